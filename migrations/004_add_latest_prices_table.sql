@@ -0,0 +1,88 @@
+-- Migration: add_latest_prices_table
+-- Created: 2026-10-18 09:12:41.305118
+
+-- Write your SQL changes below
+
+-- One row per asset holding its most recent price, so valuation queries read the
+-- latest price with a primary key lookup instead of a MAX(price_date) subquery
+CREATE TABLE IF NOT EXISTS latest_prices (
+    asset_id INTEGER PRIMARY KEY REFERENCES assets(asset_id),
+    price_date DATE NOT NULL,
+    price NUMERIC NOT NULL
+);
+
+INSERT INTO latest_prices (asset_id, price_date, price)
+SELECT DISTINCT ON (asset_id) asset_id, price_date, price
+FROM prices
+ORDER BY asset_id, price_date DESC
+ON CONFLICT (asset_id) DO UPDATE
+    SET price_date = EXCLUDED.price_date,
+        price = EXCLUDED.price;
+
+-- Statement-level triggers see every row of an INSERT or COPY at once through the
+-- transition table, so bulk price loads update latest_prices with one upsert
+CREATE OR REPLACE FUNCTION upsert_latest_prices() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO latest_prices (asset_id, price_date, price)
+    SELECT DISTINCT ON (asset_id) asset_id, price_date, price
+    FROM new_prices
+    ORDER BY asset_id, price_date DESC
+    ON CONFLICT (asset_id) DO UPDATE
+        SET price_date = EXCLUDED.price_date,
+            price = EXCLUDED.price
+        WHERE EXCLUDED.price_date >= latest_prices.price_date;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Updates and deletes can move an asset's latest price backwards, so recompute it
+-- from prices for the assets they touched
+CREATE OR REPLACE FUNCTION recompute_latest_prices() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM latest_prices lp
+    USING (SELECT DISTINCT asset_id FROM old_prices) changed
+    WHERE lp.asset_id = changed.asset_id;
+
+    INSERT INTO latest_prices (asset_id, price_date, price)
+    SELECT DISTINCT ON (p.asset_id) p.asset_id, p.price_date, p.price
+    FROM prices p
+    WHERE p.asset_id IN (SELECT asset_id FROM old_prices)
+    ORDER BY p.asset_id, p.price_date DESC
+    ON CONFLICT (asset_id) DO UPDATE
+        SET price_date = EXCLUDED.price_date,
+            price = EXCLUDED.price;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION truncate_latest_prices() RETURNS trigger AS $$
+BEGIN
+    TRUNCATE latest_prices;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER prices_insert_latest_prices
+    AFTER INSERT ON prices
+    REFERENCING NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION upsert_latest_prices();
+
+CREATE TRIGGER prices_update_latest_prices
+    AFTER UPDATE ON prices
+    REFERENCING OLD TABLE AS old_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION recompute_latest_prices();
+
+-- Covers updates that move a price to a different asset
+CREATE TRIGGER prices_update_new_latest_prices
+    AFTER UPDATE ON prices
+    REFERENCING NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION upsert_latest_prices();
+
+CREATE TRIGGER prices_delete_latest_prices
+    AFTER DELETE ON prices
+    REFERENCING OLD TABLE AS old_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION recompute_latest_prices();
+
+CREATE TRIGGER prices_truncate_latest_prices
+    AFTER TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE FUNCTION truncate_latest_prices();
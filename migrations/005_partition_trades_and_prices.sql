@@ -0,0 +1,129 @@
+-- Migration: partition_trades_and_prices
+-- Created: 2026-10-18 11:02:17.448920
+
+-- Write your SQL changes below
+
+-- Range-partition trades by trade_date and prices by price_date into yearly partitions,
+-- so date-bounded queries only scan the years they touch. Rows outside the created
+-- years land in the DEFAULT partition; call create_yearly_partition() ahead of each
+-- new year to keep them out of it.
+
+CREATE OR REPLACE FUNCTION create_yearly_partition(parent TEXT, partition_year INTEGER) RETURNS void AS $$
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        parent || '_' || partition_year, parent,
+        make_date(partition_year, 1, 1), make_date(partition_year + 1, 1, 1)
+    );
+END;
+$$ LANGUAGE plpgsql;
+
+-- trades
+
+ALTER TABLE trades RENAME TO trades_unpartitioned;
+ALTER TABLE trades_unpartitioned RENAME CONSTRAINT trades_pkey TO trades_unpartitioned_pkey;
+ALTER SEQUENCE trades_trade_id_seq OWNED BY NONE;
+
+-- The primary key has to include the partition key. Constraints are named explicitly
+-- so they keep their original names while the old table still holds them.
+CREATE TABLE trades (
+    trade_id INTEGER NOT NULL DEFAULT nextval('trades_trade_id_seq'),
+    portfolio_id INTEGER NOT NULL CONSTRAINT trades_portfolio_id_fkey REFERENCES portfolios(portfolio_id),
+    asset_id INTEGER NOT NULL CONSTRAINT trades_asset_id_fkey REFERENCES assets(asset_id),
+    trade_date TIMESTAMP NOT NULL,
+    side VARCHAR(4) NOT NULL CONSTRAINT trades_side_check CHECK (side IN ('BUY', 'SELL')),
+    quantity NUMERIC NOT NULL,
+    price NUMERIC NOT NULL,
+    CONSTRAINT trades_pkey PRIMARY KEY (trade_id, trade_date)
+) PARTITION BY RANGE (trade_date);
+
+ALTER SEQUENCE trades_trade_id_seq OWNED BY trades.trade_id;
+
+DO $$
+DECLARE
+    current_year INTEGER := EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER;
+    first_year INTEGER;
+    last_year INTEGER;
+BEGIN
+    SELECT LEAST(COALESCE(EXTRACT(YEAR FROM MIN(trade_date))::INTEGER, current_year), current_year - 1),
+           GREATEST(COALESCE(EXTRACT(YEAR FROM MAX(trade_date))::INTEGER, current_year), current_year + 1)
+    INTO first_year, last_year
+    FROM trades_unpartitioned;
+
+    FOR partition_year IN first_year..last_year LOOP
+        PERFORM create_yearly_partition('trades', partition_year);
+    END LOOP;
+END $$;
+
+CREATE TABLE IF NOT EXISTS trades_default PARTITION OF trades DEFAULT;
+
+INSERT INTO trades (trade_id, portfolio_id, asset_id, trade_date, side, quantity, price)
+SELECT trade_id, portfolio_id, asset_id, trade_date, side, quantity, price
+FROM trades_unpartitioned;
+
+DROP TABLE trades_unpartitioned;
+
+-- prices
+
+ALTER TABLE prices RENAME TO prices_unpartitioned;
+ALTER TABLE prices_unpartitioned RENAME CONSTRAINT prices_pkey TO prices_unpartitioned_pkey;
+
+CREATE TABLE prices (
+    asset_id INTEGER NOT NULL CONSTRAINT prices_asset_id_fkey REFERENCES assets(asset_id),
+    price_date DATE NOT NULL,
+    price NUMERIC NOT NULL,
+    CONSTRAINT prices_pkey PRIMARY KEY (asset_id, price_date)
+) PARTITION BY RANGE (price_date);
+
+DO $$
+DECLARE
+    current_year INTEGER := EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER;
+    first_year INTEGER;
+    last_year INTEGER;
+BEGIN
+    SELECT LEAST(COALESCE(EXTRACT(YEAR FROM MIN(price_date))::INTEGER, current_year), current_year - 1),
+           GREATEST(COALESCE(EXTRACT(YEAR FROM MAX(price_date))::INTEGER, current_year), current_year + 1)
+    INTO first_year, last_year
+    FROM prices_unpartitioned;
+
+    FOR partition_year IN first_year..last_year LOOP
+        PERFORM create_yearly_partition('prices', partition_year);
+    END LOOP;
+END $$;
+
+CREATE TABLE IF NOT EXISTS prices_default PARTITION OF prices DEFAULT;
+
+INSERT INTO prices (asset_id, price_date, price)
+SELECT asset_id, price_date, price
+FROM prices_unpartitioned;
+
+-- Dropping the old table drops its latest_prices triggers, so recreate them on the new
+-- one (latest_prices already matches the copied rows)
+DROP TABLE prices_unpartitioned;
+
+CREATE TRIGGER prices_insert_latest_prices
+    AFTER INSERT ON prices
+    REFERENCING NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION upsert_latest_prices();
+
+CREATE TRIGGER prices_update_latest_prices
+    AFTER UPDATE ON prices
+    REFERENCING OLD TABLE AS old_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION recompute_latest_prices();
+
+CREATE TRIGGER prices_update_new_latest_prices
+    AFTER UPDATE ON prices
+    REFERENCING NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION upsert_latest_prices();
+
+CREATE TRIGGER prices_delete_latest_prices
+    AFTER DELETE ON prices
+    REFERENCING OLD TABLE AS old_prices
+    FOR EACH STATEMENT EXECUTE FUNCTION recompute_latest_prices();
+
+CREATE TRIGGER prices_truncate_latest_prices
+    AFTER TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE FUNCTION truncate_latest_prices();
+
+ANALYZE trades;
+ANALYZE prices;
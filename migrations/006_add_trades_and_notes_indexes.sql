@@ -0,0 +1,32 @@
+-- Migration: add_trades_and_notes_indexes
+-- Created: 2026-10-18 11:05:52.127374
+
+-- Write your SQL changes below
+
+-- EXPLAIN ANALYZE execution times before migration 005 and after 005 + 006, on data from
+-- `generate_data.py --bulk --trades 10000000 --portfolios 200000 --assets 2000 --prices 730 --notes 1000000 --seed 42`
+-- (PostgreSQL 16, single core, measured with `python explain_queries.py --output plans.txt`):
+--
+--   get_all_trades_for_asset_in_portfolio     840.0 ms ->    0.1 ms  (parallel seq scan -> index scan)
+--   get_recent_trades (30 days, ~810k rows)   3883.9 ms -> 1863.1 ms  (scans one yearly partition)
+--   get_trade_counts_by_asset                 3388.4 ms -> 3123.6 ms  (index-only scan on asset_id)
+--   get_assets_with_possible_notes            1109.2 ms ->  707.9 ms
+--   get_notes_with_possible_assets             475.7 ms ->  311.0 ms
+--   get_all_assets_and_notes                   452.1 ms ->  375.4 ms
+--
+-- On that data set migration 005 took 210s and this one took 31s.
+
+-- get_all_trades_for_asset_in_portfolio filters on (portfolio_id, asset_id) and sorts by trade_date
+CREATE INDEX IF NOT EXISTS trades_portfolio_asset_date_idx ON trades (portfolio_id, asset_id, trade_date);
+
+-- get_recent_trades filters and sorts on trade_date
+CREATE INDEX IF NOT EXISTS trades_trade_date_idx ON trades (trade_date);
+
+-- get_trade_counts_by_asset groups by asset_id, which an index-only scan can serve
+CREATE INDEX IF NOT EXISTS trades_asset_id_idx ON trades (asset_id);
+
+-- The notes queries join asset_notes to assets on asset_id
+CREATE INDEX IF NOT EXISTS asset_notes_asset_id_idx ON asset_notes (asset_id);
+
+ANALYZE trades;
+ANALYZE asset_notes;
@@ -0,0 +1,17 @@
+-- Migration: add_client_full_name_search_index
+-- Created: 2026-10-18 14:12:08.417230
+
+-- Write your SQL changes below
+
+-- search_clients_by_name used to OR three ILIKE '%name%' predicates, one of them on
+-- CONCAT(first_name, ' ', last_name), which no index can serve. A stored full_name column
+-- with a trigram GIN index lets a single ILIKE on it use a bitmap index scan instead.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE clients
+    ADD COLUMN IF NOT EXISTS full_name VARCHAR(201)
+    GENERATED ALWAYS AS (first_name || ' ' || last_name) STORED;
+
+CREATE INDEX IF NOT EXISTS clients_full_name_trgm_idx ON clients USING GIN (full_name gin_trgm_ops);
+
+ANALYZE clients;
@@ -0,0 +1,116 @@
+-- Migration: add_holdings_ledger
+-- Created: 2026-10-18 15:02:47.551904
+
+-- Write your SQL changes below
+
+-- One row per (portfolio, asset) with running trade totals, kept current by statement
+-- triggers on trades so valuation and percent invested read O(positions) rows instead
+-- of aggregating the whole trade history. Average cost follows POSITIONS_CTE: the average
+-- buy price, or the average sell price for positions that were only ever sold.
+CREATE TABLE IF NOT EXISTS holdings (
+    portfolio_id INTEGER NOT NULL REFERENCES portfolios(portfolio_id),
+    asset_id INTEGER NOT NULL REFERENCES assets(asset_id),
+    trade_count BIGINT NOT NULL,
+    buy_quantity NUMERIC NOT NULL,
+    buy_notional NUMERIC NOT NULL,
+    sell_quantity NUMERIC NOT NULL,
+    sell_notional NUMERIC NOT NULL,
+    net_quantity NUMERIC GENERATED ALWAYS AS (buy_quantity - sell_quantity) STORED,
+    average_cost NUMERIC GENERATED ALWAYS AS (
+        COALESCE(buy_notional / NULLIF(buy_quantity, 0), sell_notional / NULLIF(sell_quantity, 0))
+    ) STORED,
+    cash_flow NUMERIC GENERATED ALWAYS AS (sell_notional - buy_notional) STORED,
+    PRIMARY KEY (portfolio_id, asset_id)
+);
+
+-- What holdings should contain, used to backfill it and to check it for drift
+CREATE OR REPLACE VIEW holdings_from_trades AS
+SELECT portfolio_id, asset_id,
+    COUNT(*) AS trade_count,
+    COALESCE(SUM(quantity) FILTER (WHERE side = 'BUY'), 0) AS buy_quantity,
+    COALESCE(SUM(quantity * price) FILTER (WHERE side = 'BUY'), 0) AS buy_notional,
+    COALESCE(SUM(quantity) FILTER (WHERE side = 'SELL'), 0) AS sell_quantity,
+    COALESCE(SUM(quantity * price) FILTER (WHERE side = 'SELL'), 0) AS sell_notional
+FROM trades
+GROUP BY portfolio_id, asset_id;
+
+INSERT INTO holdings (portfolio_id, asset_id, trade_count, buy_quantity, buy_notional, sell_quantity, sell_notional)
+SELECT portfolio_id, asset_id, trade_count, buy_quantity, buy_notional, sell_quantity, sell_notional
+FROM holdings_from_trades
+ON CONFLICT (portfolio_id, asset_id) DO NOTHING;
+
+-- Adds (TG_ARGV[0] = 1) or removes (-1) the trades in the changed_trades transition table
+-- from holdings, and moves their cash into or out of portfolios.cash_balance. Cash balances
+-- already in place when this migration runs are taken as current and left as they are.
+CREATE OR REPLACE FUNCTION apply_trades_to_holdings() RETURNS trigger AS $$
+DECLARE
+    direction INTEGER := TG_ARGV[0]::INTEGER;
+BEGIN
+    INSERT INTO holdings AS h (portfolio_id, asset_id, trade_count, buy_quantity, buy_notional, sell_quantity, sell_notional)
+    SELECT portfolio_id, asset_id,
+        direction * COUNT(*),
+        direction * COALESCE(SUM(quantity) FILTER (WHERE side = 'BUY'), 0),
+        direction * COALESCE(SUM(quantity * price) FILTER (WHERE side = 'BUY'), 0),
+        direction * COALESCE(SUM(quantity) FILTER (WHERE side = 'SELL'), 0),
+        direction * COALESCE(SUM(quantity * price) FILTER (WHERE side = 'SELL'), 0)
+    FROM changed_trades
+    GROUP BY portfolio_id, asset_id
+    ON CONFLICT (portfolio_id, asset_id) DO UPDATE
+        SET trade_count = h.trade_count + EXCLUDED.trade_count,
+            buy_quantity = h.buy_quantity + EXCLUDED.buy_quantity,
+            buy_notional = h.buy_notional + EXCLUDED.buy_notional,
+            sell_quantity = h.sell_quantity + EXCLUDED.sell_quantity,
+            sell_notional = h.sell_notional + EXCLUDED.sell_notional;
+
+    IF direction < 0 THEN
+        DELETE FROM holdings h
+        USING (SELECT DISTINCT portfolio_id, asset_id FROM changed_trades) changed
+        WHERE h.portfolio_id = changed.portfolio_id
+            AND h.asset_id = changed.asset_id
+            AND h.trade_count = 0;
+    END IF;
+
+    UPDATE portfolios p
+    SET cash_balance = p.cash_balance + flows.cash_flow
+    FROM (
+        SELECT portfolio_id, direction * SUM(CASE WHEN side = 'SELL' THEN quantity * price ELSE -quantity * price END) AS cash_flow
+        FROM changed_trades
+        GROUP BY portfolio_id
+    ) flows
+    WHERE p.portfolio_id = flows.portfolio_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION truncate_holdings() RETURNS trigger AS $$
+BEGIN
+    TRUNCATE holdings;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trades_insert_holdings
+    AFTER INSERT ON trades
+    REFERENCING NEW TABLE AS changed_trades
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_trades_to_holdings('1');
+
+CREATE TRIGGER trades_update_old_holdings
+    AFTER UPDATE ON trades
+    REFERENCING OLD TABLE AS changed_trades
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_trades_to_holdings('-1');
+
+CREATE TRIGGER trades_update_new_holdings
+    AFTER UPDATE ON trades
+    REFERENCING NEW TABLE AS changed_trades
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_trades_to_holdings('1');
+
+CREATE TRIGGER trades_delete_holdings
+    AFTER DELETE ON trades
+    REFERENCING OLD TABLE AS changed_trades
+    FOR EACH STATEMENT EXECUTE FUNCTION apply_trades_to_holdings('-1');
+
+CREATE TRIGGER trades_truncate_holdings
+    AFTER TRUNCATE ON trades
+    FOR EACH STATEMENT EXECUTE FUNCTION truncate_holdings();
+
+ANALYZE holdings;
@@ -0,0 +1,14 @@
+-- Migration: add_fx_rates_table
+-- Created: 2026-10-18 16:40:13.902118
+
+-- Write your SQL changes below
+
+-- Daily USD value of one unit of each currency. Valuations convert through USD, so
+-- amount_in_target = amount * rate_to_usd(source) / rate_to_usd(target), using each
+-- currency's latest rate on or before the valuation date. USD needs no rows.
+CREATE TABLE IF NOT EXISTS fx_rates (
+    currency VARCHAR(20) NOT NULL,
+    rate_date DATE NOT NULL,
+    rate_to_usd NUMERIC NOT NULL CHECK (rate_to_usd > 0),
+    PRIMARY KEY (currency, rate_date)
+);
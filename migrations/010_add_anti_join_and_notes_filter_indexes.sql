@@ -0,0 +1,75 @@
+-- Migration: add_anti_join_and_notes_filter_indexes
+-- Created: 2026-10-18 19:12:40.318227
+-- migrate:no-transaction
+
+-- Write your SQL changes below
+
+-- p50 latency per benchmark tier after this migration and the query rewrites that go with it,
+-- with the log-log slope from 100k to 10m (1.0 is linear), from `python benchmark.py --scaling`
+-- (PostgreSQL 16, single core; 10m is 10M trades and 1M notes):
+--
+--                                                 1k        100k         10m   slope
+--   get_clients_with_no_trades                 2.1 ms     20.9 ms   1070.1 ms    0.85
+--   get_clients_with_no_trades_page            1.2 ms      3.3 ms      4.1 ms    0.05
+--   get_clients_with_no_trades_filtered        1.0 ms     10.0 ms     13.2 ms    0.06
+--   get_assets_with_possible_notes             0.4 ms     21.5 ms   2300.2 ms    1.02
+--   get_assets_with_possible_notes_page        0.4 ms      2.4 ms      1.2 ms   -0.15
+--   get_notes_with_possible_assets             0.4 ms     21.7 ms   2071.2 ms    0.99
+--   get_notes_with_possible_assets_filtered    0.3 ms      1.1 ms      2.0 ms    0.13
+--   get_all_assets_and_notes                   0.8 ms     27.6 ms   3080.0 ms    1.02
+--   get_all_assets_and_notes_page              0.7 ms      3.5 ms      2.2 ms   -0.10
+--
+-- The NOT IN form of get_clients_with_no_trades planned as an unhashed subplan over every
+-- trade at 10m (estimated cost 9.6e9) and was cancelled after 600s. The full notes queries
+-- now sort by (asset_id, note_id) so they can be paged, which costs them up to 1.6x over the
+-- unordered joins they replace; the _page variants read 100 rows of the same order.
+
+-- Indexes are built CONCURRENTLY, so writes carry on while they build. Each statement commits
+-- on its own and can be re-run if the migration stops part way.
+
+-- Notes get a creation time so the notes queries can be filtered by date range. Rows that
+-- already exist are stamped with the time this migration runs.
+ALTER TABLE asset_notes ADD COLUMN IF NOT EXISTS created_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+-- The notes queries return each asset's notes in note_id order and page on (asset_id, note_id),
+-- which this index serves directly. It replaces the plain asset_id index from migration 006,
+-- dropped once the new one is built.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS asset_notes_asset_note_idx ON asset_notes (asset_id, note_id);
+DROP INDEX CONCURRENTLY IF EXISTS asset_notes_asset_id_idx;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS asset_notes_created_at_idx ON asset_notes (created_at);
+
+-- get_clients_with_no_trades probes each client's portfolios for a holding (or, with a date
+-- range, a trade in the range) and stops at the first one found
+CREATE INDEX CONCURRENTLY IF NOT EXISTS portfolios_client_id_idx ON portfolios (client_id);
+
+-- A partitioned index can't be built CONCURRENTLY: create it on the parent alone (invalid
+-- until every partition's index is attached), build each partition's index CONCURRENTLY,
+-- dropping any invalid one a failed build left behind, then attach them.
+CREATE INDEX IF NOT EXISTS trades_portfolio_date_idx ON ONLY trades (portfolio_id, trade_date);
+
+SELECT
+    CASE WHEN NOT x.indisvalid THEN format('DROP INDEX CONCURRENTLY %s', x.indexrelid::regclass) END,
+    format('CREATE INDEX CONCURRENTLY IF NOT EXISTS %I ON %s (portfolio_id, trade_date)',
+           p.relname || '_portfolio_id_trade_date_idx', p.oid::regclass)
+FROM pg_inherits i
+JOIN pg_class p ON p.oid = i.inhrelid
+LEFT JOIN pg_class xc ON xc.relname = p.relname || '_portfolio_id_trade_date_idx' AND xc.relnamespace = p.relnamespace
+LEFT JOIN pg_index x ON x.indexrelid = xc.oid
+WHERE i.inhparent = 'trades'::regclass
+\gexec
+
+SELECT format('ALTER INDEX trades_portfolio_date_idx ATTACH PARTITION %s', x.oid::regclass)
+FROM pg_inherits i
+JOIN pg_class p ON p.oid = i.inhrelid
+JOIN pg_class x ON x.relname = p.relname || '_portfolio_id_trade_date_idx' AND x.relnamespace = p.relnamespace
+WHERE i.inhparent = 'trades'::regclass
+    AND NOT EXISTS (SELECT 1 FROM pg_inherits attached WHERE attached.inhrelid = x.oid)
+\gexec
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS assets_asset_class_idx ON assets (asset_class);
+
+ANALYZE asset_notes;
+ANALYZE portfolios;
+ANALYZE assets;
+ANALYZE trades;
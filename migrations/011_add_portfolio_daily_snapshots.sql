@@ -0,0 +1,27 @@
+-- Migration: add_portfolio_daily_snapshots
+-- Created: 2026-10-18 21:03:55.604118
+
+-- Write your SQL changes below
+
+-- Each portfolio's value at the close of each day, written by the rollup in snapshots.py so
+-- trends can be read back without re-aggregating trades once per day in the range. Values
+-- follow POSITIONS_CTE, marked to each asset's last price on or before the day.
+CREATE TABLE IF NOT EXISTS portfolio_daily_snapshots (
+    portfolio_id INTEGER NOT NULL REFERENCES portfolios(portfolio_id),
+    snapshot_date DATE NOT NULL,
+    market_value NUMERIC NOT NULL,
+    cost_basis NUMERIC NOT NULL,
+    cash_balance NUMERIC NOT NULL,
+    percent_invested NUMERIC,
+    PRIMARY KEY (portfolio_id, snapshot_date)
+);
+
+-- Cross-portfolio reads (totals per day, a day's top portfolios) go by date
+CREATE INDEX IF NOT EXISTS portfolio_daily_snapshots_date_idx ON portfolio_daily_snapshots (snapshot_date);
+
+-- Last day each rollup job has completed; the nightly rollup starts the day after
+CREATE TABLE IF NOT EXISTS rollup_watermarks (
+    job VARCHAR(100) PRIMARY KEY,
+    last_date DATE NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,100 @@
+-- Migration: add_change_events_outbox
+-- Created: 2026-10-18 22:41:07.215846
+
+-- Write your SQL changes below
+
+-- Outbox of changes to trades and prices, written by triggers in the same transaction as the
+-- change, so add_trade, add_price, the bulk loaders and any other writer all publish. Each
+-- statement also sends a NOTIFY on the change_events channel (once per transaction and table,
+-- since Postgres folds duplicates) to wake subscribers, who then read the rows from here.
+--
+-- txid orders events by transaction. A reader takes events in (txid, event_id) order and only
+-- from transactions older than every one still running, so a long bulk load committing after
+-- later short transactions is never skipped past.
+CREATE TABLE IF NOT EXISTS change_events (
+    event_id BIGSERIAL PRIMARY KEY,
+    txid XID8 NOT NULL DEFAULT pg_current_xact_id(),
+    source VARCHAR(20) NOT NULL,
+    operation VARCHAR(8) NOT NULL,
+    old_row JSONB,
+    new_row JSONB,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS change_events_txid_idx ON change_events (txid, event_id);
+CREATE INDEX IF NOT EXISTS change_events_created_at_idx ON change_events (created_at);
+
+-- TG_ARGV[0] is the source table's name, TG_ARGV[1] the key columns that pair the old and
+-- new versions of updated rows (a row whose key changed comes out as an update with only
+-- old_row or new_row set). Sessions can skip publishing, e.g. while seeding test data, with
+-- SET portfolio.change_events = 'off'.
+CREATE OR REPLACE FUNCTION publish_change_events() RETURNS trigger AS $$
+DECLARE
+    source TEXT := TG_ARGV[0];
+    published BIGINT;
+BEGIN
+    IF current_setting('portfolio.change_events', TRUE) = 'off' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO change_events (source, operation, new_row)
+        SELECT source, TG_OP, to_jsonb(r) FROM new_rows r;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO change_events (source, operation, old_row)
+        SELECT source, TG_OP, to_jsonb(r) FROM old_rows r;
+    ELSIF TG_OP = 'UPDATE' THEN
+        EXECUTE format(
+            'INSERT INTO change_events (source, operation, old_row, new_row)
+             SELECT $1, $2, to_jsonb(o), to_jsonb(n) FROM old_rows o FULL JOIN new_rows n USING (%s)',
+            TG_ARGV[1]
+        ) USING source, TG_OP;
+    ELSE
+        INSERT INTO change_events (source, operation) VALUES (source, TG_OP);
+    END IF;
+
+    GET DIAGNOSTICS published = ROW_COUNT;
+    IF published > 0 THEN
+        PERFORM pg_notify('change_events', source);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trades_publish_insert
+    AFTER INSERT ON trades
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('trades', 'trade_id');
+
+CREATE TRIGGER trades_publish_update
+    AFTER UPDATE ON trades
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('trades', 'trade_id');
+
+CREATE TRIGGER trades_publish_delete
+    AFTER DELETE ON trades
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('trades', 'trade_id');
+
+CREATE TRIGGER trades_publish_truncate
+    AFTER TRUNCATE ON trades
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('trades', 'trade_id');
+
+CREATE TRIGGER prices_publish_insert
+    AFTER INSERT ON prices
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('prices', 'asset_id, price_date');
+
+CREATE TRIGGER prices_publish_update
+    AFTER UPDATE ON prices
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('prices', 'asset_id, price_date');
+
+CREATE TRIGGER prices_publish_delete
+    AFTER DELETE ON prices
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('prices', 'asset_id, price_date');
+
+CREATE TRIGGER prices_publish_truncate
+    AFTER TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE FUNCTION publish_change_events('prices', 'asset_id, price_date');
@@ -0,0 +1,61 @@
+-- Migration: add_trade_blotter_indexes
+-- Created: 2026-10-18 23:26:52.480317
+-- migrate:no-transaction
+
+-- Write your SQL changes below
+
+-- get_trade_blotter pages newest first on (trade_date, trade_id), optionally for one asset.
+-- These replace the single-column trade_date and asset_id indexes from migration 006, which
+-- the new ones serve in their place (range scans on trade_date, get_trade_counts_by_asset's
+-- index-only scan on asset_id). Portfolio filters use trades_portfolio_date_idx from 010.
+--
+-- As in 010, each index is created ON ONLY the parent, built CONCURRENTLY per partition and
+-- attached, so trades stays writable. The old indexes are dropped once the new ones exist.
+
+CREATE INDEX IF NOT EXISTS trades_date_id_idx ON ONLY trades (trade_date, trade_id);
+
+SELECT
+    CASE WHEN NOT x.indisvalid THEN format('DROP INDEX CONCURRENTLY %s', x.indexrelid::regclass) END,
+    format('CREATE INDEX CONCURRENTLY IF NOT EXISTS %I ON %s (trade_date, trade_id)',
+           p.relname || '_trade_date_trade_id_idx', p.oid::regclass)
+FROM pg_inherits i
+JOIN pg_class p ON p.oid = i.inhrelid
+LEFT JOIN pg_class xc ON xc.relname = p.relname || '_trade_date_trade_id_idx' AND xc.relnamespace = p.relnamespace
+LEFT JOIN pg_index x ON x.indexrelid = xc.oid
+WHERE i.inhparent = 'trades'::regclass
+\gexec
+
+SELECT format('ALTER INDEX trades_date_id_idx ATTACH PARTITION %s', x.oid::regclass)
+FROM pg_inherits i
+JOIN pg_class p ON p.oid = i.inhrelid
+JOIN pg_class x ON x.relname = p.relname || '_trade_date_trade_id_idx' AND x.relnamespace = p.relnamespace
+WHERE i.inhparent = 'trades'::regclass
+    AND NOT EXISTS (SELECT 1 FROM pg_inherits attached WHERE attached.inhrelid = x.oid)
+\gexec
+
+CREATE INDEX IF NOT EXISTS trades_asset_date_idx ON ONLY trades (asset_id, trade_date);
+
+SELECT
+    CASE WHEN NOT x.indisvalid THEN format('DROP INDEX CONCURRENTLY %s', x.indexrelid::regclass) END,
+    format('CREATE INDEX CONCURRENTLY IF NOT EXISTS %I ON %s (asset_id, trade_date)',
+           p.relname || '_asset_id_trade_date_idx', p.oid::regclass)
+FROM pg_inherits i
+JOIN pg_class p ON p.oid = i.inhrelid
+LEFT JOIN pg_class xc ON xc.relname = p.relname || '_asset_id_trade_date_idx' AND xc.relnamespace = p.relnamespace
+LEFT JOIN pg_index x ON x.indexrelid = xc.oid
+WHERE i.inhparent = 'trades'::regclass
+\gexec
+
+SELECT format('ALTER INDEX trades_asset_date_idx ATTACH PARTITION %s', x.oid::regclass)
+FROM pg_inherits i
+JOIN pg_class p ON p.oid = i.inhrelid
+JOIN pg_class x ON x.relname = p.relname || '_asset_id_trade_date_idx' AND x.relnamespace = p.relnamespace
+WHERE i.inhparent = 'trades'::regclass
+    AND NOT EXISTS (SELECT 1 FROM pg_inherits attached WHERE attached.inhrelid = x.oid)
+\gexec
+
+-- Partitioned indexes can't be dropped CONCURRENTLY; dropping only takes a brief lock
+DROP INDEX IF EXISTS trades_trade_date_idx;
+DROP INDEX IF EXISTS trades_asset_id_idx;
+
+ANALYZE trades;
@@ -0,0 +1,113 @@
+import asyncio
+import re
+import time
+import asyncpg
+from db_functions import (
+    DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_POOL_MIN, DB_POOL_MAX,
+    ASSETS_WITH_POSSIBLE_NOTES_SQL, NOTES_WITH_POSSIBLE_ASSETS_SQL, ALL_ASSETS_AND_NOTES_SQL,
+    ASSETS_LATEST_PRICE_SQL, PORTFOLIOS_WITH_CLIENTS_SQL, TOP_PORTFOLIOS_BY_VALUE_SQL,
+    CLIENTS_WITH_NO_TRADES_SQL, TRADE_COUNTS_BY_ASSET_SQL, PERCENTAGE_INVESTED_SQL,
+    PORTFOLIO_TOTAL_VALUES_SQL, notes_query_params,
+)
+
+def _positional(query, params=()):
+    # db_functions queries use psycopg2 %s or %(name)s placeholders, asyncpg wants $1, $2, ...
+    if isinstance(params, dict):
+        names = list(dict.fromkeys(re.findall(r"%\((\w+)\)s", query)))
+        query = re.sub(r"%\((\w+)\)s", lambda match: f"${names.index(match.group(1)) + 1}", query)
+        return query, [params[name] for name in names]
+    counter = iter(range(1, query.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", query), params
+
+async def create_pool(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX):
+    return await asyncpg.create_pool(
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+        min_size=min_size,
+        max_size=max_size,
+    )
+
+async def fetch(pool, query, *params):
+    """Run a db_functions query on a pooled connection and return (rows, columns)
+
+    params are positional, or a single dict for queries with named placeholders.
+    """
+    query, params = _positional(query, params[0] if len(params) == 1 and isinstance(params[0], dict) else params)
+    async with pool.acquire() as conn:
+        statement = await conn.prepare(query)
+        records = await statement.fetch(*params)
+        columns = [attribute.name for attribute in statement.get_attributes()]
+    return [tuple(record) for record in records], columns
+
+async def get_assets_with_possible_notes(pool):
+    return await fetch(pool, ASSETS_WITH_POSSIBLE_NOTES_SQL, notes_query_params())
+
+async def get_notes_with_possible_assets(pool):
+    return await fetch(pool, NOTES_WITH_POSSIBLE_ASSETS_SQL, notes_query_params())
+
+async def get_all_assets_and_notes(pool):
+    return await fetch(pool, ALL_ASSETS_AND_NOTES_SQL, notes_query_params())
+
+async def get_assets_latest_price(pool):
+    return await fetch(pool, ASSETS_LATEST_PRICE_SQL)
+
+async def get_portfolios_with_clients(pool):
+    return await fetch(pool, PORTFOLIOS_WITH_CLIENTS_SQL)
+
+async def get_top_portfolios_by_value(pool, limit=5):
+    return await fetch(pool, TOP_PORTFOLIOS_BY_VALUE_SQL, limit)
+
+async def get_clients_with_no_trades(pool):
+    return await fetch(pool, CLIENTS_WITH_NO_TRADES_SQL, {"asset_class": None, "after": None, "limit": None})
+
+async def get_trade_counts_by_asset(pool):
+    return await fetch(pool, TRADE_COUNTS_BY_ASSET_SQL)
+
+async def get_percentage_invested(pool):
+    return await fetch(pool, PERCENTAGE_INVESTED_SQL)
+
+async def get_portfolio_total_values(pool):
+    return await fetch(pool, PORTFOLIO_TOTAL_VALUES_SQL)
+
+# Queries report_bundle can run, keyed by their main.py action names
+BUNDLE_QUERIES = {
+    "port_vals": get_portfolio_total_values,
+    "percent_invested": get_percentage_invested,
+    "get_assets_latest_price": get_assets_latest_price,
+    "get_trade_counts_by_asset": get_trade_counts_by_asset,
+    "get_top_portfolios": get_top_portfolios_by_value,
+    "get_portfolios_with_clients": get_portfolios_with_clients,
+    "get_clients_with_no_trades": get_clients_with_no_trades,
+    "get_assets_with_possible_notes": get_assets_with_possible_notes,
+    "get_notes_with_possible_assets": get_notes_with_possible_assets,
+    "get_all_assets_and_notes": get_all_assets_and_notes,
+}
+
+DEFAULT_BUNDLE = ["port_vals", "percent_invested", "get_assets_latest_price", "get_trade_counts_by_asset"]
+
+async def _timed(name, query, pool):
+    started = time.perf_counter()
+    results, columns = await query(pool)
+    return name, results, columns, (time.perf_counter() - started) * 1000
+
+async def run_bundle(names=DEFAULT_BUNDLE, pool=None):
+    """Run the named queries concurrently, one pooled connection each
+
+    Returns (name, results, columns, elapsed_ms) per query, in the order asked for.
+    """
+    owns_pool = pool is None
+    if owns_pool:
+        pool = await create_pool(min_size=len(names), max_size=len(names))
+    try:
+        return await asyncio.gather(*(_timed(name, BUNDLE_QUERIES[name], pool) for name in names))
+    finally:
+        if owns_pool:
+            await pool.close()
+
+def report_bundle(names=DEFAULT_BUNDLE):
+    started = time.perf_counter()
+    reports = asyncio.run(run_bundle(names))
+    return reports, (time.perf_counter() - started) * 1000
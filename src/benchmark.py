@@ -0,0 +1,379 @@
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from db_functions import *
+from cache import disable_cache
+from clear_data import reset_db
+from generate_data import generate_bulk_data
+from positions import get_portfolio_values_vectorized
+from daemon import ping, run_remote, stop
+
+# Data set sizes seeded for each tier, keyed by the approximate number of trades
+TIERS = {
+    "1k": dict(num_clients=100, num_portfolios=200, num_assets=50, num_trades=1_000, num_price_days=30, num_notes=100),
+    "100k": dict(num_clients=5_000, num_portfolios=10_000, num_assets=500, num_trades=100_000, num_price_days=365,
+                 num_notes=10_000),
+    "10m": dict(num_clients=100_000, num_portfolios=200_000, num_assets=2_000, num_trades=10_000_000,
+                num_price_days=730, num_notes=1_000_000),
+}
+
+# How much slower a percentile can get than the baseline before it's flagged
+DEFAULT_THRESHOLD = 1.25
+# Sub-millisecond queries are too noisy to compare on ratio alone
+DEFAULT_MIN_DELTA_MS = 1.0
+# Reporting currency for the FX read paths, and how much slower than their
+# single-currency counterpart they may be
+FX_CURRENCY = "EUR"
+DEFAULT_MAX_FX_RATIO = 2.0
+# FX read path -> the single-currency read path it's measured against
+FX_PAIRS = {
+    "get_top_portfolios_by_value_fx": "get_top_portfolios_by_value",
+    "get_portfolio_total_values_fx": "get_portfolio_total_values",
+    "get_portfolio_values_vectorized_fx": "get_portfolio_values_vectorized",
+}
+# Rows per page, days of history and asset class for the paginated and filtered read paths
+PAGE_SIZE = 100
+FILTER_DAYS = 30
+FILTER_ASSET_CLASS = "Stock"
+# Largest log-log slope of p50 latency against tier size before a read path is flagged as
+# growing faster than linearly with the data
+DEFAULT_MAX_SCALING_SLOPE = 1.15
+
+def _sample_ids(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT portfolio_id, asset_id FROM trades LIMIT 1;")
+    row = cur.fetchone()
+    cur.execute("SELECT first_name FROM clients LIMIT 1;")
+    name = cur.fetchone()
+    cur.close()
+    conn.rollback()
+    portfolio_id, asset_id = row or (1, 1)
+    return portfolio_id, asset_id, name[0] if name else "a"
+
+def _middle_ids(conn):
+    # Keyset cursors halfway through clients and assets, so pages don't just read the start
+    cur = conn.cursor()
+    cur.execute("SELECT (SELECT MAX(client_id) / 2 FROM clients), (SELECT MAX(asset_id) / 2 FROM assets);")
+    client_id, asset_id = cur.fetchone()
+    cur.close()
+    conn.rollback()
+    return client_id or 0, asset_id or 0
+
+def _middle_trade(conn):
+    # Blotter cursor halfway back through trades, so deep pages are measured too
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT trade_date, trade_id
+        FROM trades
+        ORDER BY trade_date DESC, trade_id DESC
+        OFFSET (SELECT GREATEST(reltuples::bigint / 2, 0) FROM pg_class WHERE relname = 'trades')
+        LIMIT 1;
+    """)
+    row = cur.fetchone()
+    cur.close()
+    conn.rollback()
+    return row
+
+def read_paths(conn):
+    """Every db_functions read path, as (name, zero-argument callable) pairs"""
+    portfolio_id, asset_id, name = _sample_ids(conn)
+    middle_client_id, middle_asset_id = _middle_ids(conn)
+    middle_trade = _middle_trade(conn)
+    since = (datetime.now() - timedelta(days=FILTER_DAYS)).date()
+    return [
+        ("get_assets_with_possible_notes", lambda: get_assets_with_possible_notes(conn)),
+        ("get_notes_with_possible_assets", lambda: get_notes_with_possible_assets(conn)),
+        ("get_all_assets_and_notes", lambda: get_all_assets_and_notes(conn)),
+        ("get_assets_with_possible_notes_page",
+         lambda: get_assets_with_possible_notes(conn, limit=PAGE_SIZE, after=(middle_asset_id, None))),
+        ("get_notes_with_possible_assets_filtered",
+         lambda: get_notes_with_possible_assets(conn, FILTER_ASSET_CLASS, since, limit=PAGE_SIZE)),
+        ("get_all_assets_and_notes_page",
+         lambda: get_all_assets_and_notes(conn, limit=PAGE_SIZE, after=(middle_asset_id, None))),
+        ("get_assets_latest_price", lambda: get_assets_latest_price(conn)),
+        ("get_portfolios_with_clients", lambda: get_portfolios_with_clients(conn)),
+        ("get_recent_trades", lambda: get_recent_trades(conn)),
+        ("get_trade_blotter", lambda: get_trade_blotter(conn)),
+        ("get_trade_blotter_page", lambda: get_trade_blotter(conn, after=middle_trade)),
+        ("get_trade_blotter_filtered",
+         lambda: get_trade_blotter(conn, start=since, portfolio_id=portfolio_id, side="BUY")),
+        ("get_top_portfolios_by_value", lambda: get_top_portfolios_by_value(conn)),
+        ("get_clients_with_no_trades", lambda: get_clients_with_no_trades(conn)),
+        ("get_clients_with_no_trades_page",
+         lambda: get_clients_with_no_trades(conn, limit=PAGE_SIZE, after=middle_client_id)),
+        ("get_clients_with_no_trades_filtered",
+         lambda: get_clients_with_no_trades(conn, FILTER_ASSET_CLASS, since, limit=PAGE_SIZE)),
+        ("get_trade_counts_by_asset", lambda: get_trade_counts_by_asset(conn)),
+        ("get_all_trades_for_asset_in_portfolio",
+         lambda: get_all_trades_for_asset_in_portfolio(conn, portfolio_id, asset_id)),
+        ("get_all_clients", lambda: get_all_clients(conn)),
+        ("search_clients_by_name", lambda: search_clients_by_name(conn, name)),
+        ("get_percentage_invested", lambda: get_percentage_invested(conn)),
+        ("get_portfolio_total_values", lambda: get_portfolio_total_values(conn)),
+        ("get_portfolio_values_vectorized", lambda: get_portfolio_values_vectorized(conn)),
+        ("get_top_portfolios_by_value_fx", lambda: get_top_portfolios_by_value(conn, currency=FX_CURRENCY)),
+        ("get_portfolio_total_values_fx", lambda: get_portfolio_total_values(conn, currency=FX_CURRENCY)),
+        ("get_portfolio_values_vectorized_fx", lambda: get_portfolio_values_vectorized(conn, currency=FX_CURRENCY)),
+    ]
+
+def _percentile(sorted_values, pct):
+    # Nearest-rank percentile
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def run_benchmark(conn, func, repeat, warmup):
+    for _ in range(warmup):
+        func()
+        conn.rollback()
+
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results, _ = func()
+        latencies.append((time.perf_counter() - started) * 1000)
+        rows = len(results)
+        conn.rollback()
+
+    # Peak Python-side memory is measured on a separate run, since tracing slows it down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    conn.rollback()
+
+    latencies.sort()
+    return {
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "p99_ms": round(_percentile(latencies, 99), 3),
+        "min_ms": round(latencies[0], 3),
+        "max_ms": round(latencies[-1], 3),
+        "rows": rows,
+        "peak_memory_bytes": peak,
+    }
+
+def run_suite(conn, tier, repeat, warmup, only=None):
+    results = {}
+    for name, func in read_paths(conn):
+        if only and name not in only:
+            continue
+        results[name] = run_benchmark(conn, func, repeat, warmup)
+        stats = results[name]
+        print(f"  {name:<40} p50 {stats['p50_ms']:>10.2f} ms  p95 {stats['p95_ms']:>10.2f} ms  "
+              f"p99 {stats['p99_ms']:>10.2f} ms  rows {stats['rows']:>9}  peak {stats['peak_memory_bytes'] / 1e6:8.1f} MB")
+    return {
+        "tier": tier,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+def compare_to_baseline(current, baseline, threshold=DEFAULT_THRESHOLD, min_delta_ms=DEFAULT_MIN_DELTA_MS):
+    """Return (name, metric, baseline, current) for every percentile that got slower than threshold allows"""
+    regressions = []
+    for name, stats in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms"):
+            if stats[metric] > base[metric] * threshold and stats[metric] - base[metric] >= min_delta_ms:
+                regressions.append((name, metric, base[metric], stats[metric]))
+    return regressions
+
+def check_fx_overhead(current, max_ratio=DEFAULT_MAX_FX_RATIO):
+    """Return (name, base p50, FX p50, ratio) for every FX read path that costs more than
+    max_ratio times its single-currency counterpart"""
+    over = []
+    results = current["results"]
+    for name, base_name in FX_PAIRS.items():
+        if name not in results or base_name not in results:
+            continue
+        base, fx = results[base_name]["p50_ms"], results[name]["p50_ms"]
+        ratio = fx / base if base else 1.0
+        print(f"  {name:<40} {ratio:.2f}x {base_name}")
+        if ratio > max_ratio:
+            over.append((name, base, fx, ratio))
+    return over
+
+def _tier_size(results):
+    return TIERS[results["tier"]]["num_trades"]
+
+def check_scaling(runs, max_slope=DEFAULT_MAX_SCALING_SLOPE):
+    """Compare benchmark results from several tiers and return (name, from tier, to tier, slope)
+    for every read path whose p50 grows faster than max_slope allows
+
+    The slope is log(p50 ratio) / log(data size ratio) between consecutive tiers: 1.0 is
+    linear, 0 is constant time, 2.0 is quadratic. Sub-millisecond timings at the smaller tier
+    are mostly fixed overhead, so those steps are reported but not flagged.
+    """
+    runs = sorted(runs, key=_tier_size)
+    names = [name for name in runs[-1]["results"] if all(name in run["results"] for run in runs)]
+    over = []
+    for name in names:
+        steps = []
+        for smaller, larger in zip(runs, runs[1:]):
+            before, after = smaller["results"][name]["p50_ms"], larger["results"][name]["p50_ms"]
+            slope = math.log(max(after, 1e-3) / max(before, 1e-3)) / math.log(_tier_size(larger) / _tier_size(smaller))
+            steps.append(f"{smaller['tier']}->{larger['tier']} {slope:5.2f}")
+            if slope > max_slope and before >= DEFAULT_MIN_DELTA_MS:
+                over.append((name, smaller["tier"], larger["tier"], slope))
+        p50s = "  ".join(f"{run['results'][name]['p50_ms']:>10.2f}" for run in runs)
+        print(f"  {name:<40} p50 ms {p50s}  slope {'  '.join(steps)}")
+    return over
+
+def _latency_stats(latencies):
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": round(_percentile(latencies, 50), 3),
+        "p95_ms": round(_percentile(latencies, 95), 3),
+        "min_ms": round(latencies[0], 3),
+        "max_ms": round(latencies[-1], 3),
+    }
+
+def _time_runs(run, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        run()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return _latency_stats(latencies)
+
+def run_startup_benchmark(argv, repeat):
+    """Per-invocation latency of one main.py action: a cold `python main.py`, the same command
+    forwarded to a daemon, and the daemon request alone without starting an interpreter"""
+    socket_path = os.path.join(tempfile.mkdtemp(), "benchmark.sock")
+    local_env = {k: v for k, v in os.environ.items() if k != "PORTFOLIO_DAEMON_SOCKET"}
+    daemon_env = dict(local_env, PORTFOLIO_DAEMON_SOCKET=socket_path)
+    command = [sys.executable, "main.py", *argv]
+
+    daemon = subprocess.Popen([sys.executable, "daemon.py", "serve", "--socket", socket_path],
+                              env=local_env, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if ping(socket_path):
+                break
+            time.sleep(0.1)
+        else:
+            raise RuntimeError("The daemon didn't start")
+        # Warm up both paths (imports, page cache, the pool's first connection)
+        subprocess.run(command, env=local_env, stdout=subprocess.DEVNULL, check=True)
+        run_remote(argv, socket_path, stdout=io.StringIO())
+
+        results = {
+            "cold": _time_runs(lambda: subprocess.run(command, env=local_env, stdout=subprocess.DEVNULL, check=True),
+                               repeat),
+            "daemon_cli": _time_runs(lambda: subprocess.run(command, env=daemon_env, stdout=subprocess.DEVNULL,
+                                                            check=True), repeat),
+            "daemon_request": _time_runs(lambda: run_remote(argv, socket_path, stdout=io.StringIO()), repeat),
+        }
+    finally:
+        stop(socket_path)
+        daemon.wait(timeout=10)
+    for mode, stats in results.items():
+        print(f"  {mode:<16} p50 {stats['p50_ms']:>9.2f} ms  p95 {stats['p95_ms']:>9.2f} ms  "
+              f"min {stats['min_ms']:>9.2f} ms")
+    return {
+        "argv": list(argv),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "startup": results,
+    }
+
+def seed_tier(conn, tier, seed):
+    reset_db(conn)
+    generate_bulk_data(conn, seed=seed, defer_fk_checks=True, **TIERS[tier])
+    cur = conn.cursor()
+    cur.execute("ANALYZE;")
+    conn.commit()
+    cur.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every db_functions read path")
+    parser.add_argument("--tier", choices=list(TIERS), default="1k", help="Data set size, named by trade count")
+    parser.add_argument("--seed_db", action="store_true", help="Wipe the database and seed it for --tier first")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed used with --seed_db")
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed runs per query")
+    parser.add_argument("--only", nargs="*", help="Only run these functions")
+    parser.add_argument("--output", type=str, help="Write results as JSON to this file")
+    parser.add_argument("--baseline", type=str, help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Flag percentiles slower than baseline * threshold")
+    parser.add_argument("--min_delta_ms", type=float, default=DEFAULT_MIN_DELTA_MS,
+                        help="Ignore slowdowns smaller than this many milliseconds")
+    parser.add_argument("--max_fx_ratio", type=float, default=DEFAULT_MAX_FX_RATIO,
+                        help="Fail if an FX read path is this many times slower than single-currency valuation")
+    parser.add_argument("--startup", type=str, metavar="COMMAND",
+                        help="Instead, time cold vs daemon-backed runs of this main.py command, e.g. \"get_top_portfolios --n 5\"")
+    parser.add_argument("--scaling", nargs="+", metavar="RESULTS",
+                        help="Instead, compare JSON results from two or more tiers and flag superlinear read paths")
+    parser.add_argument("--max_slope", type=float, default=DEFAULT_MAX_SCALING_SLOPE,
+                        help="Flag read paths whose p50 grows faster than size ** max_slope between tiers")
+    args = parser.parse_args()
+
+    if args.scaling:
+        runs = []
+        for path in args.scaling:
+            with open(path) as f:
+                runs.append(json.load(f))
+        tiers = sorted((run["tier"] for run in runs), key=lambda tier: TIERS[tier]["num_trades"])
+        print(f"Scaling of p50 latency across tiers {', '.join(tiers)} (slope 1.0 is linear):")
+        superlinear = check_scaling(runs, args.max_slope)
+        for name, smaller, larger, slope in superlinear:
+            print(f"SUPERLINEAR {name}: slope {slope:.2f} from {smaller} to {larger} (> {args.max_slope})")
+        sys.exit(1 if superlinear else 0)
+
+    if args.startup:
+        print(f"Startup latency of main.py {args.startup} ({args.repeat} runs each):")
+        startup = run_startup_benchmark(shlex.split(args.startup), args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(startup, f, indent=2)
+            print(f"Results written to {args.output}")
+        sys.exit(0)
+
+    # Measure the database, not the query cache
+    disable_cache()
+    conn = get_connection()
+    if args.seed_db:
+        seed_tier(conn, args.tier, args.seed)
+
+    print(f"Benchmarking tier {args.tier} ({args.repeat} runs per query):")
+    current = run_suite(conn, args.tier, args.repeat, args.warmup, args.only)
+    conn.close()
+
+    print(f"FX conversion overhead ({FX_CURRENCY}, p50):")
+    fx_over = check_fx_overhead(current, args.max_fx_ratio)
+    for name, base, fx, ratio in fx_over:
+        print(f"FX OVERHEAD {name}: {base:.2f} ms -> {fx:.2f} ms ({ratio:.2f}x > {args.max_fx_ratio}x)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(current, baseline, args.threshold, args.min_delta_ms)
+        for name, metric, before, after in regressions:
+            print(f"REGRESSION {name} {metric}: {before:.2f} ms -> {after:.2f} ms")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+    if fx_over:
+        sys.exit(1)
@@ -0,0 +1,213 @@
+import json
+import os
+import shutil
+from datetime import datetime
+import numpy as np
+from copy_arrays import copy_to_array
+from db_functions import connection
+
+# Loaded books are cached here as one .npy file per column, memory-mapped on reload
+BOOK_CACHE_DIR = os.getenv("BOOK_CACHE_DIR", os.path.join("..", ".book_cache"))
+
+# String columns held as small integer codes into a sorted dictionary of their distinct values
+DICTIONARY_COLUMNS = {
+    "trades": ["side"],
+    "assets": ["symbol", "asset_class", "base_currency"],
+}
+
+# trades_side_check allows only these, so side is coded with a CASE rather than a lookup
+SIDES = ["BUY", "SELL"]
+
+# Per table: the query for COPY and its (name, pg_type) columns. Asset codes are array_position
+# lookups into the dictionaries passed as params
+BOOK_TABLES = {
+    "trades": ("""
+        SELECT trade_id, portfolio_id, asset_id, trade_date,
+            CASE WHEN side = 'BUY' THEN 0 ELSE 1 END, quantity::float8, price::float8
+        FROM trades
+    """, [("trade_id", "int4"), ("portfolio_id", "int4"), ("asset_id", "int4"), ("trade_date", "timestamp"),
+          ("side", "int4"), ("quantity", "float8"), ("price", "float8")]),
+    "prices": ("""
+        SELECT asset_id, price_date, price::float8
+        FROM prices
+    """, [("asset_id", "int4"), ("price_date", "date"), ("price", "float8")]),
+    "portfolios": ("""
+        SELECT portfolio_id, client_id, cash_balance::float8
+        FROM portfolios
+        ORDER BY portfolio_id
+    """, [("portfolio_id", "int4"), ("client_id", "int4"), ("cash_balance", "float8")]),
+    "assets": ("""
+        SELECT asset_id, array_position(%(symbol)s::text[], symbol::text) - 1,
+            array_position(%(asset_class)s::text[], asset_class::text) - 1,
+            array_position(%(base_currency)s::text[], base_currency::text) - 1
+        FROM assets
+        ORDER BY asset_id
+    """, [("asset_id", "int4"), ("symbol", "int4"), ("asset_class", "int4"), ("base_currency", "int4")]),
+}
+
+def _code_dtype(size):
+    for dtype in (np.uint8, np.uint16):
+        if size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    return np.dtype(np.int32)
+
+class Record:
+    """View of one row of a Table. Holds only the table and row number; fields are read
+    from the columns (and decoded, for dictionary columns) when accessed."""
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._table.value(name, self._index)
+        except KeyError:
+            raise AttributeError(f"{self._table.name} has no column '{name}'") from None
+
+    def __iter__(self):
+        return (self._table.value(name, self._index) for name in self._table.columns)
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and tuple(self) == tuple(other)
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={value!r}" for name, value in zip(self._table.columns, self))
+        return f"{self._table.name}({fields})"
+
+class Table:
+    """One table of a Book as a NumPy array per column"""
+
+    def __init__(self, name, columns, dictionaries=None):
+        self.name = name
+        self.columns = columns
+        self.dictionaries = dictionaries or {}
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"{self.name} index out of range")
+        return Record(self, index)
+
+    def __iter__(self):
+        return (Record(self, index) for index in range(len(self)))
+
+    def value(self, name, index):
+        value = self.columns[name][index]
+        if name in self.dictionaries:
+            return self.dictionaries[name][value]
+        return value.item()
+
+    def decoded(self, name):
+        """A dictionary column's values as an array of strings"""
+        return np.asarray(self.dictionaries[name], dtype=object)[self.columns[name]]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+class Book:
+    """Trades, prices, portfolios and assets held in memory as columnar NumPy arrays
+
+    IDs are int32, quantities, prices and cash float64, dates datetime64, and side, symbol,
+    asset_class and base_currency are dictionary-encoded into uint8/uint16 codes. Rows come
+    back as Record views, so nothing is materialized per row until a field is read.
+    """
+
+    def __init__(self, tables, loaded_at=None):
+        self.tables = tables
+        self.loaded_at = loaded_at or datetime.now()
+
+    def __getattr__(self, name):
+        if name != "tables" and name in self.tables:
+            return self.tables[name]
+        raise AttributeError(name)
+
+    @classmethod
+    def load(cls, conn):
+        """Load every table with a binary COPY each, in one REPEATABLE READ transaction"""
+        tables = {}
+        with connection(conn) as conn:
+            conn.commit()
+            cur = conn.cursor()
+            try:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+                cur.execute("""
+                    SELECT ARRAY(SELECT DISTINCT symbol::text FROM assets ORDER BY 1),
+                        ARRAY(SELECT DISTINCT asset_class::text FROM assets ORDER BY 1),
+                        ARRAY(SELECT DISTINCT base_currency::text FROM assets ORDER BY 1);
+                """)
+                dictionaries = dict(zip(["symbol", "asset_class", "base_currency"], cur.fetchone()), side=SIDES)
+                for name, (query, fields) in BOOK_TABLES.items():
+                    rows = copy_to_array(conn, query, fields, dictionaries)
+                    table_dictionaries = {column: dictionaries[column] for column in DICTIONARY_COLUMNS.get(name, [])}
+                    columns = {}
+                    for column, _ in fields:
+                        values = rows[column]
+                        if column in table_dictionaries:
+                            values = values.astype(_code_dtype(len(table_dictionaries[column])))
+                        columns[column] = np.ascontiguousarray(values)
+                    del rows
+                    tables[name] = Table(name, columns, table_dictionaries)
+            finally:
+                cur.close()
+                conn.rollback()
+        return cls(tables)
+
+    def save(self, path=BOOK_CACHE_DIR):
+        """Write the book to path, replacing any book already there"""
+        staging = f"{path}.tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        manifest = {"loaded_at": self.loaded_at.isoformat(), "tables": {}}
+        for name, table in self.tables.items():
+            for column, values in table.columns.items():
+                np.save(os.path.join(staging, f"{name}.{column}.npy"), values)
+            manifest["tables"][name] = {"columns": list(table.columns), "dictionaries": table.dictionaries}
+        with open(os.path.join(staging, "book.json"), "w") as f:
+            json.dump(manifest, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(staging, path)
+
+    @classmethod
+    def open(cls, path=BOOK_CACHE_DIR):
+        """Open a saved book with every column memory-mapped read-only, so only the pages
+        that are read come off disk"""
+        with open(os.path.join(path, "book.json")) as f:
+            manifest = json.load(f)
+        tables = {}
+        for name, spec in manifest["tables"].items():
+            columns = {column: np.load(os.path.join(path, f"{name}.{column}.npy"), mmap_mode="r")
+                       for column in spec["columns"]}
+            tables[name] = Table(name, columns, spec["dictionaries"])
+        return cls(tables, datetime.fromisoformat(manifest["loaded_at"]))
+
+    @property
+    def nbytes(self):
+        return sum(table.nbytes for table in self.tables.values())
+
+    def __repr__(self):
+        counts = ", ".join(f"{name}={len(table)}" for name, table in self.tables.items())
+        return f"Book({counts}, {self.nbytes / 2**20:.1f} MB, loaded {self.loaded_at:%Y-%m-%d %H:%M:%S})"
+
+def load_book(conn, cache_dir=BOOK_CACHE_DIR, max_age=None, refresh=False):
+    """Open the cached book in cache_dir, or load it from the database and cache it
+
+    The cache is a snapshot and isn't invalidated by writes: pass refresh=True, or max_age
+    in seconds, to reload a cache that may be out of date.
+    """
+    if not refresh and os.path.exists(os.path.join(cache_dir, "book.json")):
+        book = Book.open(cache_dir)
+        if max_age is None or (datetime.now() - book.loaded_at).total_seconds() <= max_age:
+            return book
+    book = Book.load(conn)
+    book.save(cache_dir)
+    return book
@@ -0,0 +1,226 @@
+import functools
+import inspect
+import os
+import shelve
+import threading
+import time
+from collections import OrderedDict
+
+# Set QUERY_CACHE to "memory" or "disk" to turn the cache on without code changes
+CACHE_BACKEND = os.getenv("QUERY_CACHE")
+CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "256"))
+CACHE_PATH = os.getenv("QUERY_CACHE_PATH", os.path.join("..", ".query_cache"))
+
+class QueryCache:
+    """TTL and LRU bounded cache of query results.
+
+    Every entry is tagged with the tables its query reads, so a write only has to
+    invalidate the entries that read the tables it changed. Subclasses provide storage.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None and entry["expires"] < time.time():
+                self._delete(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["value"]
+
+    def set(self, key, value, tables):
+        with self._lock:
+            self._store(key, {"expires": time.time() + self.ttl, "tables": frozenset(tables), "value": value})
+            while len(self) > self.max_entries:
+                self._evict_lru()
+                self.evictions += 1
+
+    def invalidate(self, tables):
+        tables = set(tables)
+        with self._lock:
+            stale = [key for key, entry in self._entries() if entry["tables"] & tables]
+            for key in stale:
+                self._delete(key)
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self),
+            }
+
+    def close(self):
+        pass
+
+class MemoryCache(QueryCache):
+    """In-process cache, private to the process that created it"""
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _load(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+
+    def _delete(self, key):
+        self._data.pop(key, None)
+
+    def _entries(self):
+        return list(self._data.items())
+
+    def _evict_lru(self):
+        self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class DiskCache(QueryCache):
+    """shelve-backed cache that survives between CLI runs
+
+    Each entry's tables, expiry and last use are kept in a small metadata shelf beside the
+    results, so hits, invalidation and eviction don't read or rewrite whole result sets.
+    Not safe for several processes writing at once.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self._shelf = shelve.open(path)
+        self._meta = shelve.open(f"{path}.meta")
+        # Results without metadata (written by an older version, or a run that died between
+        # the two writes) can never be found
+        for key in set(self._shelf.keys()) - set(self._meta.keys()):
+            del self._shelf[key]
+
+    def __len__(self):
+        return len(self._meta)
+
+    def _load(self, key):
+        meta = self._meta.get(key)
+        if meta is None:
+            return None
+        if meta["expires"] < time.time():
+            # get() drops it without needing the results
+            return meta
+        value = self._shelf.get(key)
+        if value is None:
+            return None
+        meta["used"] = time.time()
+        self._meta[key] = meta
+        return dict(meta, value=value)
+
+    def _store(self, key, entry):
+        entry = dict(entry)
+        self._shelf[key] = entry.pop("value")
+        entry["used"] = time.time()
+        self._meta[key] = entry
+
+    def _delete(self, key):
+        self._meta.pop(key, None)
+        self._shelf.pop(key, None)
+
+    def _entries(self):
+        return list(self._meta.items())
+
+    def _evict_lru(self):
+        key = min(self._meta.items(), key=lambda item: item[1]["used"])[0]
+        self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._meta.clear()
+            self._shelf.clear()
+
+    def close(self):
+        self._meta.close()
+        self._shelf.close()
+
+_cache = None
+
+def enable_cache(backend="memory", ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, path=CACHE_PATH):
+    """Turn on caching for every @cached read function in this process"""
+    global _cache
+    disable_cache()
+    if backend == "disk":
+        _cache = DiskCache(path, ttl, max_entries)
+    elif backend == "memory":
+        _cache = MemoryCache(ttl, max_entries)
+    else:
+        raise ValueError(f"Unknown cache backend '{backend}', expected 'memory' or 'disk'")
+    return _cache
+
+def disable_cache():
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+def get_cache():
+    return _cache
+
+def cache_stats():
+    return _cache.stats() if _cache is not None else None
+
+def invalidate(*tables):
+    """Drop every cached result that read any of tables"""
+    if _cache is not None:
+        _cache.invalidate(tables)
+
+def clear_cache():
+    if _cache is not None:
+        _cache.clear()
+
+def cached(*tables):
+    """Cache a read function's (results, columns) by function name and arguments.
+
+    tables are the tables the query reads. The connection argument isn't part of the
+    key, and streamed calls always go to the database.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            params.pop("conn", None)
+            if _cache is None or params.pop("stream", False):
+                return func(*args, **kwargs)
+
+            key = repr((func.__name__, sorted(params.items())))
+            value = _cache.get(key)
+            if value is not None:
+                results, columns = value
+                return list(results), list(columns)
+            results, columns = func(*args, **kwargs)
+            _cache.set(key, (results, columns), tables)
+            return list(results), list(columns)
+        return wrapper
+    return decorator
+
+if CACHE_BACKEND:
+    enable_cache(CACHE_BACKEND)
@@ -1,20 +1,40 @@
-from db_functions import get_connection
+from db_functions import connection
+from cache import clear_cache
 
-def reset_db(conn):
-    cur = conn.cursor()
-
-    # Disable foreign key checks to be able to delete data
-    cur.execute("SET session_replication_role = 'replica';")
+# Tables that describe the schema rather than hold data
+SCHEMA_TABLES = ["schema_migrations"]
 
-    # Need to list tables in correct order (child tables first)
-    tables = ["trades", "prices", "portfolios", "assets", "clients"]
+def data_tables(conn, leaves=False):
+    """Every table in the public schema except SCHEMA_TABLES
 
-    for table in tables:
-        cur.execute(f"TRUNCATE TABLE {table} RESTART IDENTITY CASCADE;")
+    Partitioned tables are listed by their root by default, or with leaves=True as their
+    partitions instead, each paired with the root its rows are loaded through.
+    """
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT c.oid::regclass::text, COALESCE(pg_partition_root(c.oid), c.oid)::regclass::text
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public'
+                AND CASE WHEN %(leaves)s THEN c.relkind = 'r' ELSE c.relkind IN ('r', 'p') AND NOT c.relispartition END
+                AND c.relname <> ALL(%(schema_tables)s)
+            ORDER BY c.relname;
+        """, {"leaves": leaves, "schema_tables": SCHEMA_TABLES})
+        tables = cur.fetchall()
+        cur.close()
+    return tables if leaves else [table for table, _ in tables]
 
-    # Enable foreign key checks again
-    cur.execute("SET session_replication_role = 'origin';")
-    conn.commit()
-    cur.close()
-    conn.close()
+def reset_db(conn):
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        # Truncating every table in one statement needs no foreign key ordering and takes
+        # one lock round instead of one per table. Replica mode skips the TRUNCATE triggers
+        # on trades and prices, whose holdings and latest_prices are in the list already.
+        tables = data_tables(conn)
+        cur.execute("SET LOCAL session_replication_role = 'replica';")
+        cur.execute(f"TRUNCATE TABLE {', '.join(tables)} RESTART IDENTITY;")
+        conn.commit()
+        cur.close()
+    clear_cache()
     print("Database reset: all data deleted and sequences reset.")
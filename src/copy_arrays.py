@@ -0,0 +1,61 @@
+import io
+import numpy as np
+from db_functions import connection
+
+# Binary COPY layout: 11 byte signature, int32 flags and int32 header extension length
+COPY_HEADER_SIZE = 19
+COPY_TRAILER_SIZE = 2
+
+# Fixed-width postgres types that can be decoded straight into numpy
+PG_DTYPES = {
+    "int2": ">i2",
+    "int4": ">i4",
+    "int8": ">i8",
+    "float4": ">f4",
+    "float8": ">f8",
+    "date": ">i4",
+    "timestamp": ">i8",
+}
+
+# date and timestamp arrive as days and microseconds since 2000-01-01 and come back as datetime64
+PG_DATETIME_UNITS = {"date": "D", "timestamp": "us"}
+PG_EPOCH = np.datetime64("2000-01-01")
+
+def copy_to_array(conn, query, fields, params=None):
+    """Run query through COPY ... TO STDOUT (FORMAT binary) and decode it into a numpy structured array
+
+    fields is a list of (name, pg_type) pairs matching the query's columns. Every column
+    must be one of PG_DTYPES and NOT NULL, so each row has the same width and the whole
+    buffer can be viewed with np.frombuffer instead of being parsed row by row. params are
+    bound into query client-side, since COPY can't take parameters.
+    """
+    row_dtype = [("field_count", ">i2")]
+    for name, pg_type in fields:
+        row_dtype.append((f"{name}_length", ">i4"))
+        row_dtype.append((name, PG_DTYPES[pg_type]))
+    row_dtype = np.dtype(row_dtype)
+
+    buf = io.BytesIO()
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        if params is not None:
+            query = cur.mogrify(query, params).decode()
+        cur.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary);", buf)
+        cur.close()
+
+    data = buf.getbuffer()[COPY_HEADER_SIZE:-COPY_TRAILER_SIZE]
+    rows = np.frombuffer(data, dtype=row_dtype)
+    native_dtype = np.dtype([(name, _native_dtype(pg_type)) for name, pg_type in fields])
+    result = np.empty(len(rows), dtype=native_dtype)
+    for name, pg_type in fields:
+        if pg_type in PG_DATETIME_UNITS:
+            unit = PG_DATETIME_UNITS[pg_type]
+            result[name] = PG_EPOCH.astype(f"datetime64[{unit}]") + rows[name].astype(f"timedelta64[{unit}]")
+        else:
+            result[name] = rows[name]
+    return result
+
+def _native_dtype(pg_type):
+    if pg_type in PG_DATETIME_UNITS:
+        return np.dtype(f"datetime64[{PG_DATETIME_UNITS[pg_type]}]")
+    return np.dtype(PG_DTYPES[pg_type]).newbyteorder("=")
@@ -0,0 +1,232 @@
+import argparse
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import traceback
+
+# With PORTFOLIO_DAEMON_SOCKET set to a running daemon's socket, main.py sends its actions
+# there instead of importing everything and connecting to the database itself
+DAEMON_SOCKET = os.getenv("PORTFOLIO_DAEMON_SOCKET") or os.path.join(tempfile.gettempdir(), f"portfolio_db-{os.getuid()}.sock")
+# Options that set up process-wide state, so they only work when main.py runs the action itself
+LOCAL_ONLY_OPTIONS = ("--cache", "--profile", "--profile_output", "--slow_ms", "--cprofile", "--help", "-h")
+# Long-running actions, which would hold a daemon thread and its connection for as long as they
+# run, and actions that start a process pool, which mustn't be forked from a threaded daemon
+# holding pool connections, locks and per-request streams
+LOCAL_ONLY_ACTIONS = ("watch_events", "risk_report", "backfill_snapshots")
+# Options holding file paths, which the client makes absolute before sending
+PATH_OPTIONS = ("--file", "--rejects", "--output_dir")
+# Options that only hold a file path for some actions (--name is also a client or snapshot name)
+ACTION_PATH_OPTIONS = {"run_migration": ("--name",)}
+# Characters of output buffered per message sent back to the client
+CHUNK_SIZE = 64 * 1024
+# Modules imported when the daemon starts, so no action pays for an import
+WARM_MODULES = ["db_functions", "positions", "risk", "price_store", "holdings", "import_trades", "async_db",
+                "clear_data", "generate_data", "run_migration", "create_migration", "cache", "export",
+                "snapshots", "db_snapshots", "events"]
+
+def _send(wfile, message):
+    wfile.write(json.dumps(message).encode() + b"\n")
+    wfile.flush()
+
+class _ClientStream(io.TextIOBase):
+    """Text stream sending what's written to it to the client, CHUNK_SIZE characters at a time"""
+
+    def __init__(self, wfile, channel):
+        self.wfile = wfile
+        self.channel = channel
+        self._parts = []
+        self._size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= CHUNK_SIZE:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self._parts:
+            text = "".join(self._parts)
+            self._parts, self._size = [], 0
+            _send(self.wfile, {self.channel: text})
+
+class _ThreadStreams:
+    """Stands in for sys.stdout or sys.stderr, sending each request thread's output to its
+    own client and everything else to the daemon's real stream"""
+
+    def __init__(self, default, channel):
+        self._default = default
+        self._channel = channel
+
+    @property
+    def _stream(self):
+        return getattr(_requests, self._channel, None) or self._default
+
+    def write(self, text):
+        return self._stream.write(text)
+
+    def flush(self):
+        return self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+_requests = threading.local()
+
+def serve(socket_path=DAEMON_SOCKET, cache=None):
+    """Serve CLI actions over a Unix socket from a warm connection pool, until stopped
+
+    Each client connection carries one action. It runs on its own thread with a pooled
+    connection, at most DB_POOL_MAX at once.
+    """
+    import importlib
+    import signal
+    import socketserver
+    import main as cli
+    for module in WARM_MODULES:
+        importlib.import_module(module)
+    from db_functions import get_pool, close_pool
+    from cache import enable_cache
+
+    if cache:
+        enable_cache(cache)
+    pool = get_pool()
+    slots = threading.BoundedSemaphore(pool.maxconn)
+    sys.stdout = _ThreadStreams(sys.stdout, "stdout")
+    sys.stderr = _ThreadStreams(sys.stderr, "stderr")
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline() or "{}")
+            if request.get("command") == "ping":
+                _send(self.wfile, {"exit": 0})
+                return
+            if request.get("command") == "stop":
+                _send(self.wfile, {"exit": 0})
+                threading.Thread(target=server.shutdown).start()
+                return
+
+            _requests.stdout = _ClientStream(self.wfile, "stdout")
+            _requests.stderr = _ClientStream(self.wfile, "stderr")
+            exit_code = 0
+            try:
+                args = cli.parse_args(request.get("argv", []), prog="main.py")
+                with slots, pool.connection() as conn:
+                    cli.run_action(args, conn)
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except BrokenPipeError:
+                # The client went away
+                return
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                streams = (_requests.stdout, _requests.stderr)
+                _requests.stdout = _requests.stderr = None
+            try:
+                for stream in streams:
+                    stream.flush()
+                _send(self.wfile, {"exit": exit_code})
+            except BrokenPipeError:
+                pass
+
+    if os.path.exists(socket_path):
+        if ping(socket_path):
+            raise RuntimeError(f"A daemon is already listening on {socket_path}")
+        os.unlink(socket_path)
+    socketserver.ThreadingUnixStreamServer.daemon_threads = True
+    # Create the socket owner-only, so no other local user can connect before it's locked down
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    print(f"Serving on {socket_path} with a pool of up to {pool.maxconn} connections", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        close_pool()
+        print("Daemon stopped", file=sys.stderr)
+
+def _request(socket_path, message, stdout=None, stderr=None):
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("r", encoding="utf-8") as replies:
+            for line in replies:
+                reply = json.loads(line)
+                if "stdout" in reply:
+                    stdout.write(reply["stdout"])
+                elif "stderr" in reply:
+                    stderr.write(reply["stderr"])
+                elif "exit" in reply:
+                    return reply["exit"]
+    print("The daemon closed the connection before the action finished", file=stderr)
+    return 1
+
+def ping(socket_path=DAEMON_SOCKET):
+    try:
+        return _request(socket_path, {"command": "ping"}) == 0
+    except OSError:
+        return False
+
+def stop(socket_path=DAEMON_SOCKET):
+    return _request(socket_path, {"command": "stop"})
+
+def can_forward(argv, socket_path=DAEMON_SOCKET):
+    options = {arg.split("=", 1)[0] for arg in argv}
+    return (os.path.exists(socket_path) and not options & set(LOCAL_ONLY_OPTIONS)
+            and not set(argv) & set(LOCAL_ONLY_ACTIONS))
+
+def _absolute_paths(argv):
+    argv = list(argv)
+    path_options = PATH_OPTIONS + tuple(option for action, options in ACTION_PATH_OPTIONS.items()
+                                        if action in argv for option in options)
+    for i, arg in enumerate(argv):
+        option, _, value = arg.partition("=")
+        if option in path_options and value:
+            argv[i] = f"{option}={os.path.abspath(value)}"
+        elif arg in path_options and i + 1 < len(argv):
+            argv[i + 1] = os.path.abspath(argv[i + 1])
+    return argv
+
+def run_remote(argv, socket_path=DAEMON_SOCKET, stdout=None, stderr=None):
+    """Run a main.py action (argv without the script name) on the daemon and return its exit code"""
+    try:
+        return _request(socket_path, {"argv": _absolute_paths(argv)}, stdout, stderr)
+    except BrokenPipeError:
+        # Our reader (e.g. head) went away
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve main.py actions from a long-lived process with a warm pool")
+    parser.add_argument("command", choices=["serve", "stop", "status"])
+    parser.add_argument("--socket", type=str, default=DAEMON_SOCKET, help="Unix socket path")
+    parser.add_argument("--cache", choices=["memory", "disk"], help="Query result cache shared by every request")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.socket, args.cache)
+    elif args.command == "stop":
+        sys.exit(stop(args.socket))
+    elif ping(args.socket):
+        print(f"Daemon running on {args.socket}")
+    else:
+        print(f"No daemon on {args.socket}")
+        sys.exit(1)
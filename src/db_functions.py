@@ -1,6 +1,16 @@
+import csv
+import io
+import itertools
 import psycopg2
+import psycopg2.pool
 import os
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from dotenv import load_dotenv
+from cache import cached, clear_cache, invalidate
+from profiling import ProfilingCursor, profiling_enabled
 
 load_dotenv(dotenv_path=os.path.join("..", ".env"))
 
@@ -9,306 +19,927 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
 
-def add_price(conn, asset_id, price, price_date=None):
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO prices (asset_id, price_date, price)
-        VALUES (%s, COALESCE(%s, CURRENT_DATE), %s)
-        RETURNING asset_id, price_date;
-        """,
-        (asset_id, price_date, price),
+# Rows buffered in memory before each COPY round-trip in bulk loads
+COPY_CHUNK_SIZE = 100_000
+# Rows fetched per round-trip when streaming results from a server-side cursor
+STREAM_ITERSIZE = 10_000
+# Trades per page of get_trade_blotter
+TRADE_BLOTTER_PAGE_SIZE = 100
+
+# Positions per (portfolio, asset) come from the holdings ledger that triggers on trades keep
+# current, marked to each asset's latest price. Average cost is the average buy price (average
+# sell price for positions that were only sold), and positions in assets with no prices yet
+# are carried at cost.
+POSITIONS_CTE = """
+    WITH positions AS (
+        SELECT portfolio_id, asset_id, net_quantity, average_cost
+        FROM holdings
+    ),
+    valued_positions AS (
+        SELECT pos.portfolio_id, pos.asset_id, pos.net_quantity,
+            pos.net_quantity * COALESCE(lp.price, pos.average_cost) AS market_value,
+            pos.net_quantity * pos.average_cost AS cost_basis
+        FROM positions pos
+        LEFT JOIN latest_prices lp ON lp.asset_id = pos.asset_id
     )
-    inserted_asset_id, inserted_date = cur.fetchone()
-    conn.commit()
-    cur.close()
-    print(f"Added price for asset {inserted_asset_id} on {inserted_date}: {price}")
-    return inserted_asset_id, inserted_date
+"""
+
+# POSITIONS_CTE with every position converted to a reporting currency. The caller passes one
+# conversion factor per asset currency, which is joined to the few hundred assets (converting
+# their latest prices) before the join to holdings, so each position costs one extra multiply.
+FX_POSITIONS_CTE = """
+    WITH asset_fx AS (
+        SELECT a.asset_id, fx.factor, lp.price * fx.factor AS price
+        FROM assets a
+        JOIN unnest(%(currencies)s::text[], %(factors)s::numeric[]) AS fx(currency, factor)
+            ON fx.currency = a.base_currency
+        LEFT JOIN latest_prices lp ON lp.asset_id = a.asset_id
+    ),
+    converted_positions AS (
+        SELECT h.portfolio_id, h.asset_id,
+            h.net_quantity * COALESCE(af.price, h.average_cost * af.factor) AS market_value,
+            h.net_quantity * h.average_cost * af.factor AS cost_basis
+        FROM holdings h
+        JOIN asset_fx af ON af.asset_id = h.asset_id
+    )
+"""
+
+# Decimal places kept on cross-currency conversion factors. More only widens the NUMERIC
+# products that get summed, which is most of the cost of FX valuation.
+FX_FACTOR_SCALE = 10
+
+def add_price(conn, asset_id, price, price_date=None):
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO prices (asset_id, price_date, price)
+            VALUES (%s, COALESCE(%s, CURRENT_DATE), %s)
+            RETURNING asset_id, price_date;
+            """,
+            (asset_id, price_date, price),
+        )
+        inserted_asset_id, inserted_date = cur.fetchone()
+        conn.commit()
+        invalidate("prices")
+        cur.close()
+        print(f"Added price for asset {inserted_asset_id} on {inserted_date}: {price}")
+        return inserted_asset_id, inserted_date
 
 
+def add_fx_rate(conn, currency, rate_to_usd, rate_date=None):
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO fx_rates (currency, rate_date, rate_to_usd)
+            VALUES (%s, COALESCE(%s, CURRENT_DATE), %s)
+            ON CONFLICT (currency, rate_date) DO UPDATE SET rate_to_usd = EXCLUDED.rate_to_usd
+            RETURNING rate_date;
+            """,
+            (currency, rate_date, rate_to_usd),
+        )
+        inserted_date = cur.fetchone()[0]
+        conn.commit()
+        invalidate("fx_rates")
+        cur.close()
+        print(f"Added {currency} rate for {inserted_date}: {rate_to_usd} USD")
+        return currency, inserted_date
+
 def add_asset(conn, symbol, asset_class, base_currency):
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO assets (symbol, asset_class, base_currency)
-        VALUES (%s, %s, %s)
-        RETURNING asset_id;
-        """,
-        (symbol, asset_class, base_currency),
-    )
-    asset_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    print(f"Added asset '{symbol}' ({asset_class}, {base_currency}) with asset_id {asset_id}")
-    return asset_id
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO assets (symbol, asset_class, base_currency)
+            VALUES (%s, %s, %s)
+            RETURNING asset_id;
+            """,
+            (symbol, asset_class, base_currency),
+        )
+        asset_id = cur.fetchone()[0]
+        conn.commit()
+        invalidate("assets")
+        cur.close()
+        print(f"Added asset '{symbol}' ({asset_class}, {base_currency}) with asset_id {asset_id}")
+        return asset_id
 
 def add_trade(conn, portfolio_id, asset_id, side, quantity, price, trade_date):
     if side not in ("BUY", "SELL"):
         raise ValueError("side must be 'BUY' or 'SELL'")
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO trades (portfolio_id, asset_id, trade_date, side, quantity, price)
-        VALUES (%s, %s, COALESCE(%s, NOW()), %s, %s, %s)
-        RETURNING trade_id;
-        """,
-        (portfolio_id, asset_id, trade_date, side, quantity, price),
-    )
-    trade_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    print(f"Added trade {trade_id}: {side} {quantity} @ {price} (portfolio {portfolio_id}, asset {asset_id})")
-    return trade_id
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO trades (portfolio_id, asset_id, trade_date, side, quantity, price)
+            VALUES (%s, %s, COALESCE(%s, NOW()), %s, %s, %s)
+            RETURNING trade_id;
+            """,
+            (portfolio_id, asset_id, trade_date, side, quantity, price),
+        )
+        trade_id = cur.fetchone()[0]
+        conn.commit()
+        invalidate("trades")
+        cur.close()
+        print(f"Added trade {trade_id}: {side} {quantity} @ {price} (portfolio {portfolio_id}, asset {asset_id})")
+        return trade_id
+
+TRADE_IMPORT_COLUMNS = ["portfolio_id", "asset_id", "side", "quantity", "price", "trade_date"]
+
+def _validate_trade(row, portfolio_ids, asset_ids):
+    """Return (COPY row, None) for a valid trade mapping or (None, reason) for a rejected one"""
+    try:
+        portfolio_id = int(row.get("portfolio_id"))
+    except (TypeError, ValueError):
+        return None, "invalid portfolio_id"
+    if portfolio_id not in portfolio_ids:
+        return None, "unknown portfolio_id"
+    try:
+        asset_id = int(row.get("asset_id"))
+    except (TypeError, ValueError):
+        return None, "invalid asset_id"
+    if asset_id not in asset_ids:
+        return None, "unknown asset_id"
+    side = str(row.get("side") or "").strip().upper()
+    if side not in ("BUY", "SELL"):
+        return None, "side must be 'BUY' or 'SELL'"
+    try:
+        quantity = Decimal(str(row.get("quantity")).strip())
+        price = Decimal(str(row.get("price")).strip())
+    except InvalidOperation:
+        return None, "invalid quantity or price"
+    if not quantity.is_finite() or not price.is_finite() or quantity <= 0 or price <= 0:
+        return None, "quantity and price must be positive"
+    trade_date = row.get("trade_date")
+    if trade_date in (None, ""):
+        trade_date = None
+    else:
+        try:
+            if not isinstance(trade_date, datetime):
+                trade_date = datetime.fromisoformat(str(trade_date).strip())
+            trade_date = trade_date.isoformat(sep=" ")
+        except ValueError:
+            return None, "invalid trade_date"
+    return (portfolio_id, asset_id, trade_date, side, quantity, price), None
+
+def add_trades_bulk(conn, trades, reject_file=None, chunk_size=COPY_CHUNK_SIZE):
+    """Validate and book many trades in one transaction.
+
+    trades is an iterable of mappings keyed by TRADE_IMPORT_COLUMNS. Valid rows are
+    streamed through COPY into a temporary staging table and merged into trades in a
+    single INSERT; rejected rows are written to reject_file with the reason instead of
+    aborting the batch. Returns (inserted, rejected).
+    """
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT portfolio_id FROM portfolios;")
+        portfolio_ids = {row[0] for row in cur.fetchall()}
+        cur.execute("SELECT asset_id FROM assets;")
+        asset_ids = {row[0] for row in cur.fetchall()}
+        cur.execute("""
+            CREATE TEMP TABLE trades_staging (
+                portfolio_id INTEGER,
+                asset_id INTEGER,
+                trade_date TIMESTAMP,
+                side VARCHAR(4),
+                quantity NUMERIC,
+                price NUMERIC
+            ) ON COMMIT DROP;
+        """)
+
+        rejected = 0
+        reject_out = open(reject_file, "w", newline="") if reject_file else None
+        reject_writer = csv.writer(reject_out) if reject_out else None
+        if reject_writer:
+            reject_writer.writerow(TRADE_IMPORT_COLUMNS + ["reason"])
+
+        def valid_rows():
+            nonlocal rejected
+            for row in trades:
+                copy_row, reason = _validate_trade(row, portfolio_ids, asset_ids)
+                if reason is None:
+                    yield copy_row
+                    continue
+                rejected += 1
+                if reject_writer:
+                    reject_writer.writerow([row.get(column) for column in TRADE_IMPORT_COLUMNS] + [reason])
+
+        try:
+            copy_rows(conn, "trades_staging", ["portfolio_id", "asset_id", "trade_date", "side", "quantity", "price"],
+                      valid_rows(), chunk_size)
+            cur.execute("""
+                INSERT INTO trades (portfolio_id, asset_id, trade_date, side, quantity, price)
+                SELECT portfolio_id, asset_id, COALESCE(trade_date, NOW()), side, quantity, price
+                FROM trades_staging;
+            """)
+            inserted = cur.rowcount
+            conn.commit()
+            invalidate("trades")
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            if reject_out:
+                reject_out.close()
+    print(f"Added {inserted} trades, rejected {rejected}" + (f" (see {reject_file})" if rejected and reject_file else ""))
+    return inserted, rejected
 
 def add_portfolio(conn, client_id, cash_balance=0):
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO portfolios (client_id, cash_balance)
-        VALUES (%s, %s)
-        RETURNING portfolio_id;
-        """,
-        (client_id, cash_balance),
-    )
-    portfolio_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    print(f"Added portfolio '{portfolio_id}' for client_id {client_id} (cash_balance={cash_balance})")
-    return portfolio_id
-
-def get_assets_with_possible_notes(conn):
-    cur = conn.cursor()
-    cur.execute("""
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO portfolios (client_id, cash_balance)
+            VALUES (%s, %s)
+            RETURNING portfolio_id;
+            """,
+            (client_id, cash_balance),
+        )
+        portfolio_id = cur.fetchone()[0]
+        conn.commit()
+        invalidate("portfolios")
+        cur.close()
+        print(f"Added portfolio '{portfolio_id}' for client_id {client_id} (cash_balance={cash_balance})")
+        return portfolio_id
+
+# The notes queries take the same filters, each of which drops out of the plan when it's
+# NULL since psycopg2 inlines parameters: asset class, an inclusive date range on when notes
+# were created, and a keyset page of at most limit rows (LIMIT NULL is no limit). Pages
+# follow (asset_id, note_id) order; an asset with no notes in range gets one row with a
+# NULL note_id.
+NOTES_DATE_FILTER = """
+    (%(start_date)s::date IS NULL OR n.created_at >= %(start_date)s::date)
+    AND (%(end_date)s::date IS NULL OR n.created_at < %(end_date)s::date + 1)
+"""
+
+ASSETS_WITH_POSSIBLE_NOTES_SQL = f"""
+    SELECT a.asset_id, a.symbol, n.note_id, n.note
+    FROM assets a
+    LEFT JOIN asset_notes n ON n.asset_id = a.asset_id AND {NOTES_DATE_FILTER}
+    WHERE (%(asset_class)s::text IS NULL OR a.asset_class = %(asset_class)s::text)
+        AND (%(after_asset_id)s::int IS NULL OR a.asset_id >= %(after_asset_id)s::int)
+        AND (%(after_asset_id)s::int IS NULL OR a.asset_id > %(after_asset_id)s::int
+             OR n.note_id > %(after_note_id)s::int)
+    ORDER BY a.asset_id, n.note_id NULLS FIRST
+    LIMIT %(limit)s::int;
+"""
+
+def notes_query_params(asset_class=None, start_date=None, end_date=None, limit=None, after=None, by_note=False):
+    # Queries paged by note_id take an int cursor, the others an (asset_id, note_id) pair
+    if after is None:
+        after_asset_id = after_note_id = None
+    elif by_note:
+        if not isinstance(after, int):
+            raise TypeError(f"after must be a note_id, not {after!r}")
+        after_asset_id, after_note_id = None, after
+    else:
+        if isinstance(after, int):
+            raise TypeError(f"after must be an (asset_id, note_id) pair, not {after!r}")
+        after_asset_id, after_note_id = after
+    return {"asset_class": asset_class, "start_date": start_date, "end_date": end_date, "limit": limit,
+            "paged": after is not None, "after_asset_id": after_asset_id, "after_note_id": after_note_id}
+
+@cached("assets", "asset_notes")
+def get_assets_with_possible_notes(conn, asset_class=None, start_date=None, end_date=None, limit=None, after=None,
+                                   stream=False):
+    """Every asset with each of its notes, or once with NULLs if it has none
+
+    Only notes created between start_date and end_date are matched. Pass the (asset_id,
+    note_id) of the last row of a page as after to get the next one.
+    """
+    params = notes_query_params(asset_class, start_date, end_date, limit, after)
+    return _fetch(conn, ASSETS_WITH_POSSIBLE_NOTES_SQL, params, stream=stream)
+
+NOTES_WITH_POSSIBLE_ASSETS_SQL = f"""
+    SELECT n.note_id, n.note, a.asset_id, a.symbol
+    FROM asset_notes n
+    LEFT JOIN assets a ON a.asset_id = n.asset_id
+    WHERE {NOTES_DATE_FILTER}
+        AND (%(asset_class)s::text IS NULL OR a.asset_class = %(asset_class)s::text)
+        AND (%(after_note_id)s::int IS NULL OR n.note_id > %(after_note_id)s::int)
+    ORDER BY n.note_id
+    LIMIT %(limit)s::int;
+"""
+
+@cached("assets", "asset_notes")
+def get_notes_with_possible_assets(conn, asset_class=None, start_date=None, end_date=None, limit=None, after=None,
+                                   stream=False):
+    """Every note created between start_date and end_date with its asset, NULLs if it has none
+
+    Notes come in note_id order; pass the last note_id of a page as after to get the next one.
+    With asset_class, only notes on assets of that class are returned.
+    """
+    params = notes_query_params(asset_class, start_date, end_date, limit, after, by_note=True)
+    return _fetch(conn, NOTES_WITH_POSSIBLE_ASSETS_SQL, params, stream=stream)
+
+# Assets with their notes, then the notes with no asset (or one that no longer exists) as
+# rows with a NULL asset_id. Planned as two index-friendly halves instead of a FULL OUTER
+# JOIN, which Postgres can only run as a hash or merge join over both tables. Each half is
+# ordered and limited on its own, so a page reads at most limit rows from either. Notes
+# with no asset have no asset class, so an asset_class filter leaves them out.
+ALL_ASSETS_AND_NOTES_SQL = f"""
+    (
         SELECT a.asset_id, a.symbol, n.note_id, n.note
         FROM assets a
-        LEFT JOIN asset_notes n ON a.asset_id = n.asset_id
-        ORDER BY a.asset_id;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_notes_with_possible_assets(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT n.note_id, n.note, a.asset_id, a.symbol
+        LEFT JOIN asset_notes n ON n.asset_id = a.asset_id AND {NOTES_DATE_FILTER}
+        WHERE (%(asset_class)s::text IS NULL OR a.asset_class = %(asset_class)s::text)
+            AND (NOT %(paged)s::boolean OR a.asset_id >= %(after_asset_id)s::int)
+            AND (NOT %(paged)s::boolean OR a.asset_id > %(after_asset_id)s::int
+                 OR n.note_id > %(after_note_id)s::int)
+        ORDER BY a.asset_id, n.note_id NULLS FIRST
+        LIMIT %(limit)s::int
+    )
+    UNION ALL
+    (
+        SELECT NULL, NULL, n.note_id, n.note
         FROM asset_notes n
-        RIGHT JOIN assets a ON n.asset_id = a.asset_id;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_all_assets_and_notes(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT a.asset_id, a.symbol, n.note_id, n.note
-        FROM assets a
-        FULL OUTER JOIN asset_notes n ON a.asset_id = n.asset_id;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_assets_latest_price(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT a.asset_id, a.symbol, p.price_date, p.price
-        FROM assets a
-        JOIN prices p ON a.asset_id = p.asset_id AND p.price_date = (
-            SELECT MAX(price_date) FROM prices WHERE asset_id = a.asset_id
-        )
-        ORDER BY a.asset_id;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_portfolios_with_clients(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT p.portfolio_id, CONCAT(c.first_name, ' ', c.last_name) AS client_name
+        WHERE NOT EXISTS (SELECT 1 FROM assets a WHERE a.asset_id = n.asset_id)
+            AND {NOTES_DATE_FILTER}
+            AND %(asset_class)s::text IS NULL
+            AND (NOT %(paged)s::boolean OR %(after_asset_id)s::int IS NOT NULL
+                 OR n.note_id > %(after_note_id)s::int)
+        ORDER BY n.note_id
+        LIMIT %(limit)s::int
+    )
+    ORDER BY asset_id NULLS LAST, note_id NULLS FIRST
+    LIMIT %(limit)s::int;
+"""
+
+@cached("assets", "asset_notes")
+def get_all_assets_and_notes(conn, asset_class=None, start_date=None, end_date=None, limit=None, after=None,
+                             stream=False):
+    """Every asset with its notes, followed by every note with no asset
+
+    Takes the same filters as get_assets_with_possible_notes. Rows for notes with no asset
+    have a NULL asset_id, so their page cursor is (None, note_id).
+    """
+    params = notes_query_params(asset_class, start_date, end_date, limit, after)
+    return _fetch(conn, ALL_ASSETS_AND_NOTES_SQL, params, stream=stream)
+
+ASSETS_LATEST_PRICE_SQL = """
+    SELECT a.asset_id, a.symbol, p.price_date, p.price
+    FROM assets a
+    JOIN latest_prices p ON a.asset_id = p.asset_id
+    ORDER BY a.asset_id;
+"""
+
+@cached("assets", "prices")
+def get_assets_latest_price(conn, stream=False):
+    return _fetch(conn, ASSETS_LATEST_PRICE_SQL, stream=stream)
+
+PORTFOLIOS_WITH_CLIENTS_SQL = """
+    SELECT p.portfolio_id, CONCAT(c.first_name, ' ', c.last_name) AS client_name
+    FROM portfolios p
+    INNER JOIN clients c ON p.client_id = c.client_id;
+"""
+
+@cached("portfolios", "clients")
+def get_portfolios_with_clients(conn, stream=False):
+    return _fetch(conn, PORTFOLIOS_WITH_CLIENTS_SQL, stream=stream)
+
+# Newest trades first, paged on (trade_date, trade_id). The filters left as NULL fold away
+# when the query is planned, so each page is one backward range scan of an index ending in
+# trade_date that stops after limit rows, and trade_date bounds prune partitions.
+TRADE_BLOTTER_SQL = """
+    SELECT trade_id, portfolio_id, asset_id, trade_date, side, quantity, price
+    FROM trades
+    WHERE (%(start)s::timestamp IS NULL OR trade_date >= %(start)s::timestamp)
+        AND (%(end)s::timestamp IS NULL OR trade_date < %(end)s::timestamp)
+        AND (%(days)s::int IS NULL OR trade_date >= NOW() - make_interval(days => %(days)s::int))
+        AND (%(portfolio_id)s::int IS NULL OR portfolio_id = %(portfolio_id)s::int)
+        AND (%(asset_id)s::int IS NULL OR asset_id = %(asset_id)s::int)
+        AND (%(side)s::text IS NULL OR side = %(side)s::text)
+        AND (%(after_date)s::timestamp IS NULL
+            OR trade_date <= %(after_date)s::timestamp
+                AND (trade_date, trade_id) < (%(after_date)s::timestamp, %(after_id)s::int))
+    ORDER BY trade_date DESC, trade_id DESC
+    LIMIT %(limit)s;
+"""
+
+def _trade_blotter_params(start, end, portfolio_id, asset_id, side, limit, after, days=None):
+    if side is not None and side not in ("BUY", "SELL"):
+        raise ValueError("side must be 'BUY' or 'SELL'")
+    after_date, after_id = after if after is not None else (None, None)
+    return {"start": start, "end": end, "days": days, "portfolio_id": portfolio_id, "asset_id": asset_id, "side": side,
+            "after_date": after_date, "after_id": after_id, "limit": limit}
+
+@cached("trades")
+def get_trade_blotter(conn, start=None, end=None, portfolio_id=None, asset_id=None, side=None,
+                      limit=TRADE_BLOTTER_PAGE_SIZE, after=None, stream=False):
+    """Trades from start (inclusive) to end (exclusive), newest first, optionally for one
+    portfolio, asset or side
+
+    Pass the (trade_date, trade_id) of the last row of a page as after to get the next one.
+    Every page costs the same however deep into the history it is.
+    """
+    params = _trade_blotter_params(start, end, portfolio_id, asset_id, side, limit, after)
+    return _fetch(conn, TRADE_BLOTTER_SQL, params, stream=stream)
+
+def get_recent_trades(conn, days=30, limit=None, after=None, stream=False):
+    """Trades in the last days days, newest first, paged like get_trade_blotter"""
+    # Not cached, since the window moves with every call. The cutoff is taken from the
+    # server's clock, which stamps the trades, rather than the client's
+    params = _trade_blotter_params(None, None, None, None, None, limit, after, days)
+    return _fetch(conn, TRADE_BLOTTER_SQL, params, stream=stream)
+
+TOP_PORTFOLIOS_BY_VALUE_SQL = POSITIONS_CTE + """
+    SELECT portfolio_id, ROUND(SUM(market_value), 2) AS total_value
+    FROM valued_positions
+    GROUP BY portfolio_id
+    ORDER BY total_value DESC
+    LIMIT %s;
+"""
+
+TOP_PORTFOLIOS_BY_VALUE_FX_SQL = FX_POSITIONS_CTE + """
+    SELECT portfolio_id, ROUND(SUM(market_value), 2) AS total_value
+    FROM converted_positions
+    GROUP BY portfolio_id
+    ORDER BY total_value DESC
+    LIMIT %(limit)s;
+"""
+
+@cached("trades", "prices", "assets", "fx_rates")
+def get_top_portfolios_by_value(conn, limit=5, currency=None, as_of=None, stream=False):
+    """Top portfolios by market value, optionally converted to currency at as_of FX rates"""
+    if currency is None:
+        return _fetch(conn, TOP_PORTFOLIOS_BY_VALUE_SQL, (limit,), stream=stream)
+    params = _fx_params(conn, currency, as_of)
+    params["limit"] = limit
+    return _fetch(conn, TOP_PORTFOLIOS_BY_VALUE_FX_SQL, params, stream=stream)
+
+# A client has traded if any of their portfolios has a row in the holdings ledger, which
+# triggers on trades keep to exactly the (portfolio, asset) pairs with trades. Each portfolio
+# is checked with one holdings_pkey probe that stops at the first row (the LIMIT keeps the
+# planner from hashing the whole ledger instead). NOT IN joined every trade to its client,
+# too many to hash at scale, and matched no one if a client_id was NULL.
+CLIENTS_WITH_NO_TRADES_SQL = """
+    SELECT c.client_id, CONCAT(c.first_name, ' ', c.last_name) AS client_name
+    FROM clients c
+    WHERE NOT EXISTS (
+        SELECT 1
         FROM portfolios p
-        INNER JOIN clients c ON p.client_id = c.client_id;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_recent_trades(conn, days=30):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT *
-        FROM trades
-        WHERE trade_date >= NOW() - INTERVAL '%s days'
-        ORDER BY trade_date DESC;
-    """, (days,))
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_top_portfolios_by_value(conn, limit=5):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT p.portfolio_id, SUM(t.quantity * t.price) AS total_value
+        CROSS JOIN LATERAL (
+            SELECT 1
+            FROM holdings h
+            WHERE h.portfolio_id = p.portfolio_id
+                AND (%(asset_class)s::text IS NULL
+                     OR h.asset_id IN (SELECT asset_id FROM assets WHERE asset_class = %(asset_class)s::text))
+            LIMIT 1
+        ) traded
+        WHERE p.client_id = c.client_id
+    )
+        AND (%(after)s::int IS NULL OR c.client_id > %(after)s::int)
+    ORDER BY c.client_id
+    LIMIT %(limit)s::int;
+"""
+
+# The ledger has no dates, so with a date range the trades themselves are probed, on
+# (portfolio_id, trade_date)
+CLIENTS_WITH_NO_TRADES_BETWEEN_SQL = """
+    SELECT c.client_id, CONCAT(c.first_name, ' ', c.last_name) AS client_name
+    FROM clients c
+    WHERE NOT EXISTS (
+        SELECT 1
         FROM portfolios p
-        JOIN trades t ON p.portfolio_id = t.portfolio_id
-        GROUP BY p.portfolio_id
-        ORDER BY total_value DESC
-        LIMIT %s;
-    """, (limit,))
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_clients_with_no_trades(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT c.client_id, CONCAT(c.first_name, ' ', c.last_name) AS client_name
-        FROM clients c
-        WHERE c.client_id NOT IN (
-            SELECT p.client_id
-            FROM portfolios p
-            JOIN trades t ON p.portfolio_id = t.portfolio_id
-        )
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_trade_counts_by_asset(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT asset_id, COUNT(*) AS trade_count
-        FROM trades
-        GROUP BY asset_id
-        ORDER BY trade_count DESC;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_all_trades_for_asset_in_portfolio(conn, portfolio_id, asset_id):
-    cur = conn.cursor()
-    cur.execute("""
+        JOIN trades t ON t.portfolio_id = p.portfolio_id
+        WHERE p.client_id = c.client_id
+            AND (%(start_date)s::date IS NULL OR t.trade_date >= %(start_date)s::date)
+            AND (%(end_date)s::date IS NULL OR t.trade_date < %(end_date)s::date + 1)
+            AND (%(asset_class)s::text IS NULL
+                 OR t.asset_id IN (SELECT asset_id FROM assets WHERE asset_class = %(asset_class)s::text))
+    )
+        AND (%(after)s::int IS NULL OR c.client_id > %(after)s::int)
+    ORDER BY c.client_id
+    LIMIT %(limit)s::int;
+"""
+
+@cached("clients", "portfolios", "trades", "assets")
+def get_clients_with_no_trades(conn, asset_class=None, start_date=None, end_date=None, limit=None, after=None,
+                               stream=False):
+    """Clients with no trades in any of their portfolios, in client_id order
+
+    With asset_class, clients with no trades in assets of that class; with start_date
+    and/or end_date (inclusive), clients with no trades in that range. Pass the last
+    client_id of a page as after to get the next one.
+    """
+    params = {"asset_class": asset_class, "start_date": start_date, "end_date": end_date, "limit": limit,
+              "after": after}
+    if start_date is None and end_date is None:
+        return _fetch(conn, CLIENTS_WITH_NO_TRADES_SQL, params, stream=stream)
+    return _fetch(conn, CLIENTS_WITH_NO_TRADES_BETWEEN_SQL, params, stream=stream)
+
+TRADE_COUNTS_BY_ASSET_SQL = """
+    SELECT asset_id, COUNT(*) AS trade_count
+    FROM trades
+    GROUP BY asset_id
+    ORDER BY trade_count DESC;
+"""
+
+@cached("trades")
+def get_trade_counts_by_asset(conn, stream=False):
+    return _fetch(conn, TRADE_COUNTS_BY_ASSET_SQL, stream=stream)
+
+@cached("trades")
+def get_all_trades_for_asset_in_portfolio(conn, portfolio_id, asset_id, stream=False):
+    return _fetch(conn, """
         SELECT *
         FROM trades
         WHERE portfolio_id = %s
             AND asset_id = %s
         ORDER BY trade_date;
-    """, (portfolio_id, asset_id))
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_all_clients(conn):
-    cur = conn.cursor()
-    cur.execute("SELECT client_id, first_name, last_name, CONCAT(first_name, ' ', last_name) AS full_name FROM clients;")
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def search_clients_by_name(conn, name):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT client_id, first_name, last_name, CONCAT(first_name, ' ', last_name) AS full_name 
-        FROM clients 
-        WHERE CONCAT(first_name, ' ', last_name) ILIKE %s 
-           OR first_name ILIKE %s 
-           OR last_name ILIKE %s;
-    """, (f"%{name}%", f"%{name}%", f"%{name}%"))
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
+    """, (portfolio_id, asset_id), stream=stream)
+
+@cached("clients")
+def get_all_clients(conn, stream=False):
+    return _fetch(conn, "SELECT client_id, first_name, last_name, full_name FROM clients;", stream=stream)
+
+def _like_pattern(text):
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+@cached("clients")
+def search_clients_by_name(conn, name, limit=20, after=None, stream=False):
+    """Clients whose full name contains name, best match first
+
+    Results are ordered by trigram word similarity and then client_id. Pass the (score,
+    client_id) of the last row of a page as after to get the next one.
+    """
+    after_score, after_id = after if after is not None else (None, None)
+    return _fetch(conn, """
+        WITH matches AS (
+            SELECT client_id, first_name, last_name, full_name,
+                ROUND(word_similarity(%(name)s, full_name)::numeric, 3) AS score
+            FROM clients
+            WHERE full_name ILIKE %(pattern)s
+        )
+        SELECT client_id, first_name, last_name, full_name, score
+        FROM matches
+        WHERE %(after_score)s::numeric IS NULL
+           OR score < %(after_score)s::numeric
+           OR score = %(after_score)s::numeric AND client_id > %(after_id)s::int
+        ORDER BY score DESC, client_id
+        LIMIT %(limit)s;
+    """, {"name": name, "pattern": _like_pattern(name), "after_score": after_score, "after_id": after_id,
+          "limit": limit}, stream=stream)
+
+@cached("prices")
+def get_prices_as_of(conn, asset_ids, as_of_dates, max_gap_days=None, stream=False):
+    """Resolve the price of each (asset_id, as_of_date) pair in one query
+
+    Each pair gets the asset's last price on or before its date, so weekends and
+    holidays are forward-filled. With max_gap_days, prices older than that many days
+    before the date come back as NULL. Rows are returned in the order the pairs were given.
+    """
+    return _fetch(conn, """
+        SELECT q.asset_id, q.as_of, p.price_date, p.price
+        FROM unnest(%(asset_ids)s::int[], %(dates)s::date[]) WITH ORDINALITY AS q(asset_id, as_of, n)
+        LEFT JOIN LATERAL (
+            SELECT price_date, price
+            FROM prices
+            WHERE prices.asset_id = q.asset_id
+                AND prices.price_date <= q.as_of
+                AND (%(max_gap)s::int IS NULL OR prices.price_date >= q.as_of - %(max_gap)s::int)
+            ORDER BY price_date DESC
+            LIMIT 1
+        ) p ON TRUE
+        ORDER BY q.n;
+    """, {"asset_ids": list(asset_ids), "dates": list(as_of_dates), "max_gap": max_gap_days}, stream=stream)
 
 def add_client(conn, name):
     name_parts = name.strip().split(' ', 1)
     first_name = name_parts[0]
     last_name = name_parts[1] if len(name_parts) > 1 else ''
     
-    cur = conn.cursor()
-    cur.execute("INSERT INTO clients (first_name, last_name) VALUES (%s, %s) RETURNING client_id;", (first_name, last_name))
-    client_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    print(f"Added client '{first_name} {last_name}' with client_id {client_id}")
-    return client_id
-
-def get_percentage_invested(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT p.portfolio_id,
-            ROUND(
-                (COALESCE(SUM(t.quantity * t.price), 0) /
-                (COALESCE(SUM(t.quantity * t.price), 0) + p.cash_balance)) * 100, 2
-            ) AS percentage_invested
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO clients (first_name, last_name) VALUES (%s, %s) RETURNING client_id;", (first_name, last_name))
+        client_id = cur.fetchone()[0]
+        conn.commit()
+        invalidate("clients")
+        cur.close()
+        print(f"Added client '{first_name} {last_name}' with client_id {client_id}")
+        return client_id
 
-        FROM portfolios p
-        LEFT JOIN trades t ON p.portfolio_id = t.portfolio_id
-        GROUP BY p.portfolio_id, p.cash_balance;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    cur.close()
-    return results, columns
-
-def get_portfolio_total_values(conn):
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT p.portfolio_id, SUM(t.quantity * t.price) AS total_value
-        FROM portfolios p
-        JOIN trades t ON p.portfolio_id = t.portfolio_id
-        GROUP BY p.portfolio_id;
-    """)
-    results = cur.fetchall()
-    columns = [desc[0] for desc in cur.description]
-    return results, columns
+PERCENTAGE_INVESTED_SQL = POSITIONS_CTE + """
+    SELECT p.portfolio_id,
+        ROUND(
+            COALESCE(v.market_value, 0) / NULLIF(COALESCE(v.market_value, 0) + p.cash_balance, 0) * 100, 2
+        ) AS percentage_invested
+    FROM portfolios p
+    LEFT JOIN (
+        SELECT portfolio_id, SUM(market_value) AS market_value
+        FROM valued_positions
+        GROUP BY portfolio_id
+    ) v ON v.portfolio_id = p.portfolio_id
+    ORDER BY p.portfolio_id;
+"""
+
+def get_percentage_invested(conn, stream=False):
+    return _fetch(conn, PERCENTAGE_INVESTED_SQL, stream=stream)
+
+PORTFOLIO_TOTAL_VALUES_SQL = POSITIONS_CTE + """
+    SELECT portfolio_id,
+        ROUND(SUM(market_value), 2) AS market_value,
+        ROUND(SUM(cost_basis), 2) AS cost_basis,
+        ROUND(SUM(market_value - cost_basis), 2) AS unrealized_pnl
+    FROM valued_positions
+    GROUP BY portfolio_id
+    ORDER BY portfolio_id;
+"""
+
+PORTFOLIO_TOTAL_VALUES_FX_SQL = FX_POSITIONS_CTE + """
+    SELECT portfolio_id,
+        ROUND(SUM(market_value), 2) AS market_value,
+        ROUND(SUM(cost_basis), 2) AS cost_basis,
+        ROUND(SUM(market_value - cost_basis), 2) AS unrealized_pnl
+    FROM converted_positions
+    GROUP BY portfolio_id
+    ORDER BY portfolio_id;
+"""
+
+@cached("trades", "prices", "assets", "fx_rates")
+def get_portfolio_total_values(conn, currency=None, as_of=None, stream=False):
+    """Market value, cost basis and unrealized P&L per portfolio
+
+    By default each position is summed in its asset's own currency. With currency, every
+    position is converted to it at the FX rates in effect on as_of (default today).
+    """
+    if currency is None:
+        return _fetch(conn, PORTFOLIO_TOTAL_VALUES_SQL, stream=stream)
+    return _fetch(conn, PORTFOLIO_TOTAL_VALUES_FX_SQL, _fx_params(conn, currency, as_of), stream=stream)
+
+@cached("portfolio_daily_snapshots")
+def get_portfolio_history(conn, portfolio_id, start_date=None, end_date=None, stream=False):
+    """One portfolio's daily snapshots between start_date and end_date (both optional), oldest first"""
+    return _fetch(conn, """
+        SELECT snapshot_date, market_value, cost_basis, market_value - cost_basis AS unrealized_pnl,
+            cash_balance, percent_invested
+        FROM portfolio_daily_snapshots
+        WHERE portfolio_id = %(portfolio_id)s
+            AND (%(start)s::date IS NULL OR snapshot_date >= %(start)s::date)
+            AND (%(end)s::date IS NULL OR snapshot_date <= %(end)s::date)
+        ORDER BY snapshot_date;
+    """, {"portfolio_id": portfolio_id, "start": start_date, "end": end_date}, stream=stream)
+
+@cached("portfolio_daily_snapshots")
+def get_total_value_history(conn, start_date=None, end_date=None, stream=False):
+    """Daily totals across every portfolio from the snapshots, oldest first"""
+    return _fetch(conn, """
+        SELECT snapshot_date,
+            SUM(market_value) AS market_value,
+            SUM(cost_basis) AS cost_basis,
+            SUM(market_value - cost_basis) AS unrealized_pnl,
+            SUM(cash_balance) AS cash_balance,
+            ROUND(SUM(market_value) / NULLIF(SUM(market_value) + SUM(cash_balance), 0) * 100, 2) AS percent_invested
+        FROM portfolio_daily_snapshots
+        WHERE (%(start)s::date IS NULL OR snapshot_date >= %(start)s::date)
+            AND (%(end)s::date IS NULL OR snapshot_date <= %(end)s::date)
+        GROUP BY snapshot_date
+        ORDER BY snapshot_date;
+    """, {"start": start_date, "end": end_date}, stream=stream)
+
+FX_RATES_SQL = """
+    SELECT DISTINCT ON (currency) currency, rate_date, rate_to_usd
+    FROM fx_rates
+    WHERE rate_date <= COALESCE(%s::date, CURRENT_DATE)
+    ORDER BY currency, rate_date DESC;
+"""
+
+@cached("fx_rates")
+def get_fx_rates(conn, as_of=None, stream=False):
+    """Each currency's latest rate to USD on or before as_of (default today)"""
+    return _fetch(conn, FX_RATES_SQL, (as_of,), stream=stream)
+
+def get_fx_conversion_factors(conn, currency, as_of=None):
+    """Return {asset currency: factor} converting amounts in each currency held by assets
+    into currency at as_of rates. Raises ValueError if any rate is missing."""
+    rates, _ = get_fx_rates(conn, as_of)
+    rate_to_usd = {"USD": Decimal(1)}
+    rate_to_usd.update({code: rate for code, _, rate in rates})
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT DISTINCT base_currency FROM assets;")
+        asset_currencies = [row[0] for row in cur.fetchall()]
+        cur.close()
+    missing = sorted({currency, *asset_currencies} - rate_to_usd.keys())
+    if missing:
+        raise ValueError(f"No FX rate on or before {as_of or 'today'} for: {', '.join(missing)}")
+    return {code: round(rate_to_usd[code] / rate_to_usd[currency], FX_FACTOR_SCALE) for code in asset_currencies}
+
+def _fx_params(conn, currency, as_of):
+    factors = get_fx_conversion_factors(conn, currency, as_of)
+    return {"currencies": list(factors), "factors": list(factors.values())}
+
+# Characters with a special meaning in COPY text format, escaped in string values
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+def _copy_value(value):
+    # Numbers, decimals and dates never contain the escaped characters
+    if isinstance(value, str):
+        return value.translate(COPY_ESCAPES)
+    return "\\N" if value is None else value
+
+class _CopyStream(io.TextIOBase):
+    """File-like view over formatted rows so COPY reads them as they're generated"""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._pending = ""
+        self.rows = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = [self._pending]
+        length = len(self._pending)
+        for line in self._lines:
+            parts.append(line)
+            length += len(line)
+            self.rows += 1
+            if 0 <= size <= length:
+                break
+        data = "".join(parts)
+        if size < 0 or len(data) <= size:
+            self._pending = ""
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+    readline = read
+
+def copy_rows(conn, table, columns, rows, chunk_size=COPY_CHUNK_SIZE):
+    """Stream tuples of values (None for NULL) into table with COPY FROM STDIN, one COPY per chunk_size rows.
+    Runs in the caller's transaction, which is left for the caller to commit and then invalidate
+    the table's cached results."""
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN;"
+    line_format = "\t".join(["%s"] * len(columns)) + "\n"
+    lines = (line_format % tuple(_copy_value(value) for value in row) for row in rows)
+    total = 0
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        while True:
+            stream = _CopyStream(itertools.islice(lines, chunk_size))
+            cur.copy_expert(sql, stream, size=1 << 16)
+            total += stream.rows
+            if stream.rows < chunk_size:
+                break
+        cur.close()
+    return total
 
 def load_sample_data(conn):
     with open("../sql/insert_sample_data.sql", "r") as f:
         schema_sql = f.read()
     
-    cur = conn.cursor()
+    with connection(conn) as conn:
+        cur = conn.cursor()
 
-    for statement_raw in schema_sql.split(";"):
-        statement = statement_raw.strip()
-        if statement:
-            cur.execute(statement + ";")
-    cur.close()
-    conn.commit()
-    conn.close()
+        for statement_raw in schema_sql.split(";"):
+            statement = statement_raw.strip()
+            if statement:
+                cur.execute(statement + ";")
+        cur.close()
+        conn.commit()
+    clear_cache()
 
 def create_tables(conn):
     with open("../sql/schema.sql", "r") as f:
         schema_sql = f.read()
 
-    cur = conn.cursor()
-    for statement_raw in schema_sql.split(";"):
-        statement = statement_raw.strip()
-        if statement:
-            cur.execute(statement + ";")
-    cur.close()
-    conn.commit()
-    conn.close()
-
-def get_connection():
-    return psycopg2.connect(
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        for statement_raw in schema_sql.split(";"):
+            statement = statement_raw.strip()
+            if statement:
+                cur.execute(statement + ";")
+        cur.close()
+        conn.commit()
+
+def _connect_kwargs():
+    kwargs = dict(
         dbname=DB_NAME,
         user=DB_USER,
         password=DB_PASSWORD,
         host=DB_HOST,
         port=DB_PORT
     )
+    if profiling_enabled():
+        kwargs["cursor_factory"] = ProfilingCursor
+    return kwargs
+
+def get_connection(**kwargs):
+    return psycopg2.connect(**{**_connect_kwargs(), **kwargs})
+
+class ConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """Thread-safe connection pool whose checkouts are health-checked context managers"""
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, health_check=True, **kwargs):
+        super().__init__(minconn, maxconn, **{**_connect_kwargs(), **kwargs})
+        self.health_check = health_check
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        # Replace connections the server has dropped while they sat idle in the pool
+        while not self._is_healthy(conn):
+            self.putconn(conn, close=True)
+            conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            # putconn rolls back any open transaction before the connection is reused
+            self.putconn(conn)
+
+_pool = None
+
+def get_pool(minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, health_check=True):
+    """Return the process-wide pool, creating it on first use"""
+    global _pool
+    if _pool is None or _pool.closed:
+        _pool = ConnectionPool(minconn, maxconn, health_check)
+    return _pool
+
+def close_pool():
+    global _pool
+    if _pool is not None and not _pool.closed:
+        _pool.closeall()
+    _pool = None
+
+@contextmanager
+def connection(conn_or_pool):
+    """Yield a connection from either a connection or a pool.
+
+    Connections are used as-is and left open, since the caller owns them. Pool
+    checkouts are returned to the pool afterwards.
+    """
+    if isinstance(conn_or_pool, ConnectionPool):
+        with conn_or_pool.connection() as conn:
+            yield conn
+    elif isinstance(conn_or_pool, psycopg2.pool.AbstractConnectionPool):
+        conn = conn_or_pool.getconn()
+        try:
+            yield conn
+        finally:
+            conn_or_pool.putconn(conn)
+    else:
+        yield conn_or_pool
+
+def _stream(conn, query, params, itersize):
+    stack = ExitStack()
+    conn = stack.enter_context(connection(conn))
+    # Autocommit connections have no transaction to keep a plain named cursor open in
+    cur = conn.cursor(name=f"stream_{uuid.uuid4().hex}", withhold=conn.autocommit)
+    cur.itersize = itersize
+    try:
+        cur.execute(query, params)
+        # A named cursor only has a description once the first rows have been fetched
+        first_rows = cur.fetchmany(itersize)
+        columns = [desc[0] for desc in cur.description]
+    except Exception:
+        stack.close()
+        raise
+
+    def rows():
+        try:
+            yield from first_rows
+            yield from cur
+        finally:
+            cur.close()
+            stack.close()
+
+    return rows(), columns
+
+def _fetch(conn, query, params=None, stream=False, itersize=STREAM_ITERSIZE):
+    """Run a query and return (rows, columns).
+
+    With stream=True the rows come from a server-side cursor, itersize at a time, as a
+    lazy iterator, so result size doesn't bound memory. The connection stays checked out
+    until the iterator is exhausted or closed.
+    """
+    if stream:
+        return _stream(conn, query, params, itersize)
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        results = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+        cur.close()
+        return results, columns
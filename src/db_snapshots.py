@@ -0,0 +1,253 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from db_functions import connection, get_connection
+from clear_data import data_tables, reset_db
+from cache import clear_cache
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join("..", "snapshots"))
+# Tables (partitions of trades and prices count separately) dumped or loaded at once
+SNAPSHOT_WORKERS = 4
+# Wiped on restore but not saved: outbox rows carry transaction ids that mean nothing in
+# another database, or after a restore
+UNSAVED_TABLES = ["change_events"]
+
+def _snapshot_path(name, snapshot_dir):
+    if not name or os.sep in name or name.startswith("."):
+        raise ValueError(f"Invalid snapshot name '{name}'")
+    return os.path.join(snapshot_dir, name)
+
+def _copy_columns(cur, table):
+    # Generated columns (holdings' net_quantity, average_cost, cash_flow) can't be copied in
+    cur.execute("""
+        SELECT attname
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum;
+    """, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+def _schema_version(cur):
+    cur.execute("SELECT MAX(version) FROM schema_migrations;")
+    return cur.fetchone()[0]
+
+def _dump_table(snapshot_id, table, columns, path):
+    # Each worker has its own connection, reading the exporting transaction's snapshot
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cur.execute("SET TRANSACTION SNAPSHOT %s;", (snapshot_id,))
+        with open(path, "wb") as f:
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) TO STDOUT (FORMAT binary);", f)
+        rows = cur.rowcount
+        cur.close()
+        conn.rollback()
+        return rows
+    finally:
+        conn.close()
+
+def save_snapshot(conn, name, workers=SNAPSHOT_WORKERS, snapshot_dir=SNAPSHOT_DIR):
+    """Dump every data table to snapshot_dir/name as binary COPY files, replacing any
+    snapshot of that name
+
+    Tables are dumped in parallel, all from one exported transaction snapshot, so the dump
+    is consistent across tables while writes carry on.
+    """
+    path = _snapshot_path(name, snapshot_dir)
+    staging = f"{path}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    started = time.perf_counter()
+
+    with connection(conn) as conn:
+        conn.commit()
+        cur = conn.cursor()
+        try:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+            cur.execute("SELECT pg_export_snapshot();")
+            snapshot_id = cur.fetchone()[0]
+            tables = [{"table": table, "target": target, "columns": _copy_columns(cur, table), "file": f"{table}.copy"}
+                      for table, target in data_tables(conn, leaves=True) if table not in UNSAVED_TABLES]
+            cur.execute("SELECT schemaname || '.' || sequencename, last_value FROM pg_sequences WHERE last_value IS NOT NULL;")
+            sequences = dict(cur.fetchall())
+            schema_version = _schema_version(cur)
+            # The exported snapshot is only usable while this transaction stays open
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                counts = pool.map(_dump_table, [snapshot_id] * len(tables), [t["table"] for t in tables],
+                                  [t["columns"] for t in tables], [os.path.join(staging, t["file"]) for t in tables])
+                for table, rows in zip(tables, counts):
+                    table["rows"] = rows
+        finally:
+            cur.close()
+            conn.rollback()
+
+    manifest = {
+        "name": name,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "schema_version": schema_version,
+        "tables": tables,
+        "sequences": sequences,
+    }
+    with open(os.path.join(staging, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(staging, path)
+    total_rows = sum(table["rows"] for table in tables)
+    print(f"Saved snapshot '{name}': {total_rows} rows from {len(tables)} tables in {time.perf_counter() - started:.1f}s")
+    return manifest
+
+def _secondary_indexes(cur, tables):
+    # Indexes that don't back a primary key or unique constraint, on the tables rows are
+    # loaded through. A partitioned index is dropped and rebuilt across every partition; its
+    # definition reads ON ONLY, which would leave the partitions unindexed.
+    cur.execute("""
+        SELECT i.indexrelid::regclass::text,
+            regexp_replace(regexp_replace(pg_get_indexdef(i.indexrelid), ' ON ONLY ', ' ON '),
+                           '^CREATE (UNIQUE )?INDEX ', 'CREATE \\1INDEX IF NOT EXISTS ')
+        FROM pg_index i
+        WHERE i.indrelid = ANY(%s::regclass[])
+            AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+        ORDER BY 1;
+    """, (list(tables),))
+    return cur.fetchall()
+
+def _pending_indexes_path(conn, snapshot_dir):
+    # Indexes a restore has dropped and not yet rebuilt, so a killed restore doesn't lose them
+    return os.path.join(snapshot_dir, f".pending_indexes_{conn.info.dbname}.json")
+
+def _read_pending_indexes(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [tuple(index) for index in json.load(f)]
+
+def _write_pending_indexes(path, indexes):
+    if not indexes:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(indexes, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+def _execute(statement):
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(statement)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+def _load_table(table, columns, path):
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        # Replica mode skips the holdings and latest_prices triggers (those tables are
+        # restored from the snapshot too) and foreign key checks, since tables load in any order
+        cur.execute("SET session_replication_role = 'replica';")
+        with open(path, "rb") as f:
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN (FORMAT binary);", f)
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+def _rebuild_indexes(indexes, workers):
+    # Returns the indexes that couldn't be rebuilt
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(index, pool.submit(_execute, index[1])) for index in indexes]
+        for index, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to rebuild index {index[0]}: {e}")
+                failed.append(index)
+    return failed
+
+def restore_snapshot(conn, name, workers=SNAPSHOT_WORKERS, snapshot_dir=SNAPSHOT_DIR):
+    """Replace every table's data with the snapshot saved as name
+
+    The database is wiped first, then the tables are loaded in parallel, largest first, each
+    on its own connection. Partitions load through their parent, so the snapshot restores
+    into a database with different partitions. Secondary indexes are dropped for the load
+    and rebuilt in parallel afterwards, as pg_restore does, which is several times faster
+    than maintaining them row by row. The dropped definitions are kept in snapshot_dir
+    until they're rebuilt, and the next restore rebuilds any an interrupted one left
+    behind. Raises ValueError if the snapshot was taken at a different migration version,
+    and RuntimeError if some indexes couldn't be rebuilt.
+
+    Loading in replica mode and wiping with reset_db need a superuser (or a role allowed to
+    set session_replication_role).
+    """
+    path = _snapshot_path(name, snapshot_dir)
+    manifest_path = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_path):
+        raise ValueError(f"No snapshot named '{name}' in {snapshot_dir}")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    started = time.perf_counter()
+
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        schema_version = _schema_version(cur)
+        conn.rollback()
+        if schema_version != manifest["schema_version"]:
+            cur.close()
+            raise ValueError(f"Snapshot '{name}' was taken at migration {manifest['schema_version']}, "
+                             f"the database is at {schema_version}")
+
+        reset_db(conn)
+        tables = sorted(manifest["tables"], key=lambda t: os.path.getsize(os.path.join(path, t["file"])), reverse=True)
+        pending_path = _pending_indexes_path(conn, snapshot_dir)
+        indexes = _read_pending_indexes(pending_path)
+        if indexes:
+            print(f"Rebuilding {len(indexes)} indexes left dropped by an interrupted restore")
+        dropped = _secondary_indexes(cur, {t["target"] for t in tables})
+        indexes += [index for index in dropped if index[0] not in {pending for pending, _ in indexes}]
+        _write_pending_indexes(pending_path, indexes)
+        for index, _ in dropped:
+            cur.execute(f"DROP INDEX {index};")
+        conn.commit()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(_load_table, [t["target"] for t in tables], [t["columns"] for t in tables],
+                              [os.path.join(path, t["file"]) for t in tables]))
+        finally:
+            failed = _rebuild_indexes(indexes, workers)
+            _write_pending_indexes(pending_path, failed)
+
+        for sequence, last_value in manifest["sequences"].items():
+            cur.execute("SELECT setval(%s, %s);", (sequence, last_value))
+        conn.commit()
+        # TRUNCATE dropped the planner statistics along with the data
+        for table in {t["target"] for t in tables}:
+            cur.execute(f"ANALYZE {table};")
+        conn.commit()
+        cur.close()
+    clear_cache()
+    if failed:
+        raise RuntimeError(f"{len(failed)} indexes weren't rebuilt; the next restore retries them "
+                           f"(definitions in {pending_path})")
+    total_rows = sum(table["rows"] for table in tables)
+    print(f"Restored snapshot '{name}': {total_rows} rows into {len(tables)} tables in {time.perf_counter() - started:.1f}s")
+
+def list_snapshots(snapshot_dir=SNAPSHOT_DIR):
+    """(results, columns) with a row per saved snapshot"""
+    results = []
+    if os.path.isdir(snapshot_dir):
+        for name in sorted(os.listdir(snapshot_dir)):
+            manifest_path = os.path.join(snapshot_dir, name, "manifest.json")
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                results.append((name, manifest["created_at"], manifest["schema_version"],
+                                sum(table["rows"] for table in manifest["tables"])))
+    return results, ["name", "created_at", "schema_version", "rows"]
@@ -0,0 +1,115 @@
+import select
+import time
+from collections import namedtuple
+from db_functions import connection
+
+EVENT_CHANNEL = "change_events"
+# Events read per query, and the most yielded at once
+EVENT_BATCH_SIZE = 1000
+# Seconds a subscriber waits for a NOTIFY before checking the outbox anyway. Events become
+# readable only once every older transaction has finished, which sends no notification.
+EVENT_POLL_SECONDS = 1.0
+EVENT_RETENTION_DAYS = 7
+
+# Where a subscriber has read up to: the (txid, event_id) of the last event it was given
+START = ("0", 0)
+
+class ChangeEvent(namedtuple("ChangeEvent", ["txid", "event_id", "source", "operation", "old", "new", "created_at"])):
+    """One changed row of trades or prices. old and new are the row before and after as
+    dicts: INSERT has only new, DELETE only old, UPDATE both, and TRUNCATE neither."""
+
+    __slots__ = ()
+
+    @property
+    def position(self):
+        return (self.txid, self.event_id)
+
+# Only events from transactions older than the oldest one still running are read, so an
+# event can't turn up later behind a position already handed out
+READ_EVENTS_SQL = """
+    SELECT txid::text, event_id, source, operation, old_row, new_row, created_at
+    FROM change_events
+    WHERE (txid, event_id) > (%(txid)s::xid8, %(event_id)s)
+        AND txid < pg_snapshot_xmin(pg_current_snapshot())
+        AND (%(sources)s::text[] IS NULL OR source = ANY(%(sources)s::text[]))
+    ORDER BY txid, event_id
+    LIMIT %(limit)s;
+"""
+
+def read_events(conn, after=START, limit=EVENT_BATCH_SIZE, sources=None):
+    """Up to limit events after position after, oldest first"""
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(READ_EVENTS_SQL, {"txid": after[0], "event_id": after[1], "sources": sources, "limit": limit})
+        events = [ChangeEvent(*row) for row in cur.fetchall()]
+        cur.close()
+        if not conn.autocommit:
+            conn.rollback()
+    return events
+
+def latest_position(conn):
+    """Position of the last readable event, to subscribe from now on"""
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT txid::text, event_id
+            FROM change_events
+            WHERE txid < pg_snapshot_xmin(pg_current_snapshot())
+            ORDER BY txid DESC, event_id DESC
+            LIMIT 1;
+        """)
+        row = cur.fetchone()
+        cur.close()
+        if not conn.autocommit:
+            conn.rollback()
+    return tuple(row) if row else START
+
+def subscribe(conn, after=None, batch_size=EVENT_BATCH_SIZE, sources=None, poll_seconds=EVENT_POLL_SECONDS,
+              idle_timeout=None):
+    """Yield lists of ChangeEvents as they're committed, oldest first
+
+    Starts after position after (a previous event's .position, or START for everything in
+    the outbox), by default from now. LISTENs on the connection and reads the outbox when
+    notified, so events arrive within a round trip of their commit, in batches of up to
+    batch_size when they come faster than they're consumed. Stops after idle_timeout
+    seconds without events, or runs until the caller stops iterating. The connection is
+    put in autocommit mode while subscribed, so use one that isn't needed for anything else.
+    """
+    with connection(conn) as conn:
+        autocommit = conn.autocommit
+        conn.rollback()
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            cur.execute(f"LISTEN {EVENT_CHANNEL};")
+            position = latest_position(conn) if after is None else tuple(after)
+            last_event = time.monotonic()
+            while True:
+                events = read_events(conn, position, batch_size, sources)
+                if events:
+                    position = events[-1].position
+                    last_event = time.monotonic()
+                    yield events
+                    if len(events) == batch_size:
+                        continue
+                if idle_timeout is not None and time.monotonic() - last_event >= idle_timeout:
+                    return
+                wait = poll_seconds if idle_timeout is None else min(poll_seconds, idle_timeout)
+                if select.select([conn], [], [], wait)[0]:
+                    conn.poll()
+                    conn.notifies.clear()
+        finally:
+            cur.execute(f"UNLISTEN {EVENT_CHANNEL};")
+            cur.close()
+            conn.autocommit = autocommit
+
+def prune_events(conn, keep_days=EVENT_RETENTION_DAYS):
+    """Delete events older than keep_days, returning how many were deleted"""
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM change_events WHERE created_at < NOW() - make_interval(days => %s);", (keep_days,))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    print(f"Pruned {deleted} change events older than {keep_days} days")
+    return deleted
@@ -0,0 +1,76 @@
+import argparse
+import re
+import psycopg2.extensions
+from db_functions import (
+    get_all_assets_and_notes,
+    get_all_trades_for_asset_in_portfolio,
+    get_assets_with_possible_notes,
+    get_clients_with_no_trades,
+    get_connection,
+    get_notes_with_possible_assets,
+    get_recent_trades,
+    get_trade_blotter,
+    get_trade_counts_by_asset,
+)
+
+class ExplainCursor(psycopg2.extensions.cursor):
+    """Cursor that runs EXPLAIN (ANALYZE, BUFFERS) for every query instead of the query itself,
+    so db_functions can be explained without duplicating their SQL"""
+
+    def execute(self, query, vars=None):
+        return super().execute("EXPLAIN (ANALYZE, BUFFERS) " + query, vars)
+
+def _sample_portfolio_and_asset(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT portfolio_id, asset_id
+        FROM trades
+        GROUP BY portfolio_id, asset_id
+        ORDER BY COUNT(*) DESC
+        LIMIT 1;
+    """)
+    row = cur.fetchone()
+    cur.close()
+    return row or (1, 1)
+
+def explain_hot_paths(conn, explain_conn):
+    portfolio_id, asset_id = _sample_portfolio_and_asset(conn)
+    hot_paths = [
+        ("get_all_trades_for_asset_in_portfolio", lambda: get_all_trades_for_asset_in_portfolio(explain_conn, portfolio_id, asset_id)),
+        ("get_recent_trades", lambda: get_recent_trades(explain_conn)),
+        ("get_trade_blotter (asset)", lambda: get_trade_blotter(explain_conn, asset_id=asset_id)),
+        ("get_trade_counts_by_asset", lambda: get_trade_counts_by_asset(explain_conn)),
+        ("get_assets_with_possible_notes", lambda: get_assets_with_possible_notes(explain_conn)),
+        ("get_notes_with_possible_assets", lambda: get_notes_with_possible_assets(explain_conn)),
+        ("get_all_assets_and_notes", lambda: get_all_assets_and_notes(explain_conn)),
+        ("get_all_assets_and_notes (page)", lambda: get_all_assets_and_notes(explain_conn, limit=100, after=(asset_id, None))),
+        ("get_clients_with_no_trades", lambda: get_clients_with_no_trades(explain_conn)),
+        ("get_clients_with_no_trades (page)", lambda: get_clients_with_no_trades(explain_conn, limit=100)),
+    ]
+    report = []
+    for name, explain in hot_paths:
+        plan_rows, _ = explain()
+        explain_conn.rollback()
+        plan = "\n".join(row[0] for row in plan_rows)
+        match = re.search(r"Execution Time: ([\d.]+) ms", plan)
+        report.append((name, float(match.group(1)) if match else None, plan))
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE the trades, notes and clients hot-path queries")
+    parser.add_argument("--output", type=str, help="Write the full plans to this file")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    explain_conn = get_connection(cursor_factory=ExplainCursor)
+    report = explain_hot_paths(conn, explain_conn)
+    conn.close()
+    explain_conn.close()
+
+    for name, execution_ms, _ in report:
+        print(f"{name:<40} {execution_ms:>12.3f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            for name, execution_ms, plan in report:
+                f.write(f"== {name} ({execution_ms} ms)\n{plan}\n\n")
+        print(f"Plans written to {args.output}")
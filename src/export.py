@@ -0,0 +1,226 @@
+import json
+import os
+import shutil
+import threading
+from datetime import date, datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from db_functions import connection
+
+DEFAULT_EXPORT_DIR = os.path.join("..", "exports")
+WATERMARK_FILE = "_watermarks.json"
+# Bytes of COPY output parsed into each Arrow record batch
+EXPORT_BLOCK_SIZE = 16 << 20
+# NUMERIC columns are exported as exact decimals with this many decimal places
+DECIMAL = pa.decimal128(38, 10)
+NUMERIC = "::numeric(38, 10)"
+
+# Each dataset is a query whose last column, day, is the Hive partition its rows are written
+# under (<dataset>/day=YYYY-MM-DD/). Incremental datasets carry a watermark column: trades
+# append the rows past the last exported trade_id, prices re-export every day from the last
+# exported price_date on. Snapshot datasets are written whole under the export date.
+EXPORT_DATASETS = {
+    "trades": {
+        "query": f"""
+            SELECT trade_id, portfolio_id, asset_id, trade_date, side, quantity{NUMERIC}, price{NUMERIC},
+                trade_date::date AS day
+            FROM trades
+            WHERE trade_id > %(watermark)s
+            ORDER BY trade_date, trade_id
+        """,
+        "schema": [("trade_id", pa.int32()), ("portfolio_id", pa.int32()), ("asset_id", pa.int32()),
+                   ("trade_date", pa.timestamp("us")), ("side", pa.string()), ("quantity", DECIMAL),
+                   ("price", DECIMAL)],
+        "watermark": "trade_id",
+        "initial": 0,
+        "overwrite": False,
+    },
+    "prices": {
+        "query": f"""
+            SELECT asset_id, price_date, price{NUMERIC}, price_date AS day
+            FROM prices
+            WHERE price_date >= %(watermark)s
+            ORDER BY price_date, asset_id
+        """,
+        "schema": [("asset_id", pa.int32()), ("price_date", pa.date32()), ("price", DECIMAL)],
+        "watermark": "price_date",
+        "initial": "-infinity",
+        "overwrite": True,
+    },
+    "portfolios": {
+        "query": f"""
+            SELECT portfolio_id, client_id, cash_balance{NUMERIC}, CURRENT_DATE AS day
+            FROM portfolios
+            ORDER BY portfolio_id
+        """,
+        "schema": [("portfolio_id", pa.int32()), ("client_id", pa.int32()), ("cash_balance", DECIMAL)],
+        "overwrite": True,
+    },
+    "positions": {
+        "query": f"""
+            SELECT h.portfolio_id, h.asset_id, h.net_quantity{NUMERIC}, h.average_cost{NUMERIC},
+                lp.price{NUMERIC} AS latest_price,
+                (h.net_quantity * COALESCE(lp.price, h.average_cost)){NUMERIC} AS market_value,
+                CURRENT_DATE AS day
+            FROM holdings h
+            LEFT JOIN latest_prices lp ON lp.asset_id = h.asset_id
+            ORDER BY h.portfolio_id, h.asset_id
+        """,
+        "schema": [("portfolio_id", pa.int32()), ("asset_id", pa.int32()), ("net_quantity", DECIMAL),
+                   ("average_cost", DECIMAL), ("latest_price", DECIMAL), ("market_value", DECIMAL)],
+        "overwrite": True,
+    },
+}
+
+def read_watermarks(export_dir=DEFAULT_EXPORT_DIR):
+    path = os.path.join(export_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def _write_watermarks(export_dir, watermarks):
+    path = os.path.join(export_dir, WATERMARK_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(watermarks, f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+
+def _copy_batches(cur, query, params, schema):
+    """Yield Arrow record batches of query's rows, parsed from a CSV COPY as it streams in
+
+    COPY writes into a pipe from a second thread while pyarrow's streaming CSV reader
+    parses the other end, so only about EXPORT_BLOCK_SIZE bytes are held at a time.
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                cur.copy_expert(f"COPY ({cur.mogrify(query, params).decode()}) TO STDOUT (FORMAT csv)", pipe)
+        except Exception as e:
+            errors.append(e)
+
+    column_types = dict(schema)
+    column_types["day"] = pa.date32()
+    producer = threading.Thread(target=produce)
+    producer.start()
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
+            # No output means no rows or a failed COPY; the CSV reader refuses empty input
+            if pipe.peek(1):
+                reader = pa_csv.open_csv(
+                    pipe,
+                    read_options=pa_csv.ReadOptions(column_names=list(column_types), block_size=EXPORT_BLOCK_SIZE),
+                    convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True),
+                )
+                yield from reader
+    finally:
+        producer.join()
+    if errors:
+        raise errors[0]
+
+class _PartitionWriter:
+    """Writes day-ordered batches to <dataset_dir>/day=YYYY-MM-DD/<file_name>, one file per
+    day, closing each day's file once a later day shows up"""
+
+    def __init__(self, dataset_dir, file_name, schema, overwrite):
+        self.dataset_dir = dataset_dir
+        self.file_name = file_name
+        self.schema = pa.schema(schema)
+        self.overwrite = overwrite
+        self.day = None
+        self.writer = None
+        self.days = 0
+
+    def write(self, batch):
+        table = pa.Table.from_batches([batch])
+        days = table.column("day")
+        for day in pc.unique(days).to_pylist():
+            rows = table.filter(pc.equal(days, pa.scalar(day, pa.date32()))).drop_columns(["day"])
+            if day != self.day:
+                self._open(day)
+            self.writer.write_table(rows.cast(self.schema))
+
+    def _open(self, day):
+        self.close()
+        partition_dir = os.path.join(self.dataset_dir, f"day={day.isoformat()}")
+        if self.overwrite and os.path.isdir(partition_dir):
+            shutil.rmtree(partition_dir)
+        os.makedirs(partition_dir, exist_ok=True)
+        self.writer = pq.ParquetWriter(os.path.join(partition_dir, self.file_name), self.schema)
+        self.day = day
+        self.days += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+def export_dataset(cur, name, export_dir, watermark=None, run_id=None):
+    """Export one dataset, returning (rows, partitions, new watermark)"""
+    dataset = EXPORT_DATASETS[name]
+    dataset_dir = os.path.join(export_dir, name)
+    if watermark is None and os.path.isdir(dataset_dir):
+        # A full export replaces whatever was exported before
+        shutil.rmtree(dataset_dir)
+    run_id = run_id or datetime.now().strftime("%Y%m%dT%H%M%S")
+
+    column = dataset.get("watermark")
+    params = {"watermark": dataset.get("initial") if watermark is None else watermark}
+    writer = _PartitionWriter(dataset_dir, f"part-{run_id}.parquet", dataset["schema"], dataset["overwrite"])
+    rows = 0
+    try:
+        for batch in _copy_batches(cur, dataset["query"], params, dataset["schema"]):
+            if batch.num_rows == 0:
+                continue
+            writer.write(batch)
+            rows += batch.num_rows
+            if column:
+                batch_max = pc.max(batch.column(column)).as_py()
+                watermark = batch_max if watermark is None else max(watermark, batch_max)
+    finally:
+        writer.close()
+    return rows, writer.days, watermark
+
+def _parse_watermark(name, value):
+    if value is not None and EXPORT_DATASETS[name].get("watermark") == "price_date":
+        return date.fromisoformat(value)
+    return value
+
+def export_snapshot(conn, export_dir=DEFAULT_EXPORT_DIR, datasets=None, incremental=False):
+    """Export datasets (default all of EXPORT_DATASETS) to date-partitioned Parquet under export_dir
+
+    Every dataset is read in one REPEATABLE READ transaction, so they're consistent with each
+    other. With incremental=True, trades and prices start from the watermarks of the last
+    export instead of being rewritten whole. Watermarks are only saved once every dataset
+    has been written. Returns (results, columns) with a row per dataset.
+    """
+    datasets = datasets or list(EXPORT_DATASETS)
+    unknown = sorted(set(datasets) - EXPORT_DATASETS.keys())
+    if unknown:
+        raise ValueError(f"Unknown datasets {', '.join(unknown)}, choose from: {', '.join(EXPORT_DATASETS)}")
+    os.makedirs(export_dir, exist_ok=True)
+    watermarks = read_watermarks(export_dir)
+    run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+
+    results = []
+    with connection(conn) as conn:
+        conn.commit()
+        cur = conn.cursor()
+        try:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+            for name in datasets:
+                previous = watermarks.get(name, {}).get("value") if incremental else None
+                rows, partitions, watermark = export_dataset(cur, name, export_dir, _parse_watermark(name, previous), run_id)
+                if watermark is not None:
+                    watermarks[name] = {"column": EXPORT_DATASETS[name]["watermark"], "value": watermark, "run": run_id}
+                results.append((name, rows, partitions, watermark))
+                print(f"Exported {rows} {name} rows into {partitions} partitions")
+        finally:
+            cur.close()
+            conn.rollback()
+    _write_watermarks(export_dir, watermarks)
+    return results, ["dataset", "rows", "partitions", "watermark"]
@@ -1,6 +1,12 @@
+import argparse
+import math
 import random
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 from faker import Faker
-from db_functions import get_connection
+from db_functions import COPY_CHUNK_SIZE, copy_rows, get_connection
+from cache import invalidate
 
 fake = Faker()
 
@@ -9,6 +15,13 @@ NUM_PORTFOLIOS = 15
 NUM_ASSETS = 8
 NUM_TRADES = 40
 NUM_PRICES = 100
+NUM_NOTES = 20
+
+# Size of the Faker name pools sampled from in bulk mode
+NAME_POOL_SIZE = 1000
+
+# Rough USD value of each non-USD base currency used by generate_assets, random-walked daily
+FX_START_RATES = {"EUR": 1.08, "GBP": 1.27, "JPY": 0.0067}
 
 def generate_clients(conn, num):
     cur = conn.cursor()
@@ -72,6 +85,16 @@ def generate_prices(conn, num, asset_ids):
     conn.commit()
     cur.close()
 
+def generate_fx_rates(conn, num_days):
+    cur = conn.cursor()
+    for row in _fx_rows(random, num_days):
+        cur.execute(
+            "INSERT INTO fx_rates (currency, rate_date, rate_to_usd) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;",
+            row
+        )
+    conn.commit()
+    cur.close()
+
 def generate_asset_notes(conn, num_notes, asset_ids):
     cur = conn.cursor()
     for _ in range(num_notes):
@@ -81,44 +104,231 @@ def generate_asset_notes(conn, num_notes, asset_ids):
         else:
             asset_id = None 
         note = fake.sentence(nb_words=10)
+        created_at = datetime.now() - timedelta(seconds=random.randint(0, 365 * 86400))
         cur.execute(
-            "INSERT INTO asset_notes (asset_id, note) VALUES (%s, %s);",
-            (asset_id, note)
+            "INSERT INTO asset_notes (asset_id, note, created_at) VALUES (%s, %s, %s);",
+            (asset_id, note, created_at)
         )
     conn.commit()
     cur.close()
 
-if __name__ == "__main__":
-    conn = get_connection()
+def _fetch_ids(conn, table, id_column, after_id):
+    cur = conn.cursor()
+    cur.execute(f"SELECT {id_column} FROM {table} WHERE {id_column} > %s ORDER BY {id_column};", (after_id,))
+    ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+    return ids
+
+def _max_id(conn, table, id_column):
+    cur = conn.cursor()
+    cur.execute(f"SELECT COALESCE(MAX({id_column}), 0) FROM {table};")
+    max_id = cur.fetchone()[0]
+    cur.close()
+    return max_id
+
+@contextmanager
+def deferred_foreign_keys(conn, table):
+    """Drop table's foreign keys for a bulk load and re-add them afterwards,
+    which validates every loaded row in one set-based pass instead of per row"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT conname, pg_get_constraintdef(oid)
+        FROM pg_constraint
+        WHERE conrelid = %s::regclass AND contype = 'f';
+    """, (table,))
+    constraints = cur.fetchall()
+    for name, _ in constraints:
+        cur.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name};")
+    conn.commit()
+    try:
+        yield
+    finally:
+        conn.rollback()
+        for name, definition in constraints:
+            cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition};")
+        conn.commit()
+        cur.close()
+
+def _client_rows(rng, num):
+    first_names = [fake.first_name() for _ in range(NAME_POOL_SIZE)]
+    last_names = [fake.last_name() for _ in range(NAME_POOL_SIZE)]
+    for _ in range(num):
+        yield rng.choice(first_names), rng.choice(last_names)
+
+def _portfolio_rows(rng, num, client_ids):
+    for _ in range(num):
+        yield rng.choice(client_ids), round(rng.uniform(1000, 10000), 2)
+
+def _asset_rows(rng, num):
+    asset_classes = ['Stock', 'Bond', 'Forex', 'Crypto']
+    base_currencies = ['USD', 'EUR', 'GBP', 'JPY']
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    seen = set()
+    while len(seen) < num:
+        # Symbols grow from 4 up to 8 characters once the shorter space gets crowded
+        length = min(8, 4 + len(seen) // 200_000)
+        symbol = "".join(rng.choice(letters) for _ in range(length))
+        if symbol in seen:
+            continue
+        seen.add(symbol)
+        yield symbol, rng.choice(asset_classes), rng.choice(base_currencies)
+
+def _trade_rows(rng, num, portfolio_ids, asset_ids):
+    # Formatting a datetime per row dominates generation time, so timestamps are
+    # assembled from pre-formatted day and time-of-day strings instead
+    today = date.today()
+    days = [(today - timedelta(days=i)).isoformat() for i in range(365, 0, -1)]
+    times = [f"{h:02d}:{m:02d}:{s:02d}" for h in range(24) for m in range(60) for s in range(60)]
+    num_portfolios, num_assets = len(portfolio_ids), len(asset_ids)
+    rand = rng.random
+    for _ in range(num):
+        yield (
+            portfolio_ids[int(rand() * num_portfolios)],
+            asset_ids[int(rand() * num_assets)],
+            days[int(rand() * 365)] + " " + times[int(rand() * 86400)],
+            'BUY' if rand() < 0.5 else 'SELL',
+            round(1 + 99 * rand(), 2),
+            round(10 + 490 * rand(), 2),
+        )
+
+def _price_rows(rng, num_days, asset_ids):
+    # One random-walk price per asset per calendar day, ending today
+    days = [(date.today() - timedelta(days=num_days - 1 - i)).isoformat() for i in range(num_days)]
+    gauss = rng.gauss
+    for asset_id in asset_ids:
+        price = rng.uniform(10, 200)
+        for day in days:
+            price *= math.exp(gauss(0, 0.02))
+            yield asset_id, day, round(price, 4)
+
+def _fx_rows(rng, num_days):
+    days = [(date.today() - timedelta(days=num_days - 1 - i)).isoformat() for i in range(num_days)]
+    for currency, rate in FX_START_RATES.items():
+        for day in days:
+            rate *= math.exp(rng.gauss(0, 0.005))
+            yield currency, day, round(rate, 8)
+
+def _note_rows(rng, num, asset_ids):
+    # Notes are written over the same year as the trades
+    sentences = [fake.sentence(nb_words=10) for _ in range(NAME_POOL_SIZE)]
+    today = date.today()
+    days = [(today - timedelta(days=i)).isoformat() for i in range(365, 0, -1)]
+    for _ in range(num):
+        asset_id = rng.choice(asset_ids) if rng.random() < 0.8 else None
+        created_at = f"{rng.choice(days)} {rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}"
+        yield asset_id, rng.choice(sentences), created_at
+
+def _report(table, rows, seconds):
+    rate = rows / seconds if seconds else float("inf")
+    print(f"  {table:<12} {rows:>12,} rows in {seconds:8.2f}s ({rate:,.0f} rows/sec)")
+
+def generate_bulk_data(conn, num_clients, num_portfolios, num_assets, num_trades, num_price_days, num_notes,
+                       seed=None, chunk_size=COPY_CHUNK_SIZE, defer_fk_checks=False):
+    """Generate data set-at-a-time with COPY, reporting rows/sec for each table"""
+    rng = random.Random(seed)
+    Faker.seed(seed)
+    stats = []
+
+    def load(table, id_column, columns, rows):
+        before = _max_id(conn, table, id_column) if id_column else None
+        started = time.perf_counter()
+        if defer_fk_checks:
+            with deferred_foreign_keys(conn, table):
+                count = copy_rows(conn, table, columns, rows, chunk_size)
+                conn.commit()
+        else:
+            count = copy_rows(conn, table, columns, rows, chunk_size)
+            conn.commit()
+        invalidate(table)
+        elapsed = time.perf_counter() - started
+        stats.append((table, count, elapsed))
+        _report(table, count, elapsed)
+        return _fetch_ids(conn, table, id_column, before) if id_column else None
+
+    print("Bulk loading with COPY:")
+    # Seed rows aren't changes anyone is watching for, and would fill the change_events outbox
+    cur = conn.cursor()
+    cur.execute("SET portfolio.change_events = 'off';")
+    client_ids = load("clients", "client_id", ["first_name", "last_name"], _client_rows(rng, num_clients))
+    portfolio_ids = load("portfolios", "portfolio_id", ["client_id", "cash_balance"],
+                         _portfolio_rows(rng, num_portfolios, client_ids))
+    asset_ids = load("assets", "asset_id", ["symbol", "asset_class", "base_currency"], _asset_rows(rng, num_assets))
+    load("trades", None, ["portfolio_id", "asset_id", "trade_date", "side", "quantity", "price"],
+         _trade_rows(rng, num_trades, portfolio_ids, asset_ids))
+    load("prices", None, ["asset_id", "price_date", "price"], _price_rows(rng, num_price_days, asset_ids))
+    load("fx_rates", None, ["currency", "rate_date", "rate_to_usd"], _fx_rows(rng, num_price_days))
+    load("asset_notes", None, ["asset_id", "note", "created_at"], _note_rows(rng, num_notes, asset_ids))
+    cur.execute("RESET portfolio.change_events;")
+    conn.commit()
+    cur.close()
+
+    total_rows = sum(count for _, count, _ in stats)
+    total_seconds = sum(seconds for _, _, seconds in stats)
+    _report("total", total_rows, total_seconds)
+    return stats
+
+def generate_sample_data(conn, num_clients=NUM_CLIENTS, num_portfolios=NUM_PORTFOLIOS, num_assets=NUM_ASSETS,
+                         num_trades=NUM_TRADES, num_prices=NUM_PRICES, num_notes=NUM_NOTES, seed=None):
+    if seed is not None:
+        random.seed(seed)
+        Faker.seed(seed)
+
     print("Generating clients...")
-    generate_clients(conn, NUM_CLIENTS)
+    generate_clients(conn, num_clients)
     cur = conn.cursor()
     cur.execute("SELECT client_id FROM clients;")
     client_ids = [row[0] for row in cur.fetchall()]
     cur.close()
 
     print("Generating portfolios...")
-    generate_portfolios(conn, NUM_PORTFOLIOS, client_ids)
+    generate_portfolios(conn, num_portfolios, client_ids)
     cur = conn.cursor()
     cur.execute("SELECT portfolio_id FROM portfolios;")
     portfolio_ids = [row[0] for row in cur.fetchall()]
     cur.close()
 
     print("Generating assets...")
-    generate_assets(conn, NUM_ASSETS)
+    generate_assets(conn, num_assets)
     cur = conn.cursor()
     cur.execute("SELECT asset_id FROM assets;")
     asset_ids = [row[0] for row in cur.fetchall()]
     cur.close()
 
     print("Generating trades...")
-    generate_trades(conn, NUM_TRADES, portfolio_ids, asset_ids)
+    generate_trades(conn, num_trades, portfolio_ids, asset_ids)
 
     print("Generating prices...")
-    generate_prices(conn, NUM_PRICES, asset_ids)
+    generate_prices(conn, num_prices, asset_ids)
+
+    print("Generating FX rates...")
+    generate_fx_rates(conn, 365)
 
     print("Generating asset notes...")
-    generate_asset_notes(conn, 20, asset_ids)
+    generate_asset_notes(conn, num_notes, asset_ids)
 
-    conn.close()
     print("Sample data generation complete.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate sample data for the portfolio database")
+    parser.add_argument("--bulk", action="store_true", help="Stream rows in with COPY instead of per-row INSERTs")
+    parser.add_argument("--clients", type=int, default=NUM_CLIENTS, help="Number of clients")
+    parser.add_argument("--portfolios", type=int, default=NUM_PORTFOLIOS, help="Number of portfolios")
+    parser.add_argument("--assets", type=int, default=NUM_ASSETS, help="Number of assets")
+    parser.add_argument("--trades", type=int, default=NUM_TRADES, help="Number of trades")
+    parser.add_argument("--prices", type=int, default=NUM_PRICES,
+                        help="Number of prices (with --bulk: days of daily prices per asset)")
+    parser.add_argument("--notes", type=int, default=NUM_NOTES, help="Number of asset notes")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible data")
+    parser.add_argument("--chunk_size", type=int, default=COPY_CHUNK_SIZE, help="Rows per COPY chunk (with --bulk)")
+    parser.add_argument("--defer_fk_checks", action="store_true",
+                        help="Drop foreign keys during the load and validate them once at the end (with --bulk)")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    if args.bulk:
+        generate_bulk_data(conn, args.clients, args.portfolios, args.assets, args.trades, args.prices, args.notes,
+                           seed=args.seed, chunk_size=args.chunk_size, defer_fk_checks=args.defer_fk_checks)
+    else:
+        generate_sample_data(conn, args.clients, args.portfolios, args.assets, args.trades, args.prices, args.notes,
+                             seed=args.seed)
+    conn.close()
@@ -0,0 +1,68 @@
+from db_functions import connection
+from cache import invalidate
+
+HOLDING_COLUMNS = ["trade_count", "buy_quantity", "buy_notional", "sell_quantity", "sell_notional"]
+
+def backfill_holdings(conn):
+    """Rebuild the holdings ledger from trades in one transaction
+
+    trades is locked against writes for the duration so no trade lands between the
+    rebuild and the commit. Cash balances are left alone.
+    """
+    columns = ", ".join(HOLDING_COLUMNS)
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("LOCK TABLE trades IN SHARE MODE;")
+            cur.execute("DELETE FROM holdings;")
+            cur.execute(f"""
+                INSERT INTO holdings (portfolio_id, asset_id, {columns})
+                SELECT portfolio_id, asset_id, {columns}
+                FROM holdings_from_trades;
+            """)
+            rebuilt = cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+    invalidate("trades")
+    print(f"Holdings rebuilt: {rebuilt} positions")
+    return rebuilt
+
+def check_holdings(conn, repair=False):
+    """Compare the holdings ledger against a rebuild from trades
+
+    Returns (results, columns) with one row per drifted column per position, showing
+    the ledger value against the value recomputed from trades. With repair=True the
+    ledger is rebuilt when any drift is found.
+    """
+    differences = " UNION ALL ".join(
+        f"SELECT portfolio_id, asset_id, '{column}' AS field, ledger_{column} AS ledger, expected_{column} AS expected "
+        f"FROM compared WHERE ledger_{column} IS DISTINCT FROM expected_{column}"
+        for column in HOLDING_COLUMNS
+    )
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            WITH compared AS (
+                SELECT COALESCE(h.portfolio_id, e.portfolio_id) AS portfolio_id,
+                    COALESCE(h.asset_id, e.asset_id) AS asset_id,
+                    {", ".join(f"h.{c} AS ledger_{c}, e.{c} AS expected_{c}" for c in HOLDING_COLUMNS)}
+                FROM holdings h
+                FULL OUTER JOIN holdings_from_trades e
+                    ON e.portfolio_id = h.portfolio_id AND e.asset_id = h.asset_id
+            )
+            {differences}
+            ORDER BY portfolio_id, asset_id, field;
+        """)
+        results = cur.fetchall()
+        columns = [desc[0] for desc in cur.description]
+        cur.close()
+
+        drifted = len({(row[0], row[1]) for row in results})
+        print(f"Holdings check: {drifted} positions drifted from trades")
+        if drifted and repair:
+            backfill_holdings(conn)
+    return results, columns
@@ -0,0 +1,36 @@
+import csv
+import os
+import sys
+from db_functions import add_trades_bulk, get_connection
+
+PARQUET_BATCH_SIZE = 65_536
+
+def read_trades_csv(path):
+    with open(path, newline="") as f:
+        yield from csv.DictReader(f)
+
+def read_trades_parquet(path):
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(path)
+    for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_SIZE):
+        yield from batch.to_pylist()
+
+def read_trades(path):
+    if os.path.splitext(path)[1].lower() in (".parquet", ".pq"):
+        return read_trades_parquet(path)
+    return read_trades_csv(path)
+
+def import_trades(conn, path, reject_file=None):
+    """Book every trade in a CSV or Parquet file, writing rejected rows next to it by default"""
+    if reject_file is None:
+        reject_file = os.path.splitext(path)[0] + ".rejects.csv"
+    return add_trades_bulk(conn, read_trades(path), reject_file)
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python import_trades.py <trades.csv|trades.parquet> [rejects.csv]")
+        sys.exit(1)
+    conn = get_connection()
+    import_trades(conn, sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+    conn.close()
@@ -1,9 +1,24 @@
-import argparse
+import csv
+import itertools
+import json
+import os
 import sys
-from db_functions import *
-from clear_data import reset_db
-from create_migration import create_migration_file
-from run_migration import run_migration, run_all_migrations
+from datetime import date
+
+ACTIONS = ["init", "load_data", "get_portfolios_with_clients", "port_vals",
+            "percent_invested", "add_client", "search_client",
+            "get_all_clients", "portfolio_asset_trades",
+            "get_top_portfolios", "get_clients_with_no_trades",
+            "get_trade_counts_by_asset", "get_recent_trades", "get_trade_blotter",
+            "get_assets_latest_price", "get_notes_with_possible_assets",
+            "get_all_assets_and_notes", "get_assets_with_possible_notes",
+            "make_migration", "run_migration", "run_all_migrations", "wipe_db", "add_portfolio",
+            "add_price","add_trade", "add_asset", "generate_data", "risk_report",
+            "import_trades", "report_bundle", "backfill_holdings", "check_holdings", "price_as_of",
+            "add_fx_rate", "get_fx_rates", "export", "rollup_snapshots", "backfill_snapshots",
+            "portfolio_history", "save_snapshot", "restore_snapshot", "list_snapshots", "watch_events",
+            "prune_events"
+            ]
 
 def format_query_results(results, columns):
     if not results:
@@ -14,12 +29,33 @@ def format_query_results(results, columns):
     rows = [" | ".join(str(cell).ljust(col_widths[i]) for i, cell in enumerate(row)) for row in results]
     return "\n".join([header, sep] + rows)
 
-if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        print(f"Try '{sys.argv[0]} --help' for more information.")
-        sys.exit(0)
+def write_query_results(results, columns, fmt="table", out=None, sample_size=1000):
+    """Write rows as they arrive, so streamed results are printed in constant memory.
+    Table column widths are estimated from the first sample_size rows."""
+    out = out or sys.stdout
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(results)
+    elif fmt == "jsonl":
+        for row in results:
+            out.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+    else:
+        results = iter(results)
+        sample = list(itertools.islice(results, sample_size))
+        if not sample:
+            out.write("No results found.\n")
+            return
+        col_widths = [max(len(str(col)), max(len(str(row[i])) for row in sample)) for i, col in enumerate(columns)]
+        out.write(" | ".join(str(col).ljust(col_widths[i]) for i, col in enumerate(columns)) + "\n")
+        out.write("-+-".join("-" * w for w in col_widths) + "\n")
+        for row in itertools.chain(sample, results):
+            out.write(" | ".join(str(cell).ljust(col_widths[i]) for i, cell in enumerate(row)) + "\n")
 
-    usage = f"""{sys.argv[0]} [action] [options...]
+def parse_args(argv, prog=sys.argv[0]):
+    # Imported here since actions forwarded to the daemon are parsed there
+    import argparse
+    usage = f"""{prog} [action] [options...]
 
 Actions:
   init                             Create tables
@@ -29,56 +65,107 @@ Actions:
   port_vals                        Get values of each portfolio
   percent_invested                 Get percentage invested for each portfolio
   add_client                       Add a new client to the clients table
-  search_client                    Search for a client by their name for their ID
+  search_client                    Search for a client by their name for their ID, best matches first
   get_all_clients                  Get all clients in the db
   portfolio_asset_trades           Get all trades for a particular asset within a portfolio (ordered by trade date)
   get_top_portfolios               Get top n portfolios by total value, default n is 5
-  get_clients_with_no_trades       Get clients who have not got any trades in any of their portfolios
+  get_clients_with_no_trades       Get clients who have not got any trades in any of their portfolios (optionally in an asset class or date range)
   get_trade_counts_by_asset        Get a total count of trades for each asset
-  get_recent_trades                Get all trades opened within the last 30 days
+  get_recent_trades                Get all trades opened within the last 30 days (or --days), newest first
+  get_trade_blotter                Get a page of trades newest first, optionally in a time range, portfolio, asset or side
   get_assets_latest_price          Get the latest price of assets
   get_notes_with_possible_assets   Get all notes and their linked asset if they have one
-  get_all_assets_and_notes         Get all notes matched with assets if possible
+  get_all_assets_and_notes         Get all assets with their notes, then all notes without an asset
   get_assets_with_possible_notes   Get all assets matched with notes if possible
+  risk_report                      Get historical VaR/CVaR, volatility, max drawdown and asset correlation for each portfolio
   make_migration                   Create db migration file
   run_migration                    Run a migration file
-  run_all_migrations               Run all migration files in order
+  run_all_migrations               Run all pending migration files in order
   wipe_db                          Deletes all records in the db
+  save_snapshot                    Dump every table to a named snapshot
+  restore_snapshot                 Replace all records in the db with a named snapshot (needs a superuser)
+  list_snapshots                   List saved snapshots
+  watch_events                     Print trade and price changes as JSON lines as they're committed
+  prune_events                     Delete change events older than --days from the outbox
   add_asset                        Create a new asset
   add_price                        Add a price row for an asset
+  add_fx_rate                      Add a currency's rate to USD for a date
+  get_fx_rates                     Get each currency's latest rate to USD on or before a date
   add_portfolio                    Add a portfolio for a client
   add_trade                        Add a trade for a portfolio
+  import_trades                    Bulk import trades from a CSV or Parquet file in one transaction
+  report_bundle                    Run several reports concurrently and print them with per-query timings
+  price_as_of                      Get the last price on or before a date for an asset, or for each asset_id,date row of a CSV file
+  backfill_holdings                Rebuild the holdings ledger from the trade history
+  check_holdings                   Report positions where the holdings ledger has drifted from the trade history
+  export                           Export trades, prices, portfolios and positions to date-partitioned Parquet files
+  rollup_snapshots                 Write daily portfolio snapshots for each day since the last rollup
+  backfill_snapshots               Write daily portfolio snapshots for a date range in parallel worker processes
+  portfolio_history                Get a portfolio's daily snapshots, or daily totals across all portfolios
 
 Options:
   -h, --help                  Show this help message
-  --name <name>               Name of the client (use with 'add_client', 'search_client')
-  --portfolio_id <id>         ID of the portfolio (use with 'portfolio_asset_trades')
-  --asset_id <id>             ID of the asset (use with 'portfolio_asset_trades')
+  --name <name>               Name of the client (use with 'add_client', 'search_client'), or of the snapshot
+                              (use with 'save_snapshot', 'restore_snapshot')
+  --portfolio_id <id>         ID of the portfolio (use with 'portfolio_asset_trades', 'portfolio_history', 'add_trade', 'get_trade_blotter')
+  --asset_id <id>             ID of the asset (use with 'portfolio_asset_trades', 'add_trade', 'get_trade_blotter')
+  --side <BUY|SELL>           Trade side (use with 'add_trade', 'get_trade_blotter')
+  --quantity <number>         Trade quantity (use with 'add_trade')
   --n <number>                Number of portfolios to get (use with 'get_top_portfolios')
   --client_id <id>            ID of the client (use with 'add_portfolio')
   --cash_balance <number>     Cash value for a portfolio (use with 'add_portfolio')
   --symbol <text>             Asset symbol (use with 'add_asset')
-  --asset_class <text>        Asset class (use with 'add_asset')
+  --asset_class <text>        Asset class (use with 'add_asset'), or only include this asset class (use with 'get_clients_with_no_trades' and the notes actions)
   --base_currency <text>      Base currency (use with 'add_asset')
-  --price <number>            Price value (use with 'add_price')
-  --date <YYYY-MM-DD>         Price date (use with 'add_price', 'add_trade')
+  --price <number>            Price value (use with 'add_price', 'add_trade')
+  --date <YYYY-MM-DD>         Date (use with 'add_trade', 'price_as_of', 'add_fx_rate', 'get_fx_rates'), or FX rate date (use with 'port_vals', 'get_top_portfolios'), default is today,
+                              or last day to roll up (use with 'rollup_snapshots'), default is yesterday
+  --currency <code>           Currency (use with 'add_fx_rate'), or reporting currency to convert positions to (use with 'port_vals', 'get_top_portfolios')
+  --rate <number>             Value of one unit of --currency in USD (use with 'add_fx_rate')
+  --profile [json|prom]       Report wall time, DB time, rows and bytes per query to stderr, default format is json
+                              (or set PROFILE=json|prom)
+  --profile_output <path>     Write the profile report here instead (or set PROFILE_OUTPUT)
+  --slow_ms <number>          Include the EXPLAIN (ANALYZE, BUFFERS) plan of reads slower than this, default is 500
+                              (or set PROFILE_SLOW_MS)
+  --cprofile <path>           Dump cProfile stats for the whole action here, with or without --profile (or set PROFILE_CPROFILE)
+  --engine <sql|vectorized>   Valuation engine (use with 'port_vals', 'get_top_portfolios'), default is sql
+  --confidence <number>       VaR/CVaR confidence level (use with 'risk_report'), default is 0.95
+  --workers <number>          Worker processes (use with 'risk_report', 'backfill_snapshots'), default is one per core,
+                              or tables dumped or loaded at once (use with 'save_snapshot', 'restore_snapshot'), default is 4
+  --file <path>               CSV or Parquet trades file (use with 'import_trades'), or asset_id,date CSV (use with 'price_as_of')
+  --rejects <path>            File for rejected rows (use with 'import_trades'), default is <file>.rejects.csv
+  --format <table|csv|jsonl>  Output format for query results, default is table
+  --stream                    Stream query results from a server-side cursor instead of loading them all
+  --limit <number>            Maximum rows per page (use with 'search_client', 'get_clients_with_no_trades', the notes actions,
+                              'get_recent_trades' and 'get_trade_blotter'), default is 20 for 'search_client', 100 for
+                              'get_trade_blotter' and no limit otherwise
+  --after <id>                Last client_id of the previous page (use with 'search_client', 'get_clients_with_no_trades'),
+                              or last asset_id (use with 'get_assets_with_possible_notes', 'get_all_assets_and_notes'),
+                              or last trade_id (use with 'get_recent_trades', 'get_trade_blotter')
+  --after_date <timestamp>    Last trade_date of the previous page (use with 'get_recent_trades', 'get_trade_blotter')
+  --after_score <score>       Last score of the previous page (use with 'search_client')
+  --after_note_id <id>        Last note_id of the previous page (use with the notes actions), leave out if it was empty
+  --start <YYYY-MM-DD>        Only count trades or notes on or after this date (use with 'get_clients_with_no_trades' and the notes actions)
+  --end <YYYY-MM-DD>          Only count trades or notes on or before this date (use with 'get_clients_with_no_trades' and the notes actions)
+                              --start and --end also bound the days of 'backfill_snapshots' (default first trade to yesterday)
+                              and 'portfolio_history', and the trades of 'get_trade_blotter' (timestamps, --end exclusive)
+  --queries <action...>       Reports to run (use with 'report_bundle'), default is port_vals percent_invested get_assets_latest_price get_trade_counts_by_asset
+  --cache <memory|disk>       Cache query results, disk keeps them between runs (default from QUERY_CACHE)
+  --repair                    Rebuild the ledger if drift is found (use with 'check_holdings')
+  --dry_run                   List pending migrations without running them (use with 'run_all_migrations')
+  --baseline <version>        Mark migrations up to this version as applied without running them (use with 'run_all_migrations')
+  --max_gap_days <number>     Ignore prices older than this many days before the date (use with 'price_as_of')
+  --output_dir <path>         Export directory (use with 'export'), default is ../exports
+  --datasets <name...>        Datasets to export (use with 'export'), default is trades prices portfolios positions
+  --incremental               Only export trades and prices past the last export's watermarks (use with 'export')
+  --sources <table...>        Only watch changes to these tables (use with 'watch_events'), default is trades prices
+  --timeout <seconds>         Stop after this long without a change (use with 'watch_events'), default is to run until interrupted
+  --days <number>             Days of change events to keep (use with 'prune_events'), default is 7,
+                              or of trades to get (use with 'get_recent_trades'), default is 30
 """
 
-    choices=["init", "load_data", "get_portfolios_with_clients", "port_vals", 
-                "percent_invested", "add_client", "search_client", 
-                "get_all_clients", "portfolio_asset_trades",
-                "get_top_portfolios", "get_clients_with_no_trades",
-                "get_trade_counts_by_asset", "get_recent_trades",
-                "get_assets_latest_price", "get_notes_with_possible_assets",
-                "get_all_assets_and_notes", "get_assets_with_possible_notes",
-                "make_migration", "run_migration", "run_all_migrations", "wipe_db", "add_portfolio",
-                "add_price","add_trade", "add_asset", "generate_data"
-                ]
-    
-    
-    parser = argparse.ArgumentParser()
-
     parser = argparse.ArgumentParser(
+        prog=prog,
         description="Client Portfolio Risk Management CLI",
         usage=usage,
         formatter_class=argparse.RawTextHelpFormatter,
@@ -86,13 +173,13 @@ Options:
     )
 
     # Had to add this to remove error when running --help
-    if "--help" in sys.argv or "-h" in sys.argv:
+    if "--help" in argv or "-h" in argv:
         parser.print_help()
         sys.exit(0)
 
     parser.add_argument(
         "action",
-        choices=choices,
+        choices=ACTIONS,
     )
 
     parser.add_argument("--name", type=str, help="Client name or migration file path")
@@ -105,24 +192,79 @@ Options:
     parser.add_argument("--asset_class", type=str, help="Asset class")
     parser.add_argument("--base_currency", type=str, help="Base currency")
     parser.add_argument("--price", type=float, help="Price value")
+    parser.add_argument("--side", choices=["BUY", "SELL"], type=str.upper, help="Trade side")
+    parser.add_argument("--quantity", type=float, help="Trade quantity")
     parser.add_argument("--price_date", type=str, help="Price date (YYYY-MM-DD)")
+    parser.add_argument("--engine", choices=["sql", "vectorized"], default="sql", help="Valuation engine")
+    parser.add_argument("--confidence", type=float, default=0.95, help="VaR/CVaR confidence level")
+    parser.add_argument("--workers", type=int, help="Worker processes")
+    parser.add_argument("--file", type=str, help="Input file path")
+    parser.add_argument("--rejects", type=str, help="Rejected rows output path")
+    parser.add_argument("--format", choices=["table", "csv", "jsonl"], default="table", help="Output format")
+    parser.add_argument("--stream", action="store_true", help="Stream query results")
+    parser.add_argument("--limit", type=int, help="Maximum rows per page")
+    parser.add_argument("--after", type=int, help="Keyset pagination cursor")
+    parser.add_argument("--after_note_id", type=int, help="Keyset pagination cursor note_id")
+    parser.add_argument("--after_date", type=str, help="Keyset pagination cursor trade_date")
+    parser.add_argument("--after_score", type=str, help="Keyset pagination cursor search score")
+    parser.add_argument("--start", type=str, help="Start date (YYYY-MM-DD)")
+    parser.add_argument("--end", type=str, help="End date (YYYY-MM-DD), inclusive (exclusive for get_trade_blotter)")
+    parser.add_argument("--queries", nargs="+", help="Reports to run concurrently")
+    parser.add_argument("--cache", choices=["memory", "disk"], help="Query result cache backend")
+    parser.add_argument("--repair", action="store_true", help="Rebuild the holdings ledger on drift")
+    parser.add_argument("--dry_run", action="store_true", help="Plan migrations without running them")
+    parser.add_argument("--baseline", type=int, help="Migration version to baseline an existing database at")
+    parser.add_argument("--date", type=str, help="Date (YYYY-MM-DD)")
+    parser.add_argument("--max_gap_days", type=int, help="Maximum age of a forward-filled price in days")
+    parser.add_argument("--currency", type=str, help="Currency code")
+    parser.add_argument("--rate", type=float, help="FX rate to USD")
+    parser.add_argument("--profile", nargs="?", const="json", choices=["json", "prom"],
+                        help="Report per-query timings as JSON or Prometheus text")
+    parser.add_argument("--profile_output", type=str, help="Profile report path")
+    parser.add_argument("--slow_ms", type=float,
+                        help="EXPLAIN (ANALYZE, BUFFERS) queries slower than this when profiling")
+    parser.add_argument("--cprofile", type=str, help="cProfile stats output path")
+    parser.add_argument("--output_dir", type=str, help="Export directory")
+    parser.add_argument("--datasets", nargs="+", help="Datasets to export")
+    parser.add_argument("--incremental", action="store_true", help="Export only rows past the last watermarks")
+    parser.add_argument("--sources", nargs="+", choices=["trades", "prices"], help="Tables to watch")
+    parser.add_argument("--timeout", type=float, help="Idle timeout in seconds")
+    parser.add_argument("--days", type=int, help="Number of days")
 
-    args = parser.parse_args()
-    conn = get_connection()
+    return parser.parse_args(argv)
+
+def run_action(args, conn):
+    """Run one parsed CLI action on conn and write its output to stdout"""
+    # Everything past db_functions is imported by the actions that use it, so an action
+    # only pays for NumPy, Faker or asyncpg when it needs them
+    from db_functions import (
+        TRADE_BLOTTER_PAGE_SIZE, add_asset, add_client, add_fx_rate, add_portfolio, add_price, add_trade, create_tables,
+        get_all_assets_and_notes, get_all_clients, get_all_trades_for_asset_in_portfolio,
+        get_assets_latest_price, get_assets_with_possible_notes, get_clients_with_no_trades, get_fx_rates,
+        get_notes_with_possible_assets, get_percentage_invested, get_portfolio_total_values,
+        get_portfolio_history, get_portfolios_with_clients, get_prices_as_of, get_recent_trades,
+        get_top_portfolios_by_value, get_total_value_history, get_trade_blotter, get_trade_counts_by_asset,
+        load_sample_data, search_clients_by_name,
+    )
 
     results = columns = None
     if args.action == "init":
         create_tables(conn)
     elif args.action == "generate_data":
-        generate_sample_data()
+        from generate_data import generate_sample_data
+        generate_sample_data(conn)
     elif args.action == "load_data":
         load_sample_data(conn)
     elif args.action == "get_portfolios_with_clients":
-        results, columns = get_portfolios_with_clients(conn)
+        results, columns = get_portfolios_with_clients(conn, stream=args.stream)
     elif args.action == "port_vals":
-        results, columns = get_portfolio_total_values(conn)
+        if args.engine == "vectorized":
+            from positions import get_portfolio_values_vectorized
+            results, columns = get_portfolio_values_vectorized(conn, args.currency, args.date)
+        else:
+            results, columns = get_portfolio_total_values(conn, args.currency, args.date, stream=args.stream)
     elif args.action == "percent_invested":
-        results, columns = get_percentage_invested(conn)
+        results, columns = get_percentage_invested(conn, stream=args.stream)
     elif args.action == "add_client":
         if not args.name:
             print("Please provide a client name with --name")
@@ -132,33 +274,46 @@ Options:
         if not args.name:
             print("Please provide a name to search with --name")
         else:
-            results, columns = search_clients_by_name(conn, args.name)
+            after = (args.after_score, args.after) if args.after_score is not None else None
+            results, columns = search_clients_by_name(conn, args.name, limit=args.limit or 20, after=after,
+                                                       stream=args.stream)
     elif args.action == "get_all_clients":
-        results, columns = get_all_clients(conn)
+        results, columns = get_all_clients(conn, stream=args.stream)
     elif args.action == "portfolio_asset_trades":
         if not args.portfolio_id or not args.asset_id:
             print("Please prove both a portfolio id with --portfolio_id and asset id with --asset_id")
         else:
-            results, columns = get_all_trades_for_asset_in_portfolio(conn, args.portfolio_id, args.asset_id)
+            results, columns = get_all_trades_for_asset_in_portfolio(conn, args.portfolio_id, args.asset_id, stream=args.stream)
     elif args.action == "get_top_portfolios":
-        if not args.n:
-            results, columns = get_top_portfolios_by_value(conn)
+        if args.engine == "vectorized":
+            from positions import get_top_portfolios_by_value_vectorized as top_portfolios
         else:
-            results, columns = get_top_portfolios_by_value(conn, args.n)
+            top_portfolios = get_top_portfolios_by_value
+        results, columns = top_portfolios(conn, args.n or 5, currency=args.currency, as_of=args.date)
     elif args.action == "get_clients_with_no_trades":
-        results, columns = get_clients_with_no_trades(conn)
+        results, columns = get_clients_with_no_trades(conn, args.asset_class, args.start, args.end, args.limit, args.after,
+                                                      stream=args.stream)
     elif args.action == "get_trade_counts_by_asset":
-        results, columns = get_trade_counts_by_asset(conn)
-    elif args.action == "get_recent_trades":
-        results, columns = get_recent_trades(conn)
+        results, columns = get_trade_counts_by_asset(conn, stream=args.stream)
+    elif args.action in ("get_recent_trades", "get_trade_blotter"):
+        after = (args.after_date, args.after) if args.after_date is not None else None
+        if args.action == "get_recent_trades":
+            results, columns = get_recent_trades(conn, args.days or 30, args.limit, after, stream=args.stream)
+        else:
+            results, columns = get_trade_blotter(conn, args.start, args.end, args.portfolio_id, args.asset_id, args.side,
+                                                 args.limit or TRADE_BLOTTER_PAGE_SIZE, after, stream=args.stream)
     elif args.action == "get_assets_latest_price":
-        results, columns = get_assets_latest_price(conn)
+        results, columns = get_assets_latest_price(conn, stream=args.stream)
     elif args.action == "get_notes_with_possible_assets":
-        results, columns = get_notes_with_possible_assets(conn)
-    elif args.action == "get_all_assets_and_notes":
-        results, columns = get_all_assets_and_notes(conn)
-    elif args.action == "get_assets_with_possible_notes":
-        results, columns = get_assets_with_possible_notes(conn)
+        results, columns = get_notes_with_possible_assets(conn, args.asset_class, args.start, args.end, args.limit,
+                                                          args.after_note_id, stream=args.stream)
+    elif args.action in ("get_all_assets_and_notes", "get_assets_with_possible_notes"):
+        notes_query = get_all_assets_and_notes if args.action == "get_all_assets_and_notes" else get_assets_with_possible_notes
+        after = (args.after, args.after_note_id) if args.after is not None or args.after_note_id is not None else None
+        results, columns = notes_query(conn, args.asset_class, args.start, args.end, args.limit, after, stream=args.stream)
+    elif args.action == "risk_report":
+        from risk import get_risk_report
+        results, columns = get_risk_report(conn, args.confidence, args.workers)
     elif args.action == "add_portfolio":
         if not args.client_id or not args.cash_balance:
             print("Please provide the client ID and cash balance of the portfolio with --client_id and --cash-balance")
@@ -169,32 +324,168 @@ Options:
             print("Please provide: --portfolio_id --asset_id --side --quantity --price --date")
         else:
             add_trade(conn, args.portfolio_id, args.asset_id, args.side, args.quantity, args.price, args.date)
+    elif args.action == "import_trades":
+        if not args.file:
+            print("Please provide the trades file with --file")
+        else:
+            from import_trades import import_trades
+            import_trades(conn, args.file, args.rejects)
+    elif args.action == "price_as_of":
+        if args.file:
+            with open(args.file, newline="") as f:
+                pairs = [(int(row["asset_id"]), row["date"]) for row in csv.DictReader(f)]
+        elif args.asset_id:
+            pairs = [(args.asset_id, args.date or date.today().isoformat())]
+        else:
+            pairs = None
+            print("Please provide --asset_id (and optionally --date) or a CSV of asset_id,date rows with --file")
+        if pairs:
+            asset_ids, dates = zip(*pairs)
+            results, columns = get_prices_as_of(conn, asset_ids, dates, args.max_gap_days, stream=args.stream)
+    elif args.action == "backfill_holdings":
+        from holdings import backfill_holdings
+        backfill_holdings(conn)
+    elif args.action == "check_holdings":
+        from holdings import check_holdings
+        results, columns = check_holdings(conn, repair=args.repair)
+    elif args.action == "report_bundle":
+        from async_db import BUNDLE_QUERIES, DEFAULT_BUNDLE, report_bundle
+        unknown = sorted(set(args.queries or []) - BUNDLE_QUERIES.keys())
+        if unknown:
+            print(f"Unknown --queries {', '.join(unknown)}, choose from: {', '.join(BUNDLE_QUERIES)}")
+            return
+        reports, total_ms = report_bundle(args.queries or DEFAULT_BUNDLE)
+        for name, bundle_results, bundle_columns, elapsed_ms in reports:
+            print(f"== {name} ({len(bundle_results)} rows in {elapsed_ms:.1f} ms) ==")
+            write_query_results(bundle_results, bundle_columns, args.format)
+            print()
+        print(f"Ran {len(reports)} queries concurrently in {total_ms:.1f} ms "
+              f"(sum of query times {sum(r[3] for r in reports):.1f} ms)")
+    elif args.action == "export":
+        from export import DEFAULT_EXPORT_DIR, export_snapshot
+        results, columns = export_snapshot(conn, args.output_dir or DEFAULT_EXPORT_DIR, args.datasets, args.incremental)
+    elif args.action == "rollup_snapshots":
+        from snapshots import rollup_snapshots
+        rollup_snapshots(conn, args.date)
+    elif args.action == "backfill_snapshots":
+        from snapshots import backfill_snapshots
+        backfill_snapshots(conn, args.start, args.end, args.workers)
+    elif args.action == "portfolio_history":
+        if args.portfolio_id:
+            results, columns = get_portfolio_history(conn, args.portfolio_id, args.start, args.end, stream=args.stream)
+        else:
+            results, columns = get_total_value_history(conn, args.start, args.end, stream=args.stream)
     elif args.action == "add_asset":
         if not args.symbol or not args.asset_class or not args.base_currency:
             print("Please provide --symbol --asset_class --base_currency")
         else:
             asset_id = add_asset(conn, args.symbol, args.asset_class, args.base_currency)
+    elif args.action == "add_fx_rate":
+        if not args.currency or not args.rate:
+            print("Please provide --currency and --rate (and optionally --date)")
+        else:
+            add_fx_rate(conn, args.currency, args.rate, args.date)
+    elif args.action == "get_fx_rates":
+        results, columns = get_fx_rates(conn, args.date, stream=args.stream)
     elif args.action == "add_price":
         if args.asset_id is None or args.price is None:
             print("Please provide --asset_id --price --price_date")
         else:
             asset_id, price_date = add_price(conn, args.asset_id, args.price, args.price_date)
     elif args.action == "wipe_db":
+        from clear_data import reset_db
         reset_db(conn)
+    elif args.action in ("save_snapshot", "restore_snapshot"):
+        if not args.name:
+            print("Please provide a name for the snapshot with --name")
+        else:
+            from db_snapshots import SNAPSHOT_WORKERS, restore_snapshot, save_snapshot
+            snapshot_action = save_snapshot if args.action == "save_snapshot" else restore_snapshot
+            snapshot_action(conn, args.name, args.workers or SNAPSHOT_WORKERS)
+    elif args.action == "list_snapshots":
+        from db_snapshots import list_snapshots
+        results, columns = list_snapshots()
+    elif args.action == "watch_events":
+        from events import subscribe
+        try:
+            for events in subscribe(conn, sources=args.sources, idle_timeout=args.timeout):
+                for event in events:
+                    print(json.dumps(event._asdict(), default=str))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    elif args.action == "prune_events":
+        from events import EVENT_RETENTION_DAYS, prune_events
+        prune_events(conn, args.days if args.days is not None else EVENT_RETENTION_DAYS)
     elif args.action == "make_migration":
         if not args.name:
             print("Please provide a name for the migration with --name")
-        else: 
+        else:
+            from create_migration import create_migration_file
             create_migration_file(args.name)
     elif args.action == "run_migration":
         if not args.name:
             print("Please provide the filepath for the migration file with --name")
         else:
-            run_migration(args.name)
+            from run_migration import run_migration
+            run_migration(args.name, conn)
     elif args.action == "run_all_migrations":
-        run_all_migrations()
+        from run_migration import baseline_migrations, run_all_migrations
+        if args.baseline is not None:
+            baseline_migrations(conn, args.baseline)
+        else:
+            run_all_migrations(conn, dry_run=args.dry_run)
 
-    if results and columns:
+    if args.stream or args.format != "table":
+        if columns:
+            write_query_results(results, columns, args.format)
+    elif results and columns:
         print(format_query_results(results, columns))
-        
+    sys.stdout.flush()
+
+def main(argv):
+    if not argv:
+        print(f"Try '{sys.argv[0]} --help' for more information.")
+        return 0
 
+    socket_path = os.getenv("PORTFOLIO_DAEMON_SOCKET")
+    if socket_path:
+        from daemon import can_forward, run_remote
+        if can_forward(argv, socket_path):
+            return run_remote(argv, socket_path)
+
+    args = parse_args(argv)
+    if args.cache:
+        from cache import enable_cache
+        enable_cache(args.cache)
+    # --cprofile alone only dumps cProfile stats; the query report needs --profile
+    query_report = args.profile or os.getenv("PROFILE")
+    profiling = query_report or args.cprofile or os.getenv("PROFILE_CPROFILE")
+    if profiling:
+        # Profiling has to be on before the connection is opened, to give it the profiling cursor
+        from profiling import PROFILE_OUTPUT, PROFILE_SLOW_MS, PROFILE_CPROFILE, enable_profiling
+        enable_profiling(args.action, args.profile, args.profile_output or PROFILE_OUTPUT,
+                         PROFILE_SLOW_MS if args.slow_ms is None else args.slow_ms, args.cprofile or PROFILE_CPROFILE,
+                         report=bool(query_report))
+
+    from db_functions import get_connection
+    from cache import cache_stats, disable_cache
+    conn = get_connection()
+    try:
+        run_action(args, conn)
+    except BrokenPipeError:
+        # The reader (e.g. head) went away; stop quietly instead of printing a traceback
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+    stats = cache_stats()
+    if stats:
+        print(f"Cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries", file=sys.stderr)
+    disable_cache()
+    if profiling:
+        from profiling import finish_profiling
+        finish_profiling()
+    conn.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,112 @@
+import numpy as np
+from copy_arrays import copy_to_array
+from db_functions import connection, get_fx_conversion_factors
+
+HOLDING_FIELDS = [
+    ("portfolio_id", "int4"),
+    ("asset_id", "int4"),
+    ("net_quantity", "float8"),
+    ("average_cost", "float8"),
+]
+
+LATEST_PRICE_FIELDS = [
+    ("asset_id", "int4"),
+    ("price", "float8"),
+]
+
+def load_holdings(conn):
+    # value_portfolios expects each portfolio's positions to be a contiguous run
+    return copy_to_array(conn, """
+        SELECT portfolio_id, asset_id, net_quantity::float8, COALESCE(average_cost, 0)::float8
+        FROM holdings
+        ORDER BY portfolio_id, asset_id
+    """, HOLDING_FIELDS)
+
+def load_latest_prices(conn):
+    return copy_to_array(conn, """
+        SELECT asset_id, price::float8
+        FROM latest_prices
+    """, LATEST_PRICE_FIELDS)
+
+def mark_positions(portfolio_ids, asset_ids, net_quantity, average_cost, latest_prices):
+    max_asset_id = max(int(asset_ids.max(initial=0)), int(latest_prices["asset_id"].max(initial=0)))
+    price_lookup = np.full(max_asset_id + 1, np.nan)
+    price_lookup[latest_prices["asset_id"]] = latest_prices["price"]
+    mark = price_lookup[asset_ids]
+    mark = np.where(np.isnan(mark), average_cost, mark)
+
+    cost_basis = net_quantity * average_cost
+    market_value = net_quantity * mark
+    return {
+        "portfolio_id": portfolio_ids,
+        "asset_id": asset_ids,
+        "net_quantity": net_quantity,
+        "average_cost": average_cost,
+        "market_value": market_value,
+        "cost_basis": cost_basis,
+        "unrealized_pnl": market_value - cost_basis,
+    }
+
+def load_positions(conn):
+    """Marked positions from the holdings ledger, without reading the trade history"""
+    holdings = load_holdings(conn)
+    return mark_positions(holdings["portfolio_id"].astype(np.int64), holdings["asset_id"].astype(np.int64),
+                          holdings["net_quantity"], holdings["average_cost"], load_latest_prices(conn))
+
+def load_asset_currencies(conn):
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT asset_id, base_currency FROM assets;")
+        rows = cur.fetchall()
+        cur.close()
+    asset_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    currencies = np.array([row[1] for row in rows], dtype=object)
+    return asset_ids, currencies
+
+def convert_positions(positions, asset_ids, currencies, factors):
+    """Convert marked positions with one gather: each currency's factor is looked up once
+    and spread to its assets, then to the positions through an asset_id-indexed array"""
+    codes, currency_index = np.unique(currencies.astype(str), return_inverse=True)
+    code_factors = np.array([float(factors[code]) for code in codes])
+    max_asset_id = max(int(asset_ids.max(initial=0)), int(positions["asset_id"].max(initial=0)))
+    asset_factor = np.full(max_asset_id + 1, np.nan)
+    asset_factor[asset_ids] = code_factors[currency_index]
+    factor = asset_factor[positions["asset_id"]]
+
+    converted = dict(positions)
+    for column in ("market_value", "cost_basis", "unrealized_pnl"):
+        converted[column] = positions[column] * factor
+    return converted
+
+def load_positions_in(conn, currency, as_of=None):
+    factors = get_fx_conversion_factors(conn, currency, as_of)
+    asset_ids, currencies = load_asset_currencies(conn)
+    return convert_positions(load_positions(conn), asset_ids, currencies, factors)
+
+def value_portfolios(positions):
+    # Position keys are sorted by portfolio first, so each portfolio is a contiguous run
+    portfolio_ids, starts = np.unique(positions["portfolio_id"], return_index=True)
+    if len(portfolio_ids) == 0:
+        empty = np.empty(0)
+        return portfolio_ids, empty, empty, empty
+    market_value = np.add.reduceat(positions["market_value"], starts)
+    cost_basis = np.add.reduceat(positions["cost_basis"], starts)
+    return portfolio_ids, market_value, cost_basis, market_value - cost_basis
+
+def _rows(*arrays):
+    return list(zip(*(a.tolist() for a in arrays)))
+
+def get_portfolio_values_vectorized(conn, currency=None, as_of=None):
+    positions = load_positions(conn) if currency is None else load_positions_in(conn, currency, as_of)
+    portfolio_ids, market_value, cost_basis, unrealized_pnl = value_portfolios(positions)
+    results = _rows(portfolio_ids, market_value.round(2), cost_basis.round(2), unrealized_pnl.round(2))
+    columns = ["portfolio_id", "market_value", "cost_basis", "unrealized_pnl"]
+    return results, columns
+
+def get_top_portfolios_by_value_vectorized(conn, limit=5, currency=None, as_of=None):
+    positions = load_positions(conn) if currency is None else load_positions_in(conn, currency, as_of)
+    portfolio_ids, market_value, _, _ = value_portfolios(positions)
+    top = np.argsort(-market_value, kind="stable")[:limit]
+    results = _rows(portfolio_ids[top], market_value[top].round(2))
+    columns = ["portfolio_id", "total_value"]
+    return results, columns
@@ -0,0 +1,78 @@
+import numpy as np
+from copy_arrays import copy_to_array
+
+PRICE_FIELDS = [
+    ("asset_id", "int4"),
+    ("day", "int4"),
+    ("price", "float8"),
+]
+
+class PriceMatrix:
+    """Prices held in memory as an (assets x calendar days) float64 matrix
+
+    Every calendar day from the first to the last price is a column, and days without a
+    price carry the previous price forward. Days before an asset's first price are NaN.
+    """
+
+    def __init__(self, asset_ids, first_day, values, observed_days):
+        self.asset_ids = asset_ids
+        self.first_day = first_day
+        self.values = values
+        # Days on which at least one asset had a real (not filled) price
+        self.observed_days = observed_days
+
+    @classmethod
+    def load(cls, conn, start_date=None, end_date=None):
+        """Load prices with a single binary COPY, optionally limited to a date range"""
+        conditions = []
+        if start_date is not None:
+            conditions.append("price_date >= %(start_date)s::date")
+        if end_date is not None:
+            conditions.append("price_date <= %(end_date)s::date")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        prices = copy_to_array(conn, f"""
+            SELECT asset_id, price_date - DATE '1970-01-01', price::float8
+            FROM prices
+            {where}
+        """, PRICE_FIELDS, {"start_date": start_date, "end_date": end_date})
+        return cls.from_array(prices)
+
+    @classmethod
+    def from_array(cls, prices):
+        asset_ids, asset_index = np.unique(prices["asset_id"], return_inverse=True)
+        if len(prices) == 0:
+            return cls(asset_ids, 0, np.empty((0, 0)), np.empty(0, dtype=np.int32))
+        first_day = int(prices["day"].min())
+        n_days = int(prices["day"].max()) - first_day + 1
+        day_index = prices["day"] - first_day
+
+        values = np.full((len(asset_ids), n_days), np.nan)
+        values[asset_index, day_index] = prices["price"]
+        last_observed = np.where(~np.isnan(values), np.arange(n_days), 0)
+        np.maximum.accumulate(last_observed, axis=1, out=last_observed)
+        values = np.take_along_axis(values, last_observed, axis=1)
+        return cls(asset_ids, first_day, values, np.unique(prices["day"]))
+
+    @property
+    def days(self):
+        return np.arange(self.first_day, self.first_day + self.values.shape[1])
+
+    def as_of(self, asset_ids, as_of_dates):
+        """Vectorized as-of lookup: the price of each asset on or before each date
+
+        Dates after the last loaded day use the last price; unknown assets and dates
+        before an asset's first price give NaN.
+        """
+        asset_ids = np.asarray(asset_ids)
+        days = np.asarray(as_of_dates, dtype="datetime64[D]").astype(np.int64)
+        prices = np.full(len(asset_ids), np.nan)
+        if len(self.asset_ids) == 0:
+            return prices
+        rows = np.minimum(np.searchsorted(self.asset_ids, asset_ids), len(self.asset_ids) - 1)
+        columns = np.minimum(days - self.first_day, self.values.shape[1] - 1)
+        valid = (self.asset_ids[rows] == asset_ids) & (columns >= 0)
+        prices[valid] = self.values[rows[valid], columns[valid]]
+        return prices
+
+    def price(self, asset_id, as_of_date):
+        return float(self.as_of([asset_id], [as_of_date])[0])
@@ -0,0 +1,287 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+
+# Set PROFILE to "json" or "prom" to profile without code changes
+PROFILE_FORMAT = os.getenv("PROFILE")
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT")
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_CPROFILE = os.getenv("PROFILE_CPROFILE")
+# Longest SQL text kept per query in reports
+MAX_SQL_LENGTH = 2000
+METRIC_PREFIX = "portfolio_db"
+
+class QueryProfile:
+    """Timings and sizes for one executed statement
+
+    db_ms is the time spent waiting on the server: execute() for client-side cursors,
+    plus every fetch for server-side (named) ones. wall_ms adds the time psycopg2 spends
+    turning the rows into Python objects. bytes is the text size of the rows fetched.
+    """
+
+    __slots__ = ("caller", "sql", "wall_ms", "db_ms", "rows", "bytes", "plan")
+
+    def __init__(self, caller, sql):
+        self.caller = caller
+        self.sql = sql
+        self.wall_ms = self.db_ms = 0.0
+        self.rows = self.bytes = 0
+        self.plan = None
+
+    def to_dict(self):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values["wall_ms"] = round(self.wall_ms, 3)
+        values["db_ms"] = round(self.db_ms, 3)
+        return values
+
+class Profiler:
+    """Collects a QueryProfile per statement run through a ProfilingCursor"""
+
+    def __init__(self, action=None, slow_ms=PROFILE_SLOW_MS, explain=True):
+        self.action = action
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.queries = []
+        self.started = time.perf_counter()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, query):
+        with self._lock:
+            self.queries.append(query)
+
+    @property
+    def wall_ms(self):
+        return ((self.finished or time.perf_counter()) - self.started) * 1000
+
+    def by_caller(self):
+        """Totals per calling function: {caller: {queries, wall_ms, db_ms, rows, bytes, slow}}"""
+        totals = {}
+        for query in self.queries:
+            entry = totals.setdefault(query.caller, {"queries": 0, "wall_ms": 0.0, "db_ms": 0.0,
+                                                     "rows": 0, "bytes": 0, "slow": 0})
+            entry["queries"] += 1
+            entry["wall_ms"] += query.wall_ms
+            entry["db_ms"] += query.db_ms
+            entry["rows"] += query.rows
+            entry["bytes"] += query.bytes
+            entry["slow"] += query.wall_ms >= self.slow_ms
+        for entry in totals.values():
+            entry["wall_ms"] = round(entry["wall_ms"], 3)
+            entry["db_ms"] = round(entry["db_ms"], 3)
+        return totals
+
+    def report(self):
+        queries = [query.to_dict() for query in self.queries]
+        return {
+            "action": self.action,
+            "wall_ms": round(self.wall_ms, 3),
+            "db_ms": round(sum(query.db_ms for query in self.queries), 3),
+            "query_wall_ms": round(sum(query.wall_ms for query in self.queries), 3),
+            "rows": sum(query.rows for query in self.queries),
+            "bytes": sum(query.bytes for query in self.queries),
+            "slow_ms": self.slow_ms,
+            "by_caller": self.by_caller(),
+            "queries": queries,
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2, default=str)
+
+    def to_prometheus(self):
+        """Prometheus text exposition, e.g. for node_exporter's textfile collector"""
+        action = _label(self.action or "")
+        lines = [
+            f"# HELP {METRIC_PREFIX}_action_seconds Wall time of the CLI action",
+            f"# TYPE {METRIC_PREFIX}_action_seconds gauge",
+            f'{METRIC_PREFIX}_action_seconds{{action="{action}"}} {self.wall_ms / 1000:.6f}',
+        ]
+        metrics = [
+            ("queries_total", "Statements executed", "queries", 1),
+            ("query_wall_seconds_total", "Wall time spent in statements", "wall_ms", 1000),
+            ("query_db_seconds_total", "Time spent waiting on the server", "db_ms", 1000),
+            ("query_rows_total", "Rows fetched", "rows", 1),
+            ("query_bytes_total", "Text size of the rows fetched", "bytes", 1),
+            ("slow_queries_total", "Statements slower than the slow query threshold", "slow", 1),
+        ]
+        totals = self.by_caller()
+        for name, help_text, field, scale in metrics:
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} counter")
+            for caller, entry in sorted(totals.items()):
+                value = entry[field] / scale
+                lines.append(f'{METRIC_PREFIX}_{name}{{action="{action}",caller="{_label(caller)}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _caller():
+    # The first public function up the stack that isn't plumbing: cursor, cache or _fetch
+    frame = sys._getframe(2)
+    while frame is not None:
+        name = frame.f_code.co_name
+        filename = os.path.basename(frame.f_code.co_filename)
+        if filename not in ("profiling.py", "cache.py", "extras.py") and not name.startswith(("_", "<")):
+            return name
+        frame = frame.f_back
+    return "<module>"
+
+def _row_bytes(rows):
+    return sum(len(str(value)) for row in rows for value in row if value is not None)
+
+def _is_explainable(sql):
+    # EXPLAIN ANALYZE runs the statement again, so only plain reads are explained, and
+    # only inside a savepoint that's rolled back
+    words = sql.lstrip().split(None, 1)
+    return bool(words) and words[0].upper() in ("SELECT", "WITH", "VALUES", "TABLE")
+
+class ProfilingCursor(psycopg2.extensions.cursor):
+    """Cursor that reports every statement it runs to the active profiler"""
+
+    def execute(self, query, vars=None):
+        profiler = _profiler
+        if profiler is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        sql = self.query.decode(errors="replace") if self.query else str(query)
+        self._profile = QueryProfile(_caller(), sql[:MAX_SQL_LENGTH])
+        self._profile.wall_ms = self._profile.db_ms = elapsed
+        if self.description is None and self.rowcount > 0:
+            # Writes report the rows they touched
+            self._profile.rows = self.rowcount
+        profiler.record(self._profile)
+        # Named cursors only DECLARE here; their time goes into the fetches
+        if profiler.explain and self.name is None and elapsed >= profiler.slow_ms and _is_explainable(sql):
+            self._profile.plan = _explain(self.connection, query, vars)
+
+    def executemany(self, query, vars_list):
+        profiler = _profiler
+        if profiler is None:
+            return super().executemany(query, vars_list)
+        started = time.perf_counter()
+        super().executemany(query, vars_list)
+        profile = QueryProfile(_caller(), str(query)[:MAX_SQL_LENGTH])
+        profile.wall_ms = profile.db_ms = (time.perf_counter() - started) * 1000
+        profile.rows = max(self.rowcount, 0)
+        profiler.record(profile)
+
+    def copy_expert(self, sql, file, size=8192):
+        profiler = _profiler
+        if profiler is None:
+            return super().copy_expert(sql, file, size)
+        started = time.perf_counter()
+        super().copy_expert(sql, file, size)
+        profile = QueryProfile(_caller(), str(sql)[:MAX_SQL_LENGTH])
+        profile.wall_ms = profile.db_ms = (time.perf_counter() - started) * 1000
+        profile.rows = max(self.rowcount, 0)
+        profiler.record(profile)
+
+    def _fetched(self, rows, elapsed):
+        profile = getattr(self, "_profile", None)
+        if profile is None:
+            return rows
+        profile.wall_ms += elapsed
+        if self.name is not None:
+            profile.db_ms += elapsed
+        profile.rows += len(rows)
+        profile.bytes += _row_bytes(rows)
+        return rows
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched([row] if row is not None else [], (time.perf_counter() - started) * 1000)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        return self._fetched(rows, (time.perf_counter() - started) * 1000)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        return self._fetched(rows, (time.perf_counter() - started) * 1000)
+
+    def __iter__(self):
+        # Iterating a named cursor fetches itersize rows per round-trip
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+def _explain(conn, query, vars):
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    savepoint = not conn.autocommit
+    try:
+        cur.execute("SAVEPOINT profiling_explain;" if savepoint else "BEGIN;")
+        cur.execute(b"EXPLAIN (ANALYZE, BUFFERS) " + cur.mogrify(query, vars))
+        return "\n".join(row[0] for row in cur.fetchall())
+    except psycopg2.Error as e:
+        return f"EXPLAIN failed: {e}".strip()
+    finally:
+        try:
+            cur.execute("ROLLBACK TO SAVEPOINT profiling_explain;" if savepoint else "ROLLBACK;")
+        except psycopg2.Error:
+            pass
+        cur.close()
+
+_profiler = None
+_cprofile = None
+_settings = {}
+
+def enable_profiling(action=None, fmt=None, output=PROFILE_OUTPUT, slow_ms=PROFILE_SLOW_MS,
+                     cprofile_path=PROFILE_CPROFILE, explain=True, report=True):
+    """Profile every query on connections opened from now on, until finish_profiling()
+
+    fmt is "json" or "prom" (default PROFILE, else json). With cprofile_path, a cProfile
+    dump of the whole run is written there as well; with report=False, only that is.
+    """
+    global _profiler, _cprofile
+    fmt = fmt or PROFILE_FORMAT or "json"
+    if fmt not in ("json", "prom"):
+        raise ValueError(f"Unknown profile format '{fmt}', expected 'json' or 'prom'")
+    if report:
+        _profiler = Profiler(action, slow_ms, explain)
+    _settings.update(fmt=fmt, output=output, cprofile_path=cprofile_path)
+    if cprofile_path:
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+    return _profiler
+
+def profiling_enabled():
+    return _profiler is not None
+
+def get_profiler():
+    return _profiler
+
+def finish_profiling():
+    """Stop profiling and write the report to PROFILE_OUTPUT (stderr by default)"""
+    global _profiler, _cprofile
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.finished = time.perf_counter()
+    if _cprofile is not None:
+        _cprofile.disable()
+        _cprofile.dump_stats(_settings["cprofile_path"])
+        print(f"cProfile stats written to {_settings['cprofile_path']}", file=sys.stderr)
+        _cprofile = None
+    if profiler is None:
+        return None
+
+    text = profiler.to_prometheus() if _settings["fmt"] == "prom" else profiler.to_json() + "\n"
+    if _settings["output"]:
+        with open(_settings["output"], "w") as f:
+            f.write(text)
+    else:
+        sys.stderr.write(text)
+    return profiler
@@ -0,0 +1,208 @@
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from copy_arrays import copy_to_array
+from price_store import PriceMatrix
+
+TRADING_DAYS_PER_YEAR = 252
+# Upper bound on (positions x dates) cells a worker holds per array, roughly 160MB of float64
+CHUNK_CELLS = 20_000_000
+# Upper bound on same-portfolio asset pairs expanded at once for the correlation sums
+CORRELATION_PAIRS = 2_000_000
+
+TRADE_FIELDS = [
+    ("portfolio_id", "int4"),
+    ("asset_id", "int4"),
+    ("day", "int4"),
+    ("quantity", "float8"),
+    ("cash_flow", "float8"),
+]
+
+CASH_FIELDS = [
+    ("portfolio_id", "int4"),
+    ("cash_balance", "float8"),
+]
+
+def load_price_matrix(conn):
+    """Load prices into an (assets x dates) matrix over every date that has a price
+
+    Gaps are forward-filled and each asset's history before its first price is
+    back-filled with that first price, so it contributes no P&L until it's priced.
+    """
+    prices = PriceMatrix.load(conn)
+    if len(prices.asset_ids) == 0:
+        return prices.asset_ids, prices.observed_days, np.empty((0, 0))
+    matrix = prices.values[:, prices.observed_days - prices.first_day]
+    first_observed = (~np.isnan(matrix)).argmax(axis=1)
+    matrix = np.where(np.isnan(matrix), matrix[np.arange(len(prices.asset_ids)), first_observed][:, None], matrix)
+    return prices.asset_ids, prices.observed_days, matrix
+
+def load_trades(conn):
+    trades = copy_to_array(conn, """
+        SELECT portfolio_id, asset_id, trade_date::date - DATE '1970-01-01',
+            (CASE WHEN side = 'BUY' THEN quantity ELSE -quantity END)::float8,
+            (CASE WHEN side = 'BUY' THEN -quantity * price ELSE quantity * price END)::float8
+        FROM trades
+    """, TRADE_FIELDS)
+    return trades[np.argsort(trades["portfolio_id"], kind="stable")]
+
+def load_cash_balances(conn):
+    return copy_to_array(conn, "SELECT portfolio_id, cash_balance::float8 FROM portfolios", CASH_FIELDS)
+
+def asset_correlation_matrix(price_matrix):
+    returns = price_matrix[:, 1:] / price_matrix[:, :-1] - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = np.corrcoef(returns)
+    # Assets whose price never moves have no defined correlation
+    return np.nan_to_num(np.atleast_2d(correlation))
+
+_worker_state = {}
+
+def _init_worker(price_matrix, correlation):
+    _worker_state["prices"] = price_matrix
+    _worker_state["price_changes"] = np.diff(price_matrix, axis=1)
+    _worker_state["correlation"] = correlation
+
+def _chunk_metrics(portfolio_ids, cash, local_portfolio, asset_index, day_index, quantity, cash_flow, confidence):
+    prices = _worker_state["prices"]
+    price_changes = _worker_state["price_changes"]
+    correlation = _worker_state["correlation"]
+    n_assets, n_days = prices.shape
+    n_portfolios = len(portfolio_ids)
+
+    # Daily positions per (portfolio, asset) pair: scatter each trade's quantity onto
+    # its date and take a running sum along the date axis
+    pair_keys, pair_index = np.unique(local_portfolio.astype(np.int64) * n_assets + asset_index, return_inverse=True)
+    n_pairs = len(pair_keys)
+    deltas = np.bincount(pair_index * n_days + day_index, weights=quantity, minlength=n_pairs * n_days)
+    positions = np.cumsum(deltas.reshape(n_pairs, n_days), axis=1)
+    pair_portfolio = pair_keys // n_assets
+    pair_asset = pair_keys % n_assets
+
+    starts = np.searchsorted(pair_portfolio, np.arange(n_portfolios))
+    # cash is today's balance, which every trade has already moved; carry it back through
+    # the trades' cash flows to get the balance at each date's close
+    flows = np.cumsum(np.bincount(local_portfolio * n_days + day_index, weights=cash_flow,
+                                  minlength=n_portfolios * n_days).reshape(n_portfolios, n_days), axis=1)
+    cash = cash[:, None] - flows[:, -1:] + flows
+    nav = np.add.reduceat(positions * prices[pair_asset], starts, axis=0) + cash
+    pnl = np.add.reduceat(positions[:, :-1] * price_changes[pair_asset], starts, axis=0)
+
+    previous_nav = nav[:, :-1]
+    returns = np.full(pnl.shape, np.nan)
+    np.divide(pnl, previous_nav, out=returns, where=previous_nav > 0)
+
+    running_peak = np.fmax.accumulate(np.where(nav > 0, nav, np.nan), axis=1)
+
+    # Portfolios without a usable return history come out as NaN rather than warning
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        cutoff = np.nanquantile(returns, 1 - confidence, axis=1)
+        var = -cutoff
+        cvar = -np.nanmean(np.where(returns <= cutoff[:, None], returns, np.nan), axis=1)
+        volatility = np.nanstd(returns, axis=1, ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR)
+        max_drawdown = np.nanmax(np.where(running_peak > 0, 1 - nav / running_peak, np.nan), axis=1)
+
+    # Average pairwise correlation between the assets each portfolio holds today
+    held = positions[:, -1] != 0
+    n_held, pair_correlation_sum = _held_correlation_sums(pair_portfolio[held], pair_asset[held], n_portfolios,
+                                                          correlation)
+    pair_correlation_sum -= n_held
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_correlation = np.where(n_held > 1, pair_correlation_sum / (n_held * (n_held - 1)), np.nan)
+
+    return portfolio_ids, nav[:, -1], var, cvar, volatility, max_drawdown, average_correlation
+
+def _held_correlation_sums(held_portfolio, held_asset, n_portfolios, correlation):
+    """Count each portfolio's held assets and sum correlation[a, b] over every ordered pair
+    of them, the diagonal included
+
+    held_portfolio must be sorted. The pairs are expanded from the sparse held list in
+    batches of at most CORRELATION_PAIRS, so memory doesn't grow with portfolios x assets.
+    """
+    n_held = np.bincount(held_portfolio, minlength=n_portfolios)
+    group_start = np.cumsum(n_held) - n_held
+    partners = n_held[held_portfolio]
+    cost = np.cumsum(partners)
+    sums = np.zeros(n_portfolios)
+    start = 0
+    while start < len(held_asset):
+        done = cost[start - 1] if start else 0
+        stop = max(start + 1, int(np.searchsorted(cost, done + CORRELATION_PAIRS, side="right")))
+        # Pair each held asset in the batch with every asset its portfolio holds
+        counts = partners[start:stop]
+        left = np.repeat(np.arange(start, stop), counts)
+        offset = np.arange(len(left)) - np.repeat(np.cumsum(counts) - counts, counts)
+        right = group_start[held_portfolio[left]] + offset
+        sums += np.bincount(held_portfolio[left], weights=correlation[held_asset[left], held_asset[right]],
+                            minlength=n_portfolios)
+        start = stop
+    return n_held, sums
+
+def _portfolio_chunks(pair_counts, n_days):
+    limit = max(1, CHUNK_CELLS // max(n_days, 1))
+    start = cells = 0
+    for i, count in enumerate(pair_counts):
+        if cells and cells + count > limit:
+            yield start, i
+            start, cells = i, 0
+        cells += count
+    if start < len(pair_counts):
+        yield start, len(pair_counts)
+
+def compute_risk_metrics(asset_ids, days, price_matrix, trades, cash_balances, confidence=0.95, workers=None):
+    """Historical VaR/CVaR, annualized volatility, max drawdown and average held-asset
+    correlation for every portfolio, computed over chunks of portfolios in a process pool"""
+    asset_index = np.searchsorted(asset_ids, trades["asset_id"])
+    priced = (asset_index < len(asset_ids)) & (asset_ids[np.minimum(asset_index, len(asset_ids) - 1)] == trades["asset_id"])
+    trades, asset_index = trades[priced], asset_index[priced]
+    # Trades take effect at the close of their trade date; earlier trades open the first date
+    day_index = np.maximum(np.searchsorted(days, trades["day"], side="right") - 1, 0)
+
+    portfolio_ids, portfolio_starts = np.unique(trades["portfolio_id"], return_index=True)
+    portfolio_ends = np.append(portfolio_starts[1:], len(trades))
+    pair_keys = np.unique(trades["portfolio_id"].astype(np.int64) * len(asset_ids) + asset_index)
+    pair_counts = np.bincount(np.searchsorted(portfolio_ids, pair_keys // len(asset_ids)), minlength=len(portfolio_ids))
+
+    cash_lookup = dict(zip(cash_balances["portfolio_id"].tolist(), cash_balances["cash_balance"].tolist()))
+    cash = np.array([cash_lookup.get(p, 0.0) for p in portfolio_ids.tolist()])
+    correlation = asset_correlation_matrix(price_matrix)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                             initargs=(price_matrix, correlation)) as pool:
+        futures = []
+        for first, last in _portfolio_chunks(pair_counts, len(days)):
+            lo, hi = portfolio_starts[first], portfolio_ends[last - 1]
+            local_portfolio = np.searchsorted(portfolio_ids[first:last], trades["portfolio_id"][lo:hi])
+            futures.append(pool.submit(
+                _chunk_metrics, portfolio_ids[first:last], cash[first:last], local_portfolio,
+                asset_index[lo:hi], day_index[lo:hi], trades["quantity"][lo:hi], trades["cash_flow"][lo:hi],
+                confidence,
+            ))
+        for future in futures:
+            results.append(future.result())
+
+    if not results:
+        empty = np.empty(0)
+        return portfolio_ids, empty, empty, empty, empty, empty, empty
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+def _percent(values):
+    return np.round(values * 100, 2)
+
+def get_risk_report(conn, confidence=0.95, workers=None):
+    asset_ids, days, price_matrix = load_price_matrix(conn)
+    trades = load_trades(conn)
+    cash_balances = load_cash_balances(conn)
+    if len(days) < 2 or len(trades) == 0:
+        return [], []
+    portfolio_ids, nav, var, cvar, volatility, max_drawdown, average_correlation = compute_risk_metrics(
+        asset_ids, days, price_matrix, trades, cash_balances, confidence, workers
+    )
+    columns = ["portfolio_id", "nav", "var_pct", "cvar_pct", "volatility_pct", "max_drawdown_pct", "avg_correlation"]
+    arrays = [portfolio_ids, np.round(nav, 2), _percent(var), _percent(cvar), _percent(volatility),
+              _percent(max_drawdown), np.round(average_correlation, 4)]
+    results = list(zip(*(a.tolist() for a in arrays)))
+    return results, columns
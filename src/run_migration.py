@@ -1,52 +1,288 @@
-import sys
-import os
+import argparse
 import glob
-from db_functions import get_connection
+import hashlib
+import os
+import time
+from db_functions import get_connection, connection
 
-def run_migration(migration_path):
-    with open(migration_path, "r") as f:
-        sql = f.read()
-    conn = get_connection()
+MIGRATIONS_DIR = os.path.join("..", "migrations")
+# Arbitrary key for pg_advisory_lock, shared by every process that runs migrations
+MIGRATION_LOCK_ID = 727_001
+# A migration whose first lines include this header runs outside a transaction, one
+# statement at a time, so it can use CREATE INDEX CONCURRENTLY and friends
+NO_TRANSACTION_HEADER = "-- migrate:no-transaction"
+# Ends a query instead of ";" in those migrations, and as in psql runs each value the query
+# returns as a statement of its own, e.g. to index every partition CONCURRENTLY
+GEXEC = "\\gexec"
+
+def migration_version(migration_path):
+    return os.path.basename(migration_path).split("_")[0]
+
+def migration_checksum(sql):
+    return hashlib.sha256(sql.encode()).hexdigest()
+
+def is_transactional(sql):
+    header = [line.strip() for line in sql.splitlines()[:10]]
+    return NO_TRANSACTION_HEADER not in header
+
+def split_statements(sql):
+    """Split a SQL script on top-level semicolons and \\gexec, skipping over quoted strings,
+    quoted identifiers, comments and $tag$ dollar-quoted bodies"""
+    statements = []
+    start = i = 0
+    n = len(sql)
+    while i < n:
+        char = sql[i]
+        if char in ("'", '"'):
+            i += 1
+            while i < n:
+                if sql[i] == char:
+                    # A doubled quote is an escaped quote, not the end of the string
+                    if i + 1 < n and sql[i + 1] == char:
+                        i += 2
+                        continue
+                    break
+                i += 1
+        elif sql.startswith("--", i):
+            newline = sql.find("\n", i)
+            i = n if newline == -1 else newline
+        elif sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            i = n if end == -1 else end + 1
+        elif char == "$":
+            end_tag = sql.find("$", i + 1)
+            tag = sql[i:end_tag + 1] if end_tag != -1 else ""
+            if tag and (len(tag) == 2 or tag[1:-1].replace("_", "a").isalnum()) and not tag[1].isdigit():
+                end = sql.find(tag, end_tag + 1)
+                i = n if end == -1 else end + len(tag) - 1
+        elif char == ";" or sql.startswith(GEXEC, i):
+            end = i + 1 if char == ";" else i + len(GEXEC)
+            statements.append(sql[start:end])
+            start = end
+            i = end - 1
+        i += 1
+    statements.append(sql[start:])
+    return [s.strip() for s in statements if _has_code(s)]
+
+def _has_code(statement):
+    lines = [line.strip() for line in statement.strip().splitlines()]
+    return any(line and not line.startswith("--") for line in lines)
+
+def ensure_migrations_table(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(20) PRIMARY KEY,
+            name TEXT NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            execution_ms NUMERIC NOT NULL
+        );
+    """)
+    conn.commit()
+    cur.close()
+
+def get_applied_migrations(conn):
+    """Return {version: (name, checksum)} for every migration recorded as applied"""
+    cur = conn.cursor()
+    cur.execute("SELECT version, name, checksum FROM schema_migrations;")
+    applied = {version: (name, checksum) for version, name, checksum in cur.fetchall()}
+    cur.close()
+    conn.commit()
+    return applied
+
+def _record_migration(cur, migration_path, checksum, execution_ms):
+    cur.execute("""
+        INSERT INTO schema_migrations (version, name, checksum, execution_ms)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (version) DO UPDATE
+            SET name = EXCLUDED.name, checksum = EXCLUDED.checksum,
+                applied_at = NOW(), execution_ms = EXCLUDED.execution_ms;
+    """, (migration_version(migration_path), os.path.basename(migration_path), checksum, round(execution_ms, 1)))
+
+def _apply(conn, migration_path, sql):
+    started = time.perf_counter()
+    cur = conn.cursor()
+    if is_transactional(sql):
+        try:
+            cur.execute(sql)
+            _record_migration(cur, migration_path, migration_checksum(sql), (time.perf_counter() - started) * 1000)
+            conn.commit()
+        except Exception:
+            # Leave a shared connection usable for whoever runs next
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        return
+
+    # Each statement commits on its own, so a failure part way through leaves the earlier
+    # ones applied; write these migrations so they can be re-run (IF NOT EXISTS etc.)
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for statement in split_statements(sql):
+            if not statement.endswith(GEXEC):
+                cur.execute(statement)
+                continue
+            cur.execute(statement[:-len(GEXEC)])
+            for row in cur.fetchall():
+                for generated in row:
+                    if generated is not None:
+                        cur.execute(generated)
+        _record_migration(cur, migration_path, migration_checksum(sql), (time.perf_counter() - started) * 1000)
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
+
+def _lock(conn):
     cur = conn.cursor()
-    cur.execute(sql)
+    cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+    cur.close()
     conn.commit()
+
+def _unlock(conn):
+    if conn.closed:
+        return
+    if not conn.autocommit:
+        conn.rollback()
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
     cur.close()
-    conn.close()
+    conn.commit()
+
+def run_migration(migration_path, conn=None):
+    """Apply one migration file and record it in schema_migrations, unless it's already applied"""
+    with open(migration_path, "r") as f:
+        sql = f.read()
+    owns_connection = conn is None
+    if owns_connection:
+        conn = get_connection()
+    try:
+        with connection(conn) as conn:
+            ensure_migrations_table(conn)
+            _lock(conn)
+            try:
+                applied = get_applied_migrations(conn)
+                if migration_version(migration_path) in applied:
+                    print(f"Migration {migration_path} is already applied, skipping.")
+                    return
+                _apply(conn, migration_path, sql)
+            finally:
+                _unlock(conn)
+    finally:
+        if owns_connection:
+            conn.close()
     print(f"Migration {migration_path} applied successfully.")
 
-def run_all_migrations():
-    """Run all migration files in the migrations directory in numerical order"""
-    migrations_dir = "../migrations"
-    if not os.path.exists(migrations_dir):
+def plan_migrations(conn, migrations_dir=MIGRATIONS_DIR):
+    """Return (migration_path, status) for every migration file, in order
+
+    status is 'applied', 'pending' or 'changed' (applied, but the file's checksum no
+    longer matches what was recorded).
+    """
+    ensure_migrations_table(conn)
+    applied = get_applied_migrations(conn)
+    plan = []
+    for migration_path in sorted(glob.glob(os.path.join(migrations_dir, "*.sql"))):
+        with open(migration_path, "r") as f:
+            checksum = migration_checksum(f.read())
+        recorded = applied.get(migration_version(migration_path))
+        if recorded is None:
+            status = "pending"
+        elif recorded[1] != checksum:
+            status = "changed"
+        else:
+            status = "applied"
+        plan.append((migration_path, status))
+    return plan
+
+def baseline_migrations(conn, version, migrations_dir=MIGRATIONS_DIR):
+    """Record every migration numbered up to and including version (an int) as applied
+    without running it, for databases that were migrated before schema_migrations existed"""
+    with connection(conn) as conn:
+        plan = plan_migrations(conn, migrations_dir)
+        cur = conn.cursor()
+        baselined = 0
+        for migration_path, status in plan:
+            if int(migration_version(migration_path)) > version or status != "pending":
+                continue
+            with open(migration_path, "r") as f:
+                _record_migration(cur, migration_path, migration_checksum(f.read()), 0)
+            baselined += 1
+        conn.commit()
+        cur.close()
+    print(f"Baselined {baselined} migration(s) up to {version:03d}.")
+
+def run_all_migrations(conn=None, dry_run=False):
+    """Apply every pending migration in numerical order on one connection
+
+    An advisory lock serialises concurrent runs; each migration commits with its
+    schema_migrations record, so a failure stops the run with earlier ones kept and is
+    re-raised.
+    """
+    if not os.path.exists(MIGRATIONS_DIR):
         print("No migrations directory found.")
         return
-    
-    # Get all .sql files in migrations directory and sort them
-    migration_files = glob.glob(os.path.join(migrations_dir, "*.sql"))
-    migration_files.sort()  # This will sort by filename, which should be in order due to numbering
-    
-    if not migration_files:
-        print("No migration files found.")
-        return
-    
-    print(f"Found {len(migration_files)} migration(s) to run:")
-    for migration_file in migration_files:
-        print(f"  - {os.path.basename(migration_file)}")
-    
-    print("\nRunning migrations...")
-    for migration_file in migration_files:
-        try:
-            run_migration(migration_file)
-        except Exception as e:
-            print(f"Error running migration {migration_file}: {e}")
-            print("Migration process stopped.")
-            return
-    
+
+    owns_connection = conn is None
+    if owns_connection:
+        conn = get_connection()
+    try:
+        with connection(conn) as conn:
+            ensure_migrations_table(conn)
+            _lock(conn)
+            try:
+                plan = plan_migrations(conn)
+                if not plan:
+                    print("No migration files found.")
+                    return
+                pending = [path for path, status in plan if status == "pending"]
+                for migration_path, status in plan:
+                    if status == "changed":
+                        print(f"Warning: {os.path.basename(migration_path)} has changed since it was applied")
+
+                print(f"{len(pending)} of {len(plan)} migration(s) pending:")
+                for migration_path in pending:
+                    with open(migration_path, "r") as f:
+                        mode = "" if is_transactional(f.read()) else " (no transaction)"
+                    print(f"  - {os.path.basename(migration_path)}{mode}")
+                if dry_run or not pending:
+                    return
+
+                print("\nRunning migrations...")
+                for migration_path in pending:
+                    with open(migration_path, "r") as f:
+                        sql = f.read()
+                    started = time.perf_counter()
+                    try:
+                        _apply(conn, migration_path, sql)
+                    except Exception as e:
+                        print(f"Error running migration {migration_path}: {e}")
+                        print("Migration process stopped.")
+                        raise
+                    print(f"  Applied {os.path.basename(migration_path)} in {time.perf_counter() - started:.2f}s")
+            finally:
+                _unlock(conn)
+    finally:
+        if owns_connection:
+            conn.close()
+
     print("\n✅ All migrations completed successfully!")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python run_migration.py <migration_file.sql>")
-        sys.exit(1)
-    migration_file = sys.argv[1]
-    run_migration(migration_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Apply pending migrations from ../migrations")
+    parser.add_argument("migration_file", nargs="?", help="Apply just this migration file")
+    parser.add_argument("--dry_run", action="store_true", help="Show pending migrations without applying them")
+    parser.add_argument("--baseline", type=int, help="Mark migrations up to this version (e.g. 8) as applied")
+    args = parser.parse_args()
+
+    if args.baseline is not None:
+        conn = get_connection()
+        baseline_migrations(conn, args.baseline)
+        conn.close()
+    elif args.migration_file:
+        run_migration(args.migration_file)
+    else:
+        run_all_migrations(dry_run=args.dry_run)
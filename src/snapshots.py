@@ -0,0 +1,244 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, timedelta
+from db_functions import connection, get_connection
+from cache import invalidate
+
+SNAPSHOT_JOB = "portfolio_daily_snapshots"
+# Arbitrary key for pg_advisory_lock, held while the nightly rollup or a backfill runs
+SNAPSHOT_LOCK_ID = 727_021
+# Days of history each backfill worker rolls up per task
+BACKFILL_CHUNK_DAYS = 30
+
+# Positions and cash are carried forward a day at a time in two temp tables: the positions
+# (like holdings, with its generated net_quantity and average_cost) and cash at the close of
+# the day before the range, then each day's trades added on. Each day costs one pass over
+# the open positions instead of re-aggregating every trade up to that day. portfolios.cash_balance
+# is today's, with every trade's cash already moved by the holdings triggers, so cash on a past
+# day is today's balance less the flows of later trades.
+OPEN_POSITIONS_SQL = """
+    CREATE TEMP TABLE snapshot_positions (LIKE holdings INCLUDING GENERATED INCLUDING INDEXES);
+    CREATE TEMP TABLE snapshot_cash AS
+    SELECT p.portfolio_id, p.cash_balance - COALESCE(later.cash_flow, 0) AS cash_balance
+    FROM portfolios p
+    LEFT JOIN (
+        SELECT portfolio_id, SUM(CASE WHEN side = 'SELL' THEN quantity * price ELSE -quantity * price END) AS cash_flow
+        FROM trades
+        WHERE trade_date >= %(start)s::date
+        GROUP BY portfolio_id
+    ) later ON later.portfolio_id = p.portfolio_id;
+    ALTER TABLE snapshot_cash ADD PRIMARY KEY (portfolio_id);
+"""
+
+# Adds the trades in [start, end) to the positions and, with apply_cash, their flows to cash
+ADD_TRADES_SQL = """
+    WITH day_trades AS (
+        SELECT * FROM trades WHERE trade_date >= %(start)s::date AND trade_date < %(end)s::date
+    ),
+    positions AS (
+        INSERT INTO snapshot_positions AS s
+            (portfolio_id, asset_id, trade_count, buy_quantity, buy_notional, sell_quantity, sell_notional)
+        SELECT portfolio_id, asset_id, COUNT(*),
+            COALESCE(SUM(quantity) FILTER (WHERE side = 'BUY'), 0),
+            COALESCE(SUM(quantity * price) FILTER (WHERE side = 'BUY'), 0),
+            COALESCE(SUM(quantity) FILTER (WHERE side = 'SELL'), 0),
+            COALESCE(SUM(quantity * price) FILTER (WHERE side = 'SELL'), 0)
+        FROM day_trades
+        GROUP BY portfolio_id, asset_id
+        ON CONFLICT (portfolio_id, asset_id) DO UPDATE
+            SET trade_count = s.trade_count + EXCLUDED.trade_count,
+                buy_quantity = s.buy_quantity + EXCLUDED.buy_quantity,
+                buy_notional = s.buy_notional + EXCLUDED.buy_notional,
+                sell_quantity = s.sell_quantity + EXCLUDED.sell_quantity,
+                sell_notional = s.sell_notional + EXCLUDED.sell_notional
+    )
+    UPDATE snapshot_cash c
+    SET cash_balance = c.cash_balance + flows.cash_flow
+    FROM (
+        SELECT portfolio_id, SUM(CASE WHEN side = 'SELL' THEN quantity * price ELSE -quantity * price END) AS cash_flow
+        FROM day_trades
+        GROUP BY portfolio_id
+    ) flows
+    WHERE c.portfolio_id = flows.portfolio_id
+        AND %(apply_cash)s;
+"""
+
+# One row per portfolio for the day, valued as in POSITIONS_CTE but at each asset's last
+# price on or before the day rather than latest_prices. Only portfolios that have traded by
+# the day get a row; rows a rerun finds for any other portfolio are deleted.
+WRITE_SNAPSHOTS_SQL = """
+    DELETE FROM portfolio_daily_snapshots d
+    WHERE d.snapshot_date = %(day)s::date
+        AND NOT EXISTS (SELECT 1 FROM snapshot_positions s WHERE s.portfolio_id = d.portfolio_id);
+
+    WITH day_prices AS (
+        SELECT a.asset_id, p.price
+        FROM assets a
+        JOIN LATERAL (
+            SELECT price
+            FROM prices
+            WHERE prices.asset_id = a.asset_id AND prices.price_date <= %(day)s::date
+            ORDER BY price_date DESC
+            LIMIT 1
+        ) p ON TRUE
+    ),
+    valued AS (
+        SELECT s.portfolio_id,
+            SUM(s.net_quantity * COALESCE(dp.price, s.average_cost)) AS market_value,
+            SUM(s.net_quantity * s.average_cost) AS cost_basis
+        FROM snapshot_positions s
+        LEFT JOIN day_prices dp ON dp.asset_id = s.asset_id
+        GROUP BY s.portfolio_id
+    )
+    INSERT INTO portfolio_daily_snapshots AS snap
+        (portfolio_id, snapshot_date, market_value, cost_basis, cash_balance, percent_invested)
+    SELECT c.portfolio_id, %(day)s::date,
+        ROUND(v.market_value, 2),
+        ROUND(v.cost_basis, 2),
+        ROUND(c.cash_balance, 2),
+        ROUND(v.market_value / NULLIF(v.market_value + c.cash_balance, 0) * 100, 2)
+    FROM snapshot_cash c
+    JOIN valued v ON v.portfolio_id = c.portfolio_id
+    ON CONFLICT (portfolio_id, snapshot_date) DO UPDATE
+        SET market_value = EXCLUDED.market_value,
+            cost_basis = EXCLUDED.cost_basis,
+            cash_balance = EXCLUDED.cash_balance,
+            percent_invested = EXCLUDED.percent_invested;
+"""
+
+SET_WATERMARK_SQL = """
+    INSERT INTO rollup_watermarks (job, last_date)
+    VALUES (%(job)s, %(day)s)
+    ON CONFLICT (job) DO UPDATE
+        SET last_date = GREATEST(rollup_watermarks.last_date, EXCLUDED.last_date), updated_at = NOW();
+"""
+
+def _days(start, end):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+def _as_date(value):
+    return value if value is None or isinstance(value, date) else date.fromisoformat(str(value))
+
+def rollup_days(conn, start_date, end_date, job=None):
+    """Write snapshots for every day from start_date to end_date on one connection
+
+    Each day commits on its own, together with the job's watermark if job is given, so a
+    failure keeps the days already written. Returns the number of days written.
+    """
+    start_date, end_date = _as_date(start_date), _as_date(end_date)
+    written = 0
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(OPEN_POSITIONS_SQL, {"start": start_date})
+            cur.execute(ADD_TRADES_SQL, {"start": "-infinity", "end": start_date, "apply_cash": False})
+            for day in _days(start_date, end_date):
+                cur.execute(ADD_TRADES_SQL, {"start": day, "end": day + timedelta(days=1), "apply_cash": True})
+                cur.execute(WRITE_SNAPSHOTS_SQL, {"day": day})
+                if job:
+                    cur.execute(SET_WATERMARK_SQL, {"job": job, "day": day})
+                conn.commit()
+                written += 1
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("DROP TABLE IF EXISTS snapshot_positions, snapshot_cash;")
+            conn.commit()
+            cur.close()
+    invalidate("portfolio_daily_snapshots")
+    return written
+
+def get_watermark(conn, job=SNAPSHOT_JOB):
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT last_date FROM rollup_watermarks WHERE job = %s;", (job,))
+        row = cur.fetchone()
+        cur.close()
+        conn.rollback()
+    return row[0] if row else None
+
+def _first_trade_day(conn):
+    with connection(conn) as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT MIN(trade_date)::date FROM trades;")
+        first_day = cur.fetchone()[0]
+        cur.close()
+        conn.rollback()
+    return first_day
+
+@contextmanager
+def _snapshot_lock(conn):
+    # Rollups and backfills wait for each other instead of writing the same days and the
+    # watermark at once
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s);", (SNAPSHOT_LOCK_ID,))
+    conn.commit()
+    try:
+        yield
+    finally:
+        conn.rollback()
+        cur.execute("SELECT pg_advisory_unlock(%s);", (SNAPSHOT_LOCK_ID,))
+        conn.commit()
+        cur.close()
+
+def rollup_snapshots(conn, through=None):
+    """Nightly rollup: snapshot every day after the watermark up to through (default yesterday)
+
+    Without a watermark it starts from the first trade. Runs under an advisory lock, so
+    overlapping runs wait for each other instead of writing the same days twice.
+    """
+    through = _as_date(through) or date.today() - timedelta(days=1)
+    with connection(conn) as conn, _snapshot_lock(conn):
+        watermark = get_watermark(conn)
+        start = watermark + timedelta(days=1) if watermark else _first_trade_day(conn)
+        if start is None or start > through:
+            print(f"Snapshots are up to date (watermark {watermark})")
+            return 0
+        written = rollup_days(conn, start, through, job=SNAPSHOT_JOB)
+    print(f"Rolled up {written} days of snapshots, {start} to {through}")
+    return written
+
+def _backfill_chunk(start_date, end_date):
+    # Runs in a worker process, which can't share the parent's connection
+    conn = get_connection()
+    try:
+        return rollup_days(conn, start_date, end_date)
+    finally:
+        conn.close()
+
+def backfill_snapshots(conn, start_date=None, end_date=None, workers=None, chunk_days=BACKFILL_CHUNK_DAYS):
+    """Fill snapshots from start_date (default the first trade) to end_date (default yesterday)
+
+    The range is split into chunk_days chunks rolled up in parallel, one process and
+    connection per worker. Days already in the table are overwritten. The watermark moves
+    up to end_date when the range reaches back to it, so the nightly rollup carries on from there.
+    Holds the rollup's advisory lock throughout, so the two never run at once.
+    """
+    start_date = _as_date(start_date) or _first_trade_day(conn)
+    end_date = _as_date(end_date) or date.today() - timedelta(days=1)
+    if start_date is None or start_date > end_date:
+        print("Nothing to backfill")
+        return 0
+
+    chunks = []
+    for chunk_start in _days(start_date, end_date):
+        if (chunk_start - start_date).days % chunk_days == 0:
+            chunks.append((chunk_start, min(chunk_start + timedelta(days=chunk_days - 1), end_date)))
+    with connection(conn) as conn, _snapshot_lock(conn):
+        with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(chunks))) as pool:
+            written = sum(pool.map(_backfill_chunk, *zip(*chunks)))
+
+        watermark = get_watermark(conn)
+        if watermark is None or start_date <= watermark + timedelta(days=1):
+            cur = conn.cursor()
+            cur.execute(SET_WATERMARK_SQL, {"job": SNAPSHOT_JOB, "day": end_date})
+            conn.commit()
+            cur.close()
+    invalidate("portfolio_daily_snapshots")
+    print(f"Backfilled {written} days of snapshots, {start_date} to {end_date}, in {len(chunks)} chunks")
+    return written